@@ -0,0 +1,434 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# benchmarks of the lxbatch tools on synthetic campaigns, to tell whether a
+# change made them faster or slower.  the inputs are generated: input cards
+# the size of v37214light.inp (stubs.py), the job files split.py makes of them, result
+# zips holding USRBIN scoring files (a few of them of failed jobs), _KAM dumps
+# and RESNUCLe tables.  nothing needs FLUKA or HTCondor; execute.py submits
+# to a stub condor_submit, and combine.py merges natively.
+#
+# each benchmark is timed at several scales, a few times each, keeping the
+# fastest run.  the timings are written as JSON, and compared with those of an
+# earlier run:
+#
+#     benchmark.py -o baseline.json
+#     ...
+#     benchmark.py -c baseline.json
+#
+# with -d, the generated inputs are kept in DIR and reused by later runs.
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import gzip
+import json
+import time
+import struct
+import shutil
+import fnmatch
+import zipfile
+import platform
+import tempfile
+import contextlib
+import collections
+import multiprocessing
+import itertools as it
+from timeit import default_timer
+from optparse import OptionParser
+import numpy
+import util as ut
+import manifest as mf
+import card as cd
+import split as sp
+import execute as ex
+import combine as cb
+import scoring as sc
+import kam
+import rnuc2tab as rn
+import bundle as bd
+import stubs as sb
+
+VERSION="""
+2.x""".strip()
+ut.require_version_match(VERSION)
+
+DEFAULT_REPEAT = 3
+DEFAULT_SCALES = "small,medium"
+# a benchmark more than this much slower than in the baseline is a regression
+DEFAULT_TOLERANCE = 0.2
+
+# the scales multiply the sizes of the inputs
+SCALES = collections.OrderedDict([("small", 1), ("medium", 4), ("large", 40)])
+
+INPUT_BASE = "bench"
+# sizes of the inputs at scale 1
+JOBS = 50
+KAM_RECORDS = 100000
+RESNUCLE_FILES = 25
+# every FAILED_EVERY-th result zip is one of a failed job
+FAILED_EVERY = 20
+USRBIN_BINS = (40, 40, 20)
+USRBIN_UNIT = 21
+RESNUCLE_DETECTORS = 20
+RESNUCLE_ISOTOPES = 300
+RESNUCLE_ISOMERS = 30
+# distinct records the _KAM dumps are drawn from
+KAM_POOL = 4096
+
+STUB_CONDOR_SUBMIT = """#!/bin/sh
+# stands in for condor_submit in the benchmarks
+echo "Submitting job(s)."
+echo "1 job(s) submitted to cluster 1."
+"""
+
+# runs the block with the output of the tools going nowhere
+@contextlib.contextmanager
+def quiet(enabled=True):
+    if not enabled:
+        yield
+        return
+    stdout, stderr = sys.stdout, sys.stderr
+    with open(os.devnull, "w") as null:
+        sys.stdout = sys.stderr = null
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+# makes path with generator(temporary path, *args), unless it exists.  the
+# inputs appear complete or not at all, so that -d can reuse them.
+def generated(path, generator, *args):
+    if not os.path.exists(path):
+        temp = tempfile.mkdtemp(prefix=".%s." % os.path.basename(path), dir=os.path.dirname(path))
+        try:
+            generator(temp, *args)
+            os.rename(temp, path)
+        except BaseException:
+            shutil.rmtree(temp, ignore_errors=True)
+            raise
+    return path
+
+def generate_card(directory, nlines=sb.CARD_LINES):
+    with open(os.path.join(directory, "%s.inp" % INPUT_BASE), "w") as file:
+        file.write(sb.synthetic_card(nlines))
+
+def read_base(directory):
+    return cd.read_card(os.path.join(directory, "%s.inp" % INPUT_BASE))
+
+def split_jobs(path_prefix, base, njobs):
+    journal, manifest = ut.Journal(), mf.open_manifest(path_prefix)
+    sp.make_copies(path_prefix, journal, manifest, INPUT_BASE, base, it.islice(ut.generate_identifiers(), njobs),
+                   it.islice(ut.generate_seeds(base.seed()), njobs), sp.DEFAULT_NPRIMARIES)
+    journal.commit()
+    manifest.commit()
+
+# a campaign split into njobs jobs, ready for execute.py
+def generate_jobs(directory, njobs):
+    generate_card(directory)
+    with quiet():
+        split_jobs(directory, read_base(directory), njobs)
+    mf.close_manifest(directory)
+    path = os.path.join(directory, "condor_submit")
+    with open(path, "w") as file:
+        file.write(STUB_CONDOR_SUBMIT)
+    os.chmod(path, 0o755)
+
+def usrbin_scoring(data, ncase):
+    nx, ny, nz = USRBIN_BINS
+    header = (1, b"DOSE".ljust(10), 10, 208, -100.0, 100.0, nx, 200.0 / nx,
+              -100.0, 100.0, ny, 200.0 / ny, 0.0, 500.0, nz, 500.0 / nz, 0, 0.0, 0.0, 0.0)
+    raw_header = struct.pack(sc.DETECTOR_FORMATS[86][1], *header)
+    kind, header = sc.parse_detector_header(raw_header)
+    return sc.Scoring(b"synthetic benchmark geometry", b"benchmark", float(ncase), ncase, 1,
+                      [sc.Detector(kind, header, raw_header, None, data)])
+
+# the result zips of njobs jobs, each holding a USRBIN scoring file and the
+# log of the run; those of failed jobs hold the run directory rfluka left
+def generate_results(directory, njobs):
+    random = numpy.random.RandomState(0)
+    scratch = os.path.join(directory, "scratch")
+    os.mkdir(scratch)
+    for n, identifier in enumerate(it.islice(ut.generate_identifiers(), njobs)):
+        job = "%s_%s" % (INPUT_BASE, identifier)
+        scoring = os.path.join(scratch, "%s001_fort.%i" % (job, USRBIN_UNIT))
+        sc.write_scoring(scoring, usrbin_scoring(random.exponential(size=numpy.prod(USRBIN_BINS))
+                                                 .astype(numpy.float32), sp.DEFAULT_NPRIMARIES))
+        with zipfile.ZipFile(os.path.join(directory, "results_%s.zip" % job), "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.write(scoring, os.path.basename(scoring))
+            archive.writestr("%s001.log" % job, "synthetic run of %s\n" % job * 100)
+            if n % FAILED_EVERY == FAILED_EVERY - 1:
+                archive.writestr("fluka_%i/ranc%s001" % (1000 + n, job), "")
+        os.remove(scoring)
+    os.rmdir(scratch)
+
+def good_results(directory):
+    return sorted(os.path.join(directory, fn) for fn in os.listdir(directory)
+                  if ut.is_job_result(fn, INPUT_BASE, directory) and ut.job_result_failure(os.path.join(directory, fn)) is None)
+
+# a _KAM dump of nrecords crossings.  the lines are drawn in turn from a pool
+# of random records, so that large dumps are quick to write; compressed dumps
+# get a sidecar as the jobs write them.
+def generate_kam(directory, nrecords, compressed=False):
+    random = numpy.random.RandomState(0)
+    jtracks = random.randint(1, 63, KAM_POOL)
+    reals = random.standard_normal((KAM_POOL, kam.NREALS)) * 10.0 ** random.randint(-3, 4, (KAM_POOL, kam.NREALS))
+    pool = ["%5i%s\n" % (jtrack, "".join(sb.fortran_real(x) for x in row)) for jtrack, row in zip(jtracks, reals)]
+    path = os.path.join(directory, "%s_aaaa001_KAM" % INPUT_BASE) + (kam.COMPRESSED_SUFFIX if compressed else "")
+    with (gzip.open(path, "wb", 1) if compressed else open(path, "wb")) as file:
+        for start in range(0, nrecords, KAM_POOL):
+            block = ["%7i%s" % (1 + i // 8 % 9999999, pool[i % KAM_POOL]) for i in range(start, min(nrecords, start + KAM_POOL))]
+            file.write("".join(block).encode("ascii"))
+    if compressed:
+        sidecar = {"sha256": bd.sha256(path), "records": nrecords, "events": (nrecords + 7) // 8,
+                   "bytes": nrecords * kam.RECORD_WIDTH + nrecords}
+        with open(kam.sidecar_filename(path), "w") as file:
+            json.dump(sidecar, file)
+
+# nfiles RESNUCLe tables, each of RESNUCLE_DETECTORS detectors
+def generate_resnucle(directory, nfiles):
+    random = numpy.random.RandomState(0)
+    for n in range(nfiles):
+        lines = []
+        for d in range(RESNUCLE_DETECTORS):
+            lines.append(" # Detector n:  %3i  REGION%02i\n" % (d + 1, d))
+            lines.append(" # A/Z Isotopes:\n #   A   Z     Isotope      err(%)\n")
+            Z = 1 + numpy.arange(RESNUCLE_ISOTOPES) % 90
+            A = 2 * Z + numpy.arange(RESNUCLE_ISOTOPES) // 90
+            activities = random.exponential(size=RESNUCLE_ISOTOPES) * 10.0 ** random.randint(-6, 3, RESNUCLE_ISOTOPES)
+            activities[random.uniform(size=RESNUCLE_ISOTOPES) < 0.3] = 0.0
+            errors = numpy.where(activities > 0, random.uniform(1.0, 100.0, RESNUCLE_ISOTOPES), 0.0)
+            lines += ["  %3i %3i   %10.4E  %7.3f\n" % row for row in zip(A, Z, activities, errors)]
+            lines.append(" # A/Z/m Isomers:\n #   A   Z   m      Isomer   err(%)\n")
+            Z = 20 + numpy.arange(RESNUCLE_ISOMERS)
+            activities = random.exponential(size=RESNUCLE_ISOMERS) * 10.0 ** random.randint(-6, 3, RESNUCLE_ISOMERS)
+            errors = random.uniform(1.0, 100.0, RESNUCLE_ISOMERS)
+            lines += ["  %3i %3i %3i %10.4E  %7.3f\n" % (z + z + 1, z, 1, a, e) for z, a, e in zip(Z, activities, errors)]
+        with open(os.path.join(directory, "%s_resnucle_%04i_tab.lis" % (INPUT_BASE, n)), "w") as file:
+            file.write("".join(lines))
+
+# the benchmarks.  each takes the directory of its scale and the size of its
+# input, and returns the function to time and one to call between runs (or
+# None).
+
+def bench_split(directory, size):
+    inputs = generated(os.path.join(directory, "card"), generate_card)
+    runs = []
+    def run():
+        base = read_base(inputs)
+        runs.append(tempfile.mkdtemp(prefix="split.", dir=directory))
+        split_jobs(runs[-1], base, size)
+    def reset():
+        mf.close_manifest(runs[-1])
+        shutil.rmtree(runs[-1])
+    return run, reset
+
+def bench_execute(directory, size):
+    path_prefix = generated(os.path.join(directory, "jobs-%i" % size), generate_jobs, size)
+    def run():
+        argv, flupro = sys.argv, os.environ.get("FLUPRO")
+        sys.argv = ["execute.py", "--bulk", "--condor-submit", os.path.join(path_prefix, "condor_submit"),
+                    "%s.inp" % INPUT_BASE]
+        os.environ["FLUPRO"] = flupro or "/nonexistent/fluka"
+        try:
+            ex.main(path_prefix)
+        finally:
+            sys.argv = argv
+            if flupro is None:
+                del os.environ["FLUPRO"]
+    def reset():
+        mf.close_manifest(path_prefix)
+    return run, reset
+
+# the verdicts on the zips are cached in the manifest; the first scan of a
+# campaign opens every zip, later ones only those that changed
+def forget_verdicts(directory):
+    mf.close_manifest(directory)
+    if os.path.exists(os.path.join(directory, mf.FILENAME)):
+        os.remove(os.path.join(directory, mf.FILENAME))
+
+def bench_find_job_results(directory, size):
+    results = generated(os.path.join(directory, "results-%i" % size), generate_results, size)
+    forget_verdicts(results)
+    return (lambda: ut.find_job_results(results, INPUT_BASE)), (lambda: forget_verdicts(results))
+
+def bench_find_job_results_cached(directory, size):
+    results = generated(os.path.join(directory, "results-%i" % size), generate_results, size)
+    run = lambda: ut.find_job_results(results, INPUT_BASE)
+    run()
+    return run, None
+
+def bench_combine(directory, size):
+    results = generated(os.path.join(directory, "results-%i" % size), generate_results, size)
+    zips = good_results(results)
+    scorings = {str(USRBIN_UNIT): sc.USRBIN}
+    output = os.path.join(directory, "%s_usrbin_%i" % (INPUT_BASE, USRBIN_UNIT))
+    def run():
+        members = cb.index_members(zips, scorings)[str(USRBIN_UNIT)]
+        merged = sc.merge([(zip, member) for zip, member, size, name in members], cb.DEFAULT_JOBS).scoring()
+        sc.write_scoring(output, merged)
+    return run, None
+
+def bench_kam(directory, size):
+    inputs = generated(os.path.join(directory, "kam-%i" % size), generate_kam, size)
+    path = os.path.join(inputs, "%s_aaaa001_KAM" % INPUT_BASE)
+    return (lambda: kam.read_kam(path)), None
+
+def bench_kam_gz(directory, size):
+    inputs = generated(os.path.join(directory, "kam-gz-%i" % size), generate_kam, size, True)
+    path = os.path.join(inputs, "%s_aaaa001_KAM%s" % (INPUT_BASE, kam.COMPRESSED_SUFFIX))
+    return (lambda: kam.read_kam(path)), None
+
+def bench_resnucle(directory, size):
+    inputs = generated(os.path.join(directory, "resnucle-%i" % size), generate_resnucle, size)
+    paths = sorted(os.path.join(inputs, fn) for fn in os.listdir(inputs))
+    return (lambda: rn.summary_rows(rn.aggregate(paths))), None
+
+# name: (function, unit of the size, size at scale 1)
+BENCHMARKS = collections.OrderedDict([
+    ("split",                   (bench_split,                   "jobs",    JOBS)),
+    ("execute",                 (bench_execute,                 "jobs",    JOBS)),
+    ("find_job_results",        (bench_find_job_results,        "zips",    JOBS)),
+    ("find_job_results_cached", (bench_find_job_results_cached, "zips",    JOBS)),
+    ("combine",                 (bench_combine,                 "zips",    JOBS)),
+    ("kam",                     (bench_kam,                     "records", KAM_RECORDS)),
+    ("kam_gz",                  (bench_kam_gz,                  "records", KAM_RECORDS)),
+    ("resnucle",                (bench_resnucle,                "files",   RESNUCLE_FILES)),
+    ])
+
+# times the benchmark repeat times at one scale.  returns its result.
+def run_benchmark(name, directory, scale, repeat, verbose):
+    function, unit, size = BENCHMARKS[name]
+    size *= SCALES[scale]
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with quiet(not verbose):
+        run, reset = function(directory, size)
+        times = []
+        for i in range(repeat):
+            start = default_timer()
+            run()
+            times.append(default_timer() - start)
+            if reset is not None:
+                reset()
+    return collections.OrderedDict([("size", size), ("unit", unit), ("seconds", min(times)),
+                                    ("rate", size / min(times) if min(times) else None), ("times", times)])
+
+def environment(repeat):
+    return collections.OrderedDict([("version", VERSION),
+                                    ("date", time.strftime("%Y-%m-%dT%H:%M:%S")),
+                                    ("host", platform.node()),
+                                    ("machine", platform.machine()),
+                                    ("cpus", multiprocessing.cpu_count()),
+                                    ("python", platform.python_version()),
+                                    ("numpy", numpy.__version__),
+                                    ("repeat", repeat)])
+
+def read_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+def write_results(path, results):
+    temp = "%s.tmp" % path
+    with open(temp, "w") as file:
+        json.dump(results, file, indent=2)
+        file.write("\n")
+    os.rename(temp, path)
+
+# compares the timings with those of the baseline.  returns lines of a table
+# and the names of the regressions.  benchmarks of another size than in the
+# baseline are not compared.
+def compare(results, baseline, tolerance):
+    lines = ["%-36s %14s %10s %10s %7s" % ("benchmark", "size", "seconds", "baseline", "ratio")]
+    regressions = []
+    for key, result in results["results"].items():
+        reference = baseline["results"].get(key)
+        line = "%-36s %14s %10.3f" % (key, "%i %s" % (result["size"], result["unit"]), result["seconds"])
+        if reference is None or reference["size"] != result["size"]:
+            lines.append(line + " %10s" % "-")
+            continue
+        ratio = result["seconds"] / reference["seconds"] if reference["seconds"] else float("inf")
+        verdict = ""
+        if ratio > 1 + tolerance:
+            verdict = "  slower"
+            regressions.append(key)
+        elif ratio < 1 / (1 + tolerance):
+            verdict = "  faster"
+        lines.append(line + " %10.3f %7.2f%s" % (reference["seconds"], ratio, verdict))
+    return lines, regressions
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options]",
+                          version="%prog "+VERSION,
+                          description="Time the lxbatch tools on synthetic campaigns",
+                          epilog=("Benchmarks: %s.  Scales: %s, multiplying the sizes of the inputs by %s.  "
+                                  "Each benchmark runs REPEAT times at every scale, and its fastest run is "
+                                  "kept.  With -c, the timings are compared with those of an earlier run "
+                                  "written with -o, and the exit status is 1 if any benchmark got slower by "
+                                  "more than the tolerance."
+                                  % (", ".join(BENCHMARKS), ", ".join(SCALES),
+                                     ", ".join(str(scale) for scale in SCALES.values()))))
+    parser.add_option("-k", "--benchmarks", dest="patterns", default="*",
+                      help="run the benchmarks matching the comma-separated PATTERNS (default: all)",
+                      metavar="PATTERNS")
+    parser.add_option("-s", "--scales", dest="scales", default=DEFAULT_SCALES,
+                      help="run at the comma-separated SCALES (default: %s)" % DEFAULT_SCALES, metavar="SCALES")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=DEFAULT_REPEAT,
+                      help="time each benchmark N times (default: %i)" % DEFAULT_REPEAT, metavar="N")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="write the timings to FILE as JSON", metavar="FILE")
+    parser.add_option("-c", "--compare", dest="baseline", default=None,
+                      help="compare the timings with those in FILE", metavar="FILE")
+    parser.add_option("-t", "--tolerance", dest="tolerance", type="float", default=DEFAULT_TOLERANCE,
+                      help="with -c, report benchmarks slower by more than this fraction (default: %g)"
+                           % DEFAULT_TOLERANCE, metavar="FRACTION")
+    parser.add_option("-d", "--directory", dest="directory", default=None,
+                      help="generate the inputs in DIR and keep them for later runs "
+                           "(default: a temporary directory, removed afterwards)", metavar="DIR")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose",
+                      help="show the output of the tools")
+    (options, args) = parser.parse_args()
+
+    if args or options.repeat < 1:
+        sys.exit(parser.get_usage())
+    patterns = options.patterns.split(",")
+    names = [name for name in BENCHMARKS if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+    scales = options.scales.split(",")
+    unknown = [scale for scale in scales if scale not in SCALES]
+    if unknown or not names:
+        sys.exit("unknown scales %s" % ", ".join(unknown) if unknown else "no benchmarks match %s" % options.patterns)
+    return (names, scales, options)
+
+def main():
+    names, scales, options = process_arguments()
+    baseline = read_results(options.baseline) if options.baseline else None
+
+    directory = options.directory or tempfile.mkdtemp(prefix="lxbatch_benchmark_")
+    results = environment(options.repeat)
+    results["results"] = collections.OrderedDict()
+    try:
+        for scale in scales:
+            for name in names:
+                key = "%s/%s" % (name, scale)
+                result = run_benchmark(name, os.path.join(os.path.abspath(directory), scale), scale,
+                                       options.repeat, options.verbose)
+                results["results"][key] = result
+                warn("%-36s %10i %-8s %10.3f s" % (key, result["size"], result["unit"], result["seconds"]))
+    finally:
+        if not options.directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if options.output:
+        write_results(options.output, results)
+    if baseline is not None:
+        lines, regressions = compare(results, baseline, options.tolerance)
+        print("\n".join(lines))
+        if regressions:
+            sys.exit("%i benchmarks got slower than in %s: %s" % (len(regressions), options.baseline,
+                                                                   ", ".join(regressions)))
+
+if __name__ == '__main__':
+    main()
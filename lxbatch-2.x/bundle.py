@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# campaign bundles: the files every job of a campaign needs besides its input
+# (the executable, the field maps and the shared card body written by
+# split.py -s) packed into one compressed archive named after the hash of its
+# contents, bundle-<digest>.tar.gz.  the archive is built reproducibly (sorted
+# members, no timestamps or owners), so the same files always give the same
+# bundle, and the digest doubles as its checksum.  the job scripts written by
+# execute.py --bundle verify the bundle against the full SHA-256 and unpack it
+# into a cache directory on the worker, once per bundle: later jobs with the
+# same bundle in the same slot only link its files.  unpack() does the same
+# here, with any local directory standing in for the worker cache.
+#
+#     bundle.py build [-o DIR] FILE...
+#     bundle.py verify BUNDLE...
+#     bundle.py unpack BUNDLE CACHE
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import re
+import io
+import gzip
+import fcntl
+import shutil
+import hashlib
+import tarfile
+import tempfile
+from optparse import OptionParser
+
+PREFIX = "bundle-"
+SUFFIX = ".tar.gz"
+DIGEST_LENGTH = 16
+LOCK = ".lock"
+RE_BUNDLE = re.compile(r"^%s(?P<digest>[0-9a-f]{%i})%s$" % (re.escape(PREFIX), DIGEST_LENGTH, re.escape(SUFFIX)))
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def bundle_filename(sha):
+    return "%s%s%s" % (PREFIX, sha[:DIGEST_LENGTH], SUFFIX)
+
+# the digest in the name of a bundle, or None if it is not named like one
+def bundle_digest(path):
+    match = RE_BUNDLE.match(os.path.basename(path))
+    return match.group("digest") if match else None
+
+# packs the files, under their base names, into the bytes of a gzipped tar
+# archive that depend on nothing but their names, contents and whether they
+# are executable
+def pack(paths):
+    names = [os.path.basename(path) for path in paths]
+    if len(set(names)) != len(names):
+        raise ValueError("files with the same name cannot go into one bundle: %s" % ", ".join(paths))
+    raw = io.BytesIO()
+    with gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as compressed:
+        archive = tarfile.open(fileobj=compressed, mode="w", format=tarfile.GNU_FORMAT)
+        for name, path in sorted(zip(names, paths)):
+            info = tarfile.TarInfo(name)
+            info.size = os.path.getsize(path)
+            info.mode = 0o755 if os.access(path, os.X_OK) else 0o644
+            info.mtime = 0
+            with open(path, "rb") as file:
+                archive.addfile(info, file)
+        archive.close()
+    return raw.getvalue()
+
+# builds the bundle of the files in directory, unless it is there already.
+# returns its path and full SHA-256.
+def build(paths, directory):
+    data = pack(paths)
+    sha = hashlib.sha256(data).hexdigest()
+    path = os.path.join(directory, bundle_filename(sha))
+    if not os.path.exists(path):
+        fd, temp = tempfile.mkstemp(prefix=".%s." % os.path.basename(path), suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.chmod(temp, 0o644)
+        os.rename(temp, path)
+    return path, sha
+
+# checks a bundle against the digest in its name, or the full SHA-256 if given.
+# returns its full SHA-256.
+def verify(path, sha=None):
+    digest = bundle_digest(path)
+    if digest is None:
+        raise ValueError("%s: not named like a bundle" % path)
+    actual = sha256(path)
+    if not actual.startswith(digest) or (sha and actual != sha):
+        raise ValueError("%s: checksum mismatch" % path)
+    return actual
+
+def members(path):
+    with tarfile.open(path, "r:gz") as archive:
+        return archive.getnames()
+
+# unpacks a bundle into cache/<digest>, unless an earlier job did, and
+# returns that directory.  concurrent unpackers of the same cache wait for
+# each other, and a bundle appears in the cache complete or not at all.
+def unpack(path, cache, sha=None):
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+    target = os.path.join(cache, bundle_digest(path) or "")
+    with open(os.path.join(cache, LOCK), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.isdir(target):
+                verify(path, sha)
+                temp = tempfile.mkdtemp(prefix=".unpack.", dir=cache)
+                try:
+                    with tarfile.open(path, "r:gz") as archive:
+                        for member in archive.getmembers():
+                            if not member.isfile() or os.path.basename(member.name) != member.name:
+                                raise ValueError("%s: unexpected member %s" % (path, member.name))
+                        archive.extractall(temp)
+                    os.rename(temp, target)
+                except BaseException:
+                    shutil.rmtree(temp, ignore_errors=True)
+                    raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return target
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog build [-o DIR] FILE...\n"
+                                "       %prog verify BUNDLE...\n"
+                                "       %prog unpack BUNDLE CACHE",
+                          description="Build, verify and unpack campaign bundles",
+                          epilog=("build packs the files into DIR/%s<digest>%s, named after the SHA-256 of "
+                                  "the archive, and prints its name; verify checks bundles against the digest "
+                                  "in their names; unpack unpacks a bundle into CACHE/<digest> as the jobs do "
+                                  "on the workers." % (PREFIX, SUFFIX)))
+    parser.add_option("-o", "--output-directory", dest="directory", default=os.getcwd(),
+                      help="with build, write the bundle to DIR (default: the current directory)", metavar="DIR")
+    (options, args) = parser.parse_args()
+    if (len(args) < 2 or args[0] not in ("build", "verify", "unpack") or
+        (args[0] == "unpack" and len(args) != 3)):
+        sys.exit(parser.get_usage())
+    return (options, args[0], args[1:])
+
+def main():
+    options, command, args = process_arguments()
+    try:
+        if command == "build":
+            path, sha = build(args, options.directory)
+            warn("%s: %s" % (path, ", ".join(members(path))))
+            print(os.path.basename(path))
+        elif command == "verify":
+            for path in args:
+                verify(path)
+                warn("%s: checksum ok" % path)
+        else:
+            print(unpack(args[0], args[1]))
+    except (ValueError, IOError, OSError, tarfile.TarError) as e:
+        sys.exit(str(e))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# a FLUKA input card, parsed once: its lines, indexed by card name, with the
+# *#lxbatch directives and the state of the preprocessor (#if, #ifdef, ...)
+# of every line.  the geometry block is kept as text and parsed only when its
+# regions are needed, e.g. to resolve the region ranges of the ASSIGNMA cards
+# into the material of every region.
+#
+# variants of a card are the base card with some of its lines replaced, as
+# described by overlays, small dicts (or JSON objects) of changes:
+#
+#     {"name": "vacuum",
+#      "materials": {"R010": "VACUUM"},           material of single regions
+#      "swap": {"AA2219": "VACUUM"},              material everywhere
+#      "cards": [{"name": "EMFCUT", "match": {"what4": "IRON"},
+#                 "set": {"what1": -0.0002}}],    WHATs or SDUM of cards
+#      "start": 1000, "randomiz": 5}              primaries and seed
+#
+# a variant matrix crosses lists of overlays:
+#
+#     {"base": "v37214light.inp",
+#      "axes": [[{"name": "light"}, {"name": "vacuum", "swap": {...}}],
+#               [{"name": "cuts"}, {"name": "lowcuts", "cards": [...]}]]}
+#
+#     card.py show CARD [-c NAME]... [-r REGION]... [-m MATERIAL]...
+#     card.py matrix MATRIX.json [-o DIR]
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import re
+import json
+import time
+import itertools as it
+import collections
+from optparse import OptionParser
+import util as ut
+
+RE_DIRECTIVE = re.compile(r"^\*[ ]?#lxbatch\s+(?P<kind>\w+)\s+(?P<argument>.*)$")
+RE_PREPROCESSOR = re.compile(r"^#(?P<command>\w+)\s*(?P<argument>\S*)")
+
+# the fields of a card in fixed format: the name, WHAT(1) to WHAT(6) and SDUM
+FIELDS = ["what%i" % k for k in range(1, 7)] + ["sdum"]
+NAME_WIDTH = 10
+
+# a card of the input: its line number (from 0), name and fields, stripped
+Card = collections.namedtuple("Card", "line name fields")
+
+def card_name(line):
+    return line[:NAME_WIDTH].strip()
+
+def card_fields(line):
+    line = line.rstrip("\r\n")
+    return dict((field, ut.get_WHAT(line, k + 1).strip()) for k, field in enumerate(FIELDS))
+
+class InputCard(object):
+    def __init__(self, text):
+        self.text = text
+        self.lines = text.splitlines(True)
+        # line numbers of the cards, by name
+        self.names = collections.defaultdict(list)
+        # (line number, kind, argument) of the *#lxbatch directives
+        self.directive_lines = []
+        # line numbers inside false #if blocks
+        self.inactive = set()
+        # (line number, path) of the #include lines outside false #if blocks
+        self.include_lines = []
+        # the lines from GEOBEGIN to GEOEND
+        self.geometry_lines = (0, 0)
+        self._regions = None
+        self._assignments = None
+        self._assigned = None
+        self.parse()
+
+    def parse(self):
+        defines = set()
+        # for every open #if: whether its lines are active, and whether one of
+        # its branches was
+        stack = []
+        geometry = None
+        for i, line in enumerate(self.lines):
+            first = line[:1]
+            if first == "#":
+                match = RE_PREPROCESSOR.match(line)
+                command, argument = match.groups() if match else ("", "")
+                outer = all(active for active, taken in stack)
+                if command in ("if", "ifdef", "ifndef"):
+                    if command == "if":
+                        condition = int(argument) != 0 if argument.isdigit() else argument in defines
+                    else:
+                        condition = (argument in defines) == (command == "ifdef")
+                    stack.append((outer and condition, condition))
+                elif command == "elif" and stack:
+                    taken = stack[-1][1]
+                    condition = not taken and (int(argument) != 0 if argument.isdigit() else argument in defines)
+                    stack[-1] = (all(active for active, t in stack[:-1]) and condition, taken or condition)
+                elif command == "else" and stack:
+                    taken = stack[-1][1]
+                    stack[-1] = (all(active for active, t in stack[:-1]) and not taken, True)
+                elif command == "endif" and stack:
+                    stack.pop()
+                elif command == "define" and outer:
+                    defines.add(argument)
+                elif command == "undef" and outer:
+                    defines.discard(argument)
+                elif command == "include" and outer:
+                    self.include_lines.append((i, argument))
+                continue
+            if stack and not all(active for active, taken in stack):
+                self.inactive.add(i)
+            if first == "*":
+                if line.startswith("*#lxbatch") or line.startswith("* #lxbatch"):
+                    match = RE_DIRECTIVE.match(line)
+                    if match:
+                        self.directive_lines.append((i, match.group("kind"), match.group("argument")))
+                continue
+            if geometry is not None:
+                if line.startswith("GEOEND"):
+                    self.geometry_lines = (geometry, i + 1)
+                    geometry = None
+                else:
+                    continue
+            name = card_name(line)
+            if name:
+                self.names[name].append(i)
+                if name == "GEOBEGIN":
+                    geometry = i
+
+    # the cards of the given name, those in false #if blocks only if asked
+    def cards(self, name, inactive=False):
+        return [Card(i, name, card_fields(self.lines[i])) for i in self.names.get(name, [])
+                if inactive or i not in self.inactive]
+
+    def card(self, name):
+        cards = self.cards(name)
+        return cards[0] if cards else None
+
+    # the arguments of the *#lxbatch directives of a kind, e.g. "before"
+    def directives(self, kind):
+        return [argument for i, k, argument in self.directive_lines if k == kind]
+
+    # the paths of the files the card #includes
+    def includes(self):
+        return [path for i, path in self.include_lines]
+
+    @property
+    def geometry(self):
+        return "".join(self.lines[self.geometry_lines[0]:self.geometry_lines[1]])
+
+    # the names of the regions, in order, from the geometry block
+    @property
+    def regions(self):
+        if self._regions is None:
+            self._regions = []
+            self._region_indices = {}
+            ends = 0
+            for i in range(*self.geometry_lines):
+                line = self.lines[i]
+                if i in self.inactive or line[:1] in ("*", "#", "$", " ", "|", "\t", "\n", "\r"):
+                    continue
+                name = line.split()[0]
+                if name == "END":
+                    ends += 1
+                    if ends == 2:
+                        break
+                elif ends == 1:
+                    self._region_indices.setdefault(name, len(self._regions))
+                    self._regions.append(name)
+        return self._regions
+
+    # resolves a region of an ASSIGNMA card, a name or a number
+    def region_index(self, region):
+        try:
+            return int(float(region)) - 1
+        except ValueError:
+            pass
+        if self.regions is not None and region not in self._region_indices:
+            raise ValueError("unknown region %s" % region)
+        return self._region_indices[region]
+
+    # the material of every region, and the line of the ASSIGNMA card
+    # assigning it, by region name; the last assignment counts
+    @property
+    def assignments(self):
+        if self._assignments is None:
+            self._assignments = collections.OrderedDict()
+            self._assigned = {}
+            for card in self.cards("ASSIGNMA"):
+                lower = card.fields["what2"]
+                upper = card.fields["what3"] or lower
+                step = int(float(card.fields["what4"])) if card.fields["what4"] else 1
+                first, last = self.region_index(lower), self.region_index(upper)
+                self._assigned[card.line] = self.regions[first:last + 1:max(1, step)]
+                for region in self._assigned[card.line]:
+                    self._assignments[region] = (card.fields["what1"], card.line)
+        return self._assignments
+
+    # the regions an ASSIGNMA card assigns a material to, by its line number
+    def assigned(self, line):
+        return self.assignments and self._assigned[line]
+
+    def material(self, region):
+        return self.assignments[region][0]
+
+    def regions_of(self, material):
+        return [region for region, (m, line) in self.assignments.items() if m == material]
+
+    # the first number of primaries and seed, as ut.get_nprimaries and
+    # ut.get_seed read them
+    def nprimaries(self):
+        cards = self.names.get("START", [])
+        return ut.get_nprimaries(self.lines[cards[0]]) if cards else None
+
+    def seed(self):
+        cards = self.names.get("RANDOMIZ", [])
+        return ut.get_seed(self.lines[cards[0]] if cards else "")
+
+def read_card(path):
+    with open(path, "r") as file:
+        return InputCard(file.read())
+
+# sets a field of a card line, keeping its line ending
+def set_field(line, field, value):
+    ending = line[len(line.rstrip("\r\n")):]
+    return ut.set_WHAT(line.rstrip("\r\n"), FIELDS.index(field) + 1, value).rstrip() + ending
+
+def matches(fields, match):
+    for field, value in match.items():
+        if field not in FIELDS:
+            raise ValueError("unknown field %s, expected one of %s" % (field, " ".join(FIELDS)))
+        try:
+            if float(fields[field]) != float(value):
+                return False
+        except ValueError:
+            if fields[field] != str(value).strip():
+                return False
+    return True
+
+# the lines of the card that an overlay replaces, by line number
+def overlay_edits(card, overlay, edits=None):
+    edits = dict(edits or {})
+
+    def edit(i, field, value):
+        edits[i] = set_field(edits.get(i, card.lines[i]), field, value)
+
+    # a card assigning several regions changes only if all of them do
+    materials = overlay.get("materials", {})
+    for region, material in sorted(materials.items()):
+        if region not in card.assignments:
+            raise ValueError("region %s has no ASSIGNMA card" % region)
+        line = card.assignments[region][1]
+        others = [r for r in card.assigned(line) if materials.get(r) != material]
+        if others:
+            raise ValueError("line %i assigns the material of %s to %s as well; give them the same material "
+                             "or swap the material instead" % (line + 1, region, " ".join(others)))
+        edit(line, "what1", material)
+    for old, new in sorted(overlay.get("swap", {}).items()):
+        swapped = [c.line for c in card.cards("ASSIGNMA") if c.fields["what1"] == old]
+        if not swapped:
+            raise ValueError("material %s is not assigned to any region" % old)
+        for line in swapped:
+            edit(line, "what1", new)
+    for change in overlay.get("cards", []):
+        selected = [c for c in card.cards(change["name"]) if matches(c.fields, change.get("match", {}))]
+        if not selected:
+            raise ValueError("no %s card matches %s" % (change["name"], change.get("match", {})))
+        for c in selected:
+            for field, value in sorted(change.get("set", {}).items()):
+                if field not in FIELDS:
+                    raise ValueError("unknown field %s, expected one of %s" % (field, " ".join(FIELDS)))
+                edit(c.line, field, value)
+    for name, key, index in (("START", "start", ut.IWHAT_NPRIMARIES), ("RANDOMIZ", "randomiz", ut.IWHAT_RANDOMSEED)):
+        if key in overlay:
+            for c in card.cards(name):
+                edit(c.line, FIELDS[index - 1], overlay[key])
+    return edits
+
+def render(card, edits):
+    if not edits:
+        return card.text
+    lines = list(card.lines)
+    for i, line in edits.items():
+        lines[i] = line
+    return "".join(lines)
+
+# the variants of a matrix: (name, text) for every combination of overlays,
+# named after the base and the overlays.  names are joined with "-", so that
+# variants are not taken for the jobs of a split.
+def variants(card, base_name, axes):
+    for combination in it.product(*axes):
+        edits = {}
+        for overlay in combination:
+            edits = overlay_edits(card, overlay, edits)
+        names = [overlay["name"] for overlay in combination if overlay.get("name")]
+        yield "-".join([base_name] + names), render(card, edits)
+
+def write_variant(path, text):
+    directory, filename = os.path.split(os.path.abspath(path))
+    temp = os.path.join(directory, ".%s.tmp" % filename)
+    with open(temp, "w") as file:
+        file.write(text)
+    os.rename(temp, path)
+
+def show(card, options):
+    for name in options.cards:
+        for c in card.cards(name):
+            print("%i\t%s" % (c.line + 1, card.lines[c.line].rstrip()))
+    for region in options.regions:
+        material, line = card.assignments[region]
+        print("%s\t%s\t(line %i)" % (region, material, line + 1))
+    for material in options.materials:
+        print("%s\t%s" % (material, " ".join(card.regions_of(material))))
+    if not (options.cards or options.regions or options.materials):
+        print("%i lines, %i cards, %i regions, %i materials assigned" %
+              (len(card.lines), sum(len(lines) for lines in card.names.values()), len(card.regions),
+               len(set(material for material, line in card.assignments.values()))))
+        print("START %s, RANDOMIZ %s" % (card.nprimaries(), card.seed()))
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog show CARD [-c NAME]... [-r REGION]... [-m MATERIAL]...\n"
+                                "       %prog matrix MATRIX.json [-o DIR]",
+                          description="Query FLUKA input cards and generate variants of them",
+                          epilog=("show prints the cards of the given names, the materials of the given "
+                                  "regions and the regions of the given materials.  matrix writes a variant "
+                                  "of the base card for every combination of the overlays in MATRIX.json, "
+                                  "as BASE-NAME1-NAME2....inp."))
+    parser.add_option("-c", "--card", dest="cards", action="append", default=[],
+                      help="show the cards named NAME", metavar="NAME")
+    parser.add_option("-r", "--region", dest="regions", action="append", default=[],
+                      help="show the material of REGION", metavar="REGION")
+    parser.add_option("-m", "--material", dest="materials", action="append", default=[],
+                      help="show the regions of MATERIAL", metavar="MATERIAL")
+    parser.add_option("-o", "--output-directory", dest="directory", default=None,
+                      help="write the variants to DIR (default: that of the base card)", metavar="DIR")
+    (options, args) = parser.parse_args()
+    if len(args) != 2 or args[0] not in ("show", "matrix"):
+        sys.exit(parser.get_usage())
+    return (args[0], args[1], options)
+
+def main():
+    command, path, options = process_arguments()
+    try:
+        if command == "show":
+            show(read_card(path), options)
+            return
+        with open(path, "r") as file:
+            matrix = json.load(file)
+        base = os.path.join(os.path.dirname(path), matrix["base"])
+        start = time.time()
+        card = read_card(base)
+        directory = options.directory or os.path.dirname(os.path.abspath(base))
+        n = 0
+        for name, text in variants(card, ut.extensionless_filename(base), matrix.get("axes", [])):
+            write_variant(os.path.join(directory, name + ".inp"), text)
+            warn(name + ".inp")
+            n += 1
+        warn("%i variants in %.2f s" % (n, time.time() - start))
+    except (ValueError, KeyError, IOError) as e:
+        sys.exit("error: %s" % e)
+
+if __name__ == '__main__':
+    main()
@@ -22,14 +22,19 @@ import subprocess
 import shutil
 import tempfile
 import fnmatch
-from glob import glob
+import zipfile
+import collections
 from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
 import util as ut
+import scoring as sc
 
 VERSION="""
 2.x""".strip()
 ut.require_version_match(VERSION)
 
+DEFAULT_JOBS = 4
+
 # map from scoring designators to combiner executables
 COMBINERS = dict(
     usrtrack='ustsuw',
@@ -58,12 +63,128 @@ def read_scorings(stream):
 # by an empty line and finally the path to the output file.
 def combine(scoring, infiles, outfile, flupro):
     combiner = os.path.join(flupro, 'flutil', COMBINERS[scoring])
-    warn('input files: %s' % infiles)
-    warn('output file: %s' % outfile)
-    warn('combiner: %s' % combiner)
-    pipe = subprocess.Popen(combiner, stdin=subprocess.PIPE)
+    # one message, as several combiners may be running at once
+    warn('input files: %s\noutput file: %s\ncombiner: %s' % (infiles, outfile, combiner))
+    pipe = subprocess.Popen(combiner, stdin=subprocess.PIPE, universal_newlines=True)
     pipe.communicate('%s\n\n%s\n' % ('\n'.join(infiles), outfile))
 
+# lists, for each scoring extension, the zip members to extract as
+# (zip, member, uncompressed size, staged filename).  there will be duplicates
+# in these zips when the execution was done locally (on lxplus we get a brand
+# new working directory for each job); like unzip into a single directory did,
+# the member found in the last zip wins.
+def index_members(zips, scorings):
+    staged = dict((extension, collections.OrderedDict()) for extension in scorings)
+    for zip in zips:
+        archive = zipfile.ZipFile(zip)
+        try:
+            infos = archive.infolist()
+        finally:
+            archive.close()
+        for info in infos:
+            for extension in scorings:
+                if fnmatch.fnmatch(info.filename, '*fort.%s' % extension):
+                    name = os.path.basename(info.filename)
+                    staged[extension].pop(name, None)
+                    staged[extension][name] = (zip, info.filename, info.file_size, name)
+    return dict((extension, list(members.values())) for extension, members in staged.items())
+
+# by default, allow the extracted files to take up half of the free space
+def default_space_budget(directory):
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize // 2
+
+# groups the scoring extensions into batches whose extracted files fit in the
+# space budget, so that each batch is extracted in a single pass over the zips
+# and combined at once.  a scoring that does not fit by itself gets a batch of
+# its own, which amounts to processing one type of file at a time.
+def plan_batches(members, scorings, budget):
+    batches, batch, used = [], [], 0
+    for extension in sorted(scorings, key=lambda extension: int(extension) if extension.isdigit() else extension):
+        size = sum(member[2] for member in members[extension])
+        if batch and used + size > budget:
+            batches.append(batch)
+            batch, used = [], 0
+        batch.append(extension)
+        used += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+# extracts the members of the batch into per-scoring staging directories under
+# tempdir, opening each zip once.  returns the extracted paths per extension.
+def extract_members(members, batch, tempdir, jobs):
+    by_zip = collections.OrderedDict()
+    infiles = {}
+    for extension in batch:
+        staging = os.path.join(tempdir, extension)
+        os.mkdir(staging)
+        infiles[extension] = []
+        for zip, member, size, name in members[extension]:
+            path = os.path.join(staging, name)
+            by_zip.setdefault(zip, []).append((member, path))
+            infiles[extension].append(path)
+
+    def extract(item):
+        zip, targets = item
+        archive = zipfile.ZipFile(zip)
+        try:
+            for member, path in targets:
+                source = archive.open(member)
+                try:
+                    with open(path, 'wb') as target:
+                        shutil.copyfileobj(source, target, 2**20)
+                finally:
+                    source.close()
+        finally:
+            archive.close()
+
+    run_pool(extract, list(by_zip.items()), jobs)
+    return infiles
+
+# applies function to each item using a pool of threads; the combiners run as
+# separate processes, so this runs up to `jobs` of them at once.
+def run_pool(function, items, jobs):
+    pool = ThreadPool(max(1, min(jobs, len(items) or 1)))
+    try:
+        pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+# the state of an incremental combine is kept next to its output
+def partial_filename(outfile):
+    return '.%s.partial.npz' % outfile
+
+# folds the scoring files of zips that were not folded into the saved partial
+# sums yet, and saves the new sums.  the zips are identified by name, size and
+# modification time; if one that was folded in has since changed or vanished,
+# its contribution cannot be taken out again and everything is summed anew.
+def combine_incrementally(members, outfile, jobs):
+    current = {}
+    for zip, member, size, name in members:
+        stat = os.stat(zip)
+        current['%s:%s' % (zip, member)] = [stat.st_size, stat.st_mtime]
+
+    path = partial_filename(outfile)
+    partial, folded = sc.Partial(), {}
+    if os.path.isfile(path):
+        partial, folded = sc.load_partial(path)
+        changed = [key for key in folded if current.get(key) != folded[key]]
+        if changed:
+            warn('%i results changed or vanished since the last combine of %s; summing all results anew' %
+                 (len(changed), outfile))
+            partial, folded = sc.Partial(), {}
+
+    new = [(zip, member) for zip, member, size, name in members if '%s:%s' % (zip, member) not in folded]
+    warn('%s: %i results already folded in, %i new' % (outfile, len(folded), len(new)))
+    if new:
+        partial = partial + sc.merge(new, jobs)
+        for zip, member in new:
+            folded['%s:%s' % (zip, member)] = current['%s:%s' % (zip, member)]
+        sc.save_partial(path, partial, folded)
+    return partial.scoring()
+
 def process_arguments():
     parser = OptionParser(usage="usage: %prog main_input_file.inp scorings_file",
                           version="%prog "+VERSION,
@@ -88,6 +209,21 @@ def process_arguments():
                                   "\n\n"
                                   "Results will be output to files in the current "
                                   "directory."))
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=DEFAULT_JOBS,
+                      help="extract zips and run combiners N at a time", metavar="N")
+    parser.add_option("--space-budget", dest="space_budget", type="int", default=None,
+                      help=("extract at most SIZE megabytes of scoring files at once "
+                            "(default: half of the free space in the current directory)"),
+                      metavar="SIZE")
+    parser.add_option("--native", action="store_true", dest="native",
+                      help=("merge USRBIN results in Python instead of with usbsuw (FLUPRO is "
+                            "not needed); USRBDX, USRTRACK and USRCOLL results still need the "
+                            "flutil combiners"))
+    parser.add_option("--incremental", action="store_true", dest="incremental",
+                      help=("with --native, keep the partial sums between runs and only fold in "
+                            "results that are new since the last run"))
+    parser.add_option("--failed-list", dest="failed_list", default=None,
+                      help="write the failed jobs and the reasons to FILE, one per line", metavar="FILE")
     (options, args) = parser.parse_args()
     
     if len(args) < 2:
@@ -104,15 +240,23 @@ def main():
     directory = os.getcwd()
     flupro = os.getenv('FLUPRO')
 
-    if not flupro:
+    if not flupro and not options.native:
         sys.exit('FLUPRO environment variable not set')
 
     warn('directory: %s' % directory)
     warn('user: %s' % os.getenv('LOGNAME'))
     warn('FLUPRO: %s' % flupro)
 
-    zips = ut.find_job_results(directory, input_base)
+    zips, failed = ut.scan_job_results(directory, input_base)
     warn('zip files to process: %s' % zips)
+    if failed:
+        warn('not processing %i failed jobs:' % len(failed))
+        for job in failed:
+            warn('\t%s\t%s' % job)
+    if options.failed_list:
+        with open(options.failed_list, 'w') as failed_file:
+            for job in failed:
+                failed_file.write('%s\t%s\n' % job)
 
     with open(scorings_filename, 'r') as scorings_file:
         scorings = read_scorings(scorings_file)
@@ -121,19 +265,45 @@ def main():
     if not zips or not scorings:
         sys.exit('nothing to do.')
         
-    # process each type of file one by one to minimize space usage.
-    for extension in scorings:
+    if options.incremental and not options.native:
+        sys.exit('--incremental requires --native')
+
+    if options.native:
+        # usxsuw and ustsuw write the statistical errors in layouts that scoring.py
+        # does not reproduce; rather than results without errors, use flutil
+        unsupported = [scoring for scoring in scorings.values() if scoring not in sc.NATIVE_KINDS]
+        if unsupported:
+            sys.exit('no native combiner for %s, combine without --native'
+                     % ', '.join(sorted(set(unsupported))))
+
+    members = index_members(zips, scorings)
+
+    if options.native:
+        # the scoring files are read straight out of the zips; nothing is extracted.
+        for extension in sorted(scorings):
+            if not members[extension]:
+                continue
+            outfile = '%s_%s_%s' % (input_base, scorings[extension], extension)
+            if options.incremental:
+                merged = combine_incrementally(members[extension], outfile, options.jobs)
+            else:
+                sources = [(zip, member) for zip, member, size, name in members[extension]]
+                merged = sc.merge(sources, options.jobs).scoring()
+            sc.write_scoring(outfile, merged)
+            warn('merged %i files (%i primaries) into %s' % (merged.nbatch, merged.ncase, outfile))
+        return
+
+    budget = options.space_budget * 2**20 if options.space_budget is not None else default_space_budget(directory)
+    for batch in plan_batches(members, scorings, budget):
+        warn('combining %s' % ' '.join('fort.%s' % extension for extension in batch))
         # unzip to temporary directory (in current directory to stay on same device)
         tempdir = os.path.basename(tempfile.mkdtemp(dir=directory))
         try:
-            for zip in zips:
-                # there will be duplicates in these zips when the execution was
-                # done locally; on lxplus we get a brand new working directory
-                # for each job.
-                subprocess.call(('unzip', '-q', zip, '*fort.%s' % extension, '-d', tempdir))
-            infiles = glob(os.path.join(tempdir, '*'))
-            outfile = '%s_%s_%s' % (input_base, scorings[extension], extension)
-            combine(scorings[extension], infiles, outfile, flupro)
+            infiles = extract_members(members, batch, tempdir, options.jobs)
+            tasks = [(scorings[extension], infiles[extension],
+                      '%s_%s_%s' % (input_base, scorings[extension], extension), flupro)
+                     for extension in batch if infiles[extension]]
+            run_pool(lambda task: combine(*task), tasks, options.jobs)
         finally:
             shutil.rmtree(tempdir)
 
@@ -24,13 +24,27 @@ import re
 import os
 import sys
 import time
+import shutil
+import tempfile
+import threading
+import multiprocessing
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 import util as ut
+import manifest as mf
+import card as cd
+import bundle as bd
 
 VERSION="""
 2.x""".strip()
 ut.require_version_match(VERSION)
 
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_RETRIES = 2
+
 #template for .sub files       
 SUBMIT_TEMPLATE_ = Template("""executable \t\t = CONDORcluster${file_name_noextension}/script_${file_name_noextension}.sh
 output \t\t\t = ${file_name_noextension}.$$(ClusterId).$(ProcId).out
@@ -40,10 +54,46 @@ log \t\t\t = ${file_name_noextension}.$$(ClusterId).$(ProcId).log
 universe \t\t = vanilla
 +JobFlavour \t\t = "${job_flavour}"
 initialdir \t\t = ${current_dir}/CONDORcluster${file_name_noextension}
-transfer_input_files \t = ${current_dir}/${file_name}, ${current_dir}/${executable}, ${current_dir}/LBQ-KEK.MAP, ${current_dir}/cmssw501.fieldmap
+transfer_input_files \t = ${current_dir}/${file_name}, ${job_files}
+
+queue""")
+
+#template for a single .sub file submitting many jobs, one per line of the job
+#list; $(job) is the extensionless name of the job's input file
+BULK_SUBMIT_TEMPLATE_ = Template("""executable \t\t = CONDORcluster$$(job)/script_$$(job).sh
+output \t\t\t = $$(job).$$(ClusterId).$$(ProcId).out
+error \t\t\t = $$(job).$$(ClusterId).$$(ProcId).err
+log \t\t\t = $$(job).$$(ClusterId).$$(ProcId).log
+
+universe \t\t = vanilla
++JobFlavour \t\t = "${job_flavour}"
+initialdir \t\t = ${current_dir}/CONDORcluster$$(job)
+transfer_input_files \t = ${current_dir}/$$(job).inp, ${job_files}
+
+queue job from ${job_list}""")
+
+#template for the .sub file of a chained job (see --segments), submitted once
+#per segment by the nodes of a DAG; $(segment) is the segment, and $(ran) adds
+#the random number file of the segment before to the input files
+CHAIN_SUBMIT_TEMPLATE_ = Template("""executable \t\t = CONDORcluster${file_name_noextension}/script_${file_name_noextension}.sh
+arguments \t\t = $$(segment)
+output \t\t\t = ${file_name_noextension}.$$(ClusterId).$(ProcId).out
+error \t\t\t = ${file_name_noextension}.$$(ClusterId).$(ProcId).err
+log \t\t\t = ${file_name_noextension}.$$(ClusterId).$(ProcId).log
+
+universe \t\t = vanilla
++JobFlavour \t\t = "${job_flavour}"
+initialdir \t\t = ${current_dir}/CONDORcluster${file_name_noextension}
+transfer_input_files \t = ${current_dir}/${file_name}, ${job_files}$$(ran)
 
 queue""")
 
+#template for the nodes of the segments of a chained job in the DAG
+DAG_NODE_TEMPLATE_ = Template("""JOB ${node} ${submit_name}${done}
+VARS ${node} segment="${segment}" ran="${ran}"
+RETRY ${node} ${retries}
+""")
+
 #template for .sh file
 EXE_SCRIPT_TEMPLATE_ = Template("""#!/bin/bash
 set -e
@@ -51,7 +101,10 @@ export LX_ORIGIN=${current_dir}
 export LX_INPUT_BASE=${input_base}
 export LX_INPUT="$${LX_INPUT_BASE}.inp"
 export LX_EOS=/afs/cern.ch/project/eos/installation/cms/bin/eos.select
+export LX_STAGE_OUT=/eos/cms/store/user/stepobr/fluka
 export LX_FLOPTS=
+export LX_SEGMENTS=${segments}
+export LX_SEGMENT=$${1:-1}
 source /cvmfs/sft.cern.ch/lcg/contrib/gcc/9.2.0/x86_64-centos7/setup.sh
 
 # copy input file, custom executable (if any) and FLUPRO over to avoid crashes
@@ -62,63 +115,205 @@ then
   export LX_FLOPTS="-e ${executable}"
 fi
 export FLUPRO=/afs/cern.ch/work/s/stepobr/fluka4-0.1
+${bundle}
 
 # begin before hooks
 ${before}
 # end before hooks
 
-$$FLUPRO/bin/rfluka $$LX_FLOPTS -M 1 "$$LX_INPUT" || true
+LX_STATUS=0
+${run_script}
+${telemetry_script}
 
 #zip -r "results_$${LX_INPUT_BASE}.zip" *"$${LX_INPUT_BASE}"* *"$${LX_INPUT_BASE}001_fort"* *"ran$${LX_INPUT_BASE}"* fluka_*/
 
 #mv "results_$${LX_INPUT_BASE}.zip" $$LX_ORIGIN
-rm "$${LX_INPUT_BASE}001.log*"
-rm "$${LX_INPUT_BASE}001.out*"
-rm "$${LX_INPUT_BASE}001.err*"
-rm "$${LX_INPUT_BASE}001_fort*"
-rm "ran$${LX_INPUT_BASE}"*"
-cp "*_KAM" /eos/cms/store/user/stepobr/fluka/
+rm -f "$${LX_INPUT_BASE}$${LX_CYCLE}".log*
+rm -f "$${LX_INPUT_BASE}$${LX_CYCLE}".out*
+rm -f "$${LX_INPUT_BASE}$${LX_CYCLE}".err*
+rm -f "$${LX_INPUT_BASE}$${LX_CYCLE}"_fort*
+# the random number file of a cycle that ended well comes back to the job's
+# directory, for the next segment to resume from
+for f in ran"$${LX_INPUT_BASE}"*
+do
+  if [[ $$LX_STATUS -ne 0 || "$$f" != ran"$${LX_INPUT_BASE}$${LX_CYCLE}" ]]
+  then
+    rm -f "$$f"
+  fi
+done
+${stage_out_script}
 
 # begin after hooks
 ${after}
 # end after hooks
+
+# the job exits with the status of rfluka, so that CONDOR's user log shows a
+# failed run (and monitor.py resubmits it), and a failed segment of a chained
+# job fails its node of the DAG, which retries it while the segments after it
+# wait
+exit $$LX_STATUS
     """)
 
-#template for running locally
+#the part of the job scripts that compresses the dumps and copies them to
+#$LX_STAGE_OUT, each with a sidecar holding the SHA-256 of the compressed file
+#and the number of records, events (runs of lines with the same NCASE) and
+#bytes of the dump (see kam.py).  the copies
+#take their final names only when complete, the sidecar last.  the compressed
+#dumps stay in the job's directory, in place of the dumps.  after a run that
+#ended well, the random number file of its cycle follows them, last: it marks
+#the segment of a chained job done and the next one resumes from it.
+STAGE_OUT_SCRIPT = r"""shopt -s nullglob
+for f in *_KAM
+do
+  gzip -1 -c "$f" > "$f.gz"
+  printf '{"sha256": "%s", "records": %d, "events": %d, "bytes": %d}\n' \
+    "$(sha256sum < "$f.gz" | cut -d ' ' -f 1)" "$(wc -l < "$f")" "$(cut -c 1-7 "$f" | uniq | wc -l)" \
+    "$(stat -c %s "$f")" > "$f.gz.json"
+  for g in "$f.gz" "$f.gz.json"
+  do
+    cp "$g" "$LX_STAGE_OUT/.$g.tmp"
+    mv -f "$LX_STAGE_OUT/.$g.tmp" "$LX_STAGE_OUT/$g"
+  done
+  rm -f "$f"
+done
+for g in ran"${LX_INPUT_BASE}${LX_CYCLE}"
+do
+  if [[ $LX_STATUS -eq 0 ]]
+  then
+    cp "$g" "$LX_STAGE_OUT/.$g.tmp"
+    mv -f "$LX_STAGE_OUT/.$g.tmp" "$LX_STAGE_OUT/$g"
+  fi
+done"""
+
+#the part of the job scripts that runs rfluka, keeping its exit status in
+#LX_STATUS, under /usr/bin/time if there is one, for its CPU time and peak
+#memory.  the job runs FLUKA cycle LX_SEGMENT (the first, unless it is a
+#segment of a chained job), resuming from the random number file of the cycle
+#before.
+RUN_SCRIPT = r"""LX_CYCLE=$(printf %03d "$LX_SEGMENT")
+LX_CYCLES="-M $LX_SEGMENT"
+if [[ $LX_SEGMENT -gt 1 ]]
+then
+  LX_CYCLES="-N $((LX_SEGMENT - 1)) -M $LX_SEGMENT"
+fi
+LX_TIME=()
+if [[ -x /usr/bin/time ]]
+then
+  LX_TIME=(/usr/bin/time -o "${LX_INPUT_BASE}.time" -f "%e %U %S %M")
+fi
+LX_STARTED=$(date +%s.%N)
+"${LX_TIME[@]}" $FLUPRO/bin/rfluka $LX_FLOPTS $LX_CYCLES "$LX_INPUT" || LX_STATUS=$?"""
+
+#the part of the job scripts that sums up the run, before its outputs are
+#removed, in ${LX_INPUT_BASE}.telemetry.json (see telemetry.py): the primaries
+#and CPU time FLUKA reports for its cycles, the records of the dumps, and the
+#wall time, CPU time and peak memory of rfluka.  the record is staged out like
+#the dumps; the values that are not known are null.  the segments of a chained
+#job write ${LX_INPUT_BASE}<cycle>.telemetry.json.
+TELEMETRY_SCRIPT = r"""shopt -s nullglob
+LX_TELEMETRY="${LX_INPUT_BASE}.telemetry.json"
+if [[ $LX_SEGMENTS -gt 1 ]]
+then
+  LX_TELEMETRY="${LX_INPUT_BASE}${LX_CYCLE}.telemetry.json"
+fi
+LX_WALL=$(awk -v s="$LX_STARTED" -v e="$(date +%s.%N)" 'BEGIN { printf "%.3f", e - s }')
+LX_FLUKA=(null null null)
+LX_OUTS=("${LX_INPUT_BASE}"[0-9][0-9][0-9].out)
+if [[ ${#LX_OUTS[@]} -gt 0 ]]
+then
+  LX_FLUKA=($(awk '/Total number of primaries run:/ { sub(/.*run:/, ""); n += $1; found = 1 }
+                   /Total CPU time used to follow all primary particles:/ { sub(/.*particles:/, ""); t += $1 }
+                   END { if (found) printf "%d %.6g %s", n, t, (n > 0 ? sprintf("%.6g", t / n) : "null");
+                         else print "null null null" }' "${LX_OUTS[@]}"))
+fi
+LX_RECORDS=0
+for f in *_KAM
+do
+  LX_RECORDS=$((LX_RECORDS + $(wc -l < "$f")))
+done
+LX_RUSAGE=(null null null)
+if [[ -s "${LX_INPUT_BASE}.time" ]]
+then
+  LX_RUSAGE=($(tail -n 1 "${LX_INPUT_BASE}.time" | awk '{ print $2, $3, $4 }'))
+  rm -f "${LX_INPUT_BASE}.time"
+fi
+printf '{"job": "%s", "segment": %d, "host": "%s", "status": %d, "primaries": %s, "cpu_seconds": %s, "cpu_per_primary": %s, "kam_records": %d, "wall_seconds": %s, "user_seconds": %s, "system_seconds": %s, "max_rss_kb": %s}\n' \
+  "$LX_INPUT_BASE" "$LX_SEGMENT" "$(hostname)" "$LX_STATUS" "${LX_FLUKA[@]}" "$LX_RECORDS" "$LX_WALL" "${LX_RUSAGE[@]}" \
+  > "$LX_TELEMETRY"
+for g in "$LX_TELEMETRY"
+do
+  cp "$g" "$LX_STAGE_OUT/.$g.tmp"
+  mv -f "$LX_STAGE_OUT/.$g.tmp" "$LX_STAGE_OUT/$g"
+done"""
+
+#template for unpacking the campaign bundle (see bundle.py) into the cache of
+#the worker, unless a job unpacked it there before, and linking its files into
+#the job's directory.  LX_BUNDLE_CACHE in the environment overrides the cache.
+#the links are removed when the script exits, so that CONDOR does not transfer
+#the files they point to back with the output of the job.
+BUNDLE_TEMPLATE_ = Template("""
+export LX_BUNDLE=${bundle}
+export LX_BUNDLE_CACHE="$${LX_BUNDLE_CACHE:-${bundle_cache}}"
+mkdir -p "$$LX_BUNDLE_CACHE"
+(
+  flock 9
+  if [[ ! -d "$$LX_BUNDLE_CACHE/${digest}" ]]
+  then
+    echo "${sha256}  $$LX_BUNDLE" | sha256sum -c --status || { echo "$$LX_BUNDLE: checksum mismatch" >&2; exit 1; }
+    LX_UNPACK=$$(mktemp -d "$$LX_BUNDLE_CACHE/.unpack.XXXXXX")
+    tar -xzf "$$LX_BUNDLE" -C "$$LX_UNPACK"
+    mv "$$LX_UNPACK" "$$LX_BUNDLE_CACHE/${digest}"
+  fi
+) 9>>"$$LX_BUNDLE_CACHE/${lock}"
+ln -sf "$$LX_BUNDLE_CACHE/${digest}"/* .
+trap 'find . -maxdepth 1 -type l -lname "$$LX_BUNDLE_CACHE/${digest}/*" -delete' EXIT""")
+
+#the cache of the bundles when running locally.  on the workers, HTCondor
+#points TMPDIR (and, with MOUNT_UNDER_SCRATCH, /tmp) at the scratch directory
+#of each job, so a cache there would not outlive the job; jobs submitted with
+#--bundle need a --bundle-cache that does.
+DEFAULT_BUNDLE_CACHE = "${TMPDIR:-/tmp}/lxbatch_bundles_$(id -u)"
+
+#template for running locally; the script runs in a scratch directory of its
+#own holding (links to) the input file and the files the job needs, and stages
+#its output out to ${stage_out}.  the exit status is that of rfluka.
 BASH_TEMPLATE_ = Template("""
 set -e
+shopt -s nullglob
 export LX_ORIGIN=${current_dir}
 export LX_INPUT_BASE=${input_base}
 export LX_INPUT="$${LX_INPUT_BASE}.inp"
-export LX_EOS=/afs/cern.ch/project/eos/installation/cms/bin/eos.select
+export LX_STAGE_OUT=${stage_out}
 export LX_FLOPTS=
+export LX_SEGMENTS=${segments}
+export LX_SEGMENT=$${1:-1}
 
 if [[ "${executable}" ]]
 then
   export LX_FLOPTS="-e ${executable}"
 fi
-export FLUPRO=/afs/cern.ch/work/s/stepobr/fluka4-0.1
+export FLUPRO=${flupro}
+${bundle}
 
 # begin before hooks
 ${before}
 # end before hooks
 
-$$FLUPRO/bin/rfluka $$LX_FLOPTS -M 1 "$$LX_INPUT" || true
+LX_STATUS=0
+${run_script}
 
-
-#zip -r "results_$${LX_INPUT_BASE}.zip" *"$${LX_INPUT_BASE}"* *fort* "ran$${LX_INPUT_BASE}"* fluka_*/
-#cp "results_$${LX_INPUT_BASE}.zip" "$${LX_ORIGIN}/"
-
-rm *"$${LX_INPUT_BASE}001_fort"*
-rm *"ran$${LX_INPUT_BASE}"*
+${telemetry_script}
+${stage_out_script}
 
 # begin after hooks
 ${after}
 # end after hooks
+
+exit $$LX_STATUS
     """)
 
 def ensure_seeds_unique(path_prefix, inputs):
-    seeds = set(ut.get_seed_from_input(os.path.join(path_prefix, input)) for input in inputs)
+    seeds = set(ut.get_job_seeds(path_prefix, inputs))
     if len(seeds) != len(inputs):
         sys.exit("Duplicate seeds found. Please investigate manually (e.g., grep RANDOMIZ main_input_file_*.inp).")
 
@@ -132,18 +327,55 @@ def process_arguments(path_prefix):
                                   "The jobs, when complete, will write their results into"
                                   " result files named results_main_input_file_<counter>.zip"))
     parser.add_option("-q", "--run-queue", dest="job_flavour", default="tomorrow",
-                      choices="espresso microcentury longlunch workday tomorrow testmatch nextweek".split(),
+                      choices=list(ut.JOB_FLAVOURS),
                       help="submit to run queue QUEUE", metavar="QUEUE")
     parser.add_option("-e", "--executable", dest="executable", default="",
                       help="passed on to rfluka", metavar="FILE")
     parser.add_option("-L", "--run-locally", action="store_true", dest="run_locally",
-                      help="run the job locally (for debugging)")
+                      help="run the jobs locally, in parallel, instead of submitting them")
+    parser.add_option("-w", "--local-workers", dest="local_workers", type="int", default=multiprocessing.cpu_count(),
+                      help="with -L, run N jobs at a time (default: number of cores)", metavar="N")
+    parser.add_option("--scratch", dest="scratch", default=None,
+                      help="with -L, create the jobs' scratch directories in DIR (default: temporary directory)",
+                      metavar="DIR")
+    parser.add_option("-b", "--bulk", action="store_true", dest="bulk",
+                      help="submit all jobs with a single submit file and condor_submit call")
+    parser.add_option("--chunk-size", dest="chunk_size", type="int", default=DEFAULT_CHUNK_SIZE,
+                      help="with --bulk, submit at most N jobs per condor_submit call", metavar="N")
+    parser.add_option("--condor-submit", dest="condor_submit", default="condor_submit",
+                      help="command used to submit jobs (default: condor_submit)", metavar="COMMAND")
     parser.add_option("--unless-finished", action="store_true", dest="unless_finished",
                       help="run only jobs for which there is not a results file present")
+    parser.add_option("--bundle", action="store_true", dest="bundle",
+                      help=("ship the executable, field maps and included files to the jobs in one compressed, "
+                            "checksummed bundle, unpacked once per worker"))
+    parser.add_option("--bundle-cache", dest="bundle_cache", default=None,
+                      help=("with --bundle, unpack the bundle into DIR on the worker, a directory that outlives "
+                            "the jobs, e.g. on a local disk of the pool; required unless running locally "
+                            "(default with -L: %s)" % DEFAULT_BUNDLE_CACHE.replace("%", "%%")), metavar="DIR")
+    parser.add_option("--segments", dest="segments", type="int", default=1,
+                      help=("run each job as a chain of N segments, FLUKA cycles 1 to N of NPRIMARIES each, "
+                            "every one a job of its own resuming from the random number file of the one "
+                            "before; segments that are done are skipped"), metavar="N")
+    parser.add_option("--retries", dest="retries", type="int", default=DEFAULT_RETRIES,
+                      help="with --segments, retry a failed segment up to N times (default: %i)"
+                           % DEFAULT_RETRIES, metavar="N")
+    parser.add_option("--condor-submit-dag", dest="condor_submit_dag", default="condor_submit_dag",
+                      help="with --segments, command used to submit the DAG of the chains (default: condor_submit_dag)",
+                      metavar="COMMAND")
     (options, args) = parser.parse_args()
     
     if len(args) < 1:
         sys.exit(parser.get_usage())
+    if options.segments < 1:
+        sys.exit("--segments has to be at least 1")
+    if options.segments > 1 and options.bulk:
+        sys.exit("the segments of chained jobs are submitted in one DAG; --bulk does not apply")
+    if options.bundle and not options.bundle_cache:
+        if not options.run_locally:
+            sys.exit("--bundle needs --bundle-cache, a directory on the workers that outlives the jobs: "
+                     "HTCondor points TMPDIR at the scratch directory of each job")
+        options.bundle_cache = DEFAULT_BUNDLE_CACHE
 
     input_base = re.sub(r'\.inp$', '', args[0])
 
@@ -154,18 +386,233 @@ def process_arguments(path_prefix):
 
     return (options, inputs)
 
-re_before_after = re.compile(r"^\*[ ]?#lxbatch\s+(?P<time>before|after)\s+(?P<command>.*)$")
-def get_before_after(path_prefix, input):
-    commands = {}
-    with open(os.path.join(path_prefix, input), "r") as infile:
-        for line in infile:
-            match = re_before_after.match(line)
-            if match:
-                commands.setdefault(match.group("time"), []).append(match.group("command"))
-    return commands.get("before", []), commands.get("after", [])
+def get_before_after(card):
+    return card.directives("before"), card.directives("after")
+
+# the files included by a job's input (written once by split.py --shared), by
+# their names in path_prefix.  they are shipped next to the input file, where
+# the include paths, relative to rfluka's run directory, find them.
+def get_includes(card):
+    return [os.path.basename(path) for path in card.includes()]
+
+def job_includes(path_prefix, input):
+    return get_includes(cd.read_card(os.path.join(path_prefix, input)))
+
+RE_CLUSTER = re.compile(r"submitted to cluster (?P<cluster>\d+)")
+
+# records the outcome of submitting (or locally running) a job in the manifest
+def record_submission(manifest, input, submit_name, output=None, returncode=None, proc_id=0):
+    input_base, identifier = ut.parse_job_filename(input)
+    if input_base is None:
+        return
+    if returncode is not None:
+        manifest.set_status(input_base, identifier, mf.STATUS_FINISHED if returncode == 0 else mf.STATUS_FAILED)
+    else:
+        match = RE_CLUSTER.search(output or "")
+        manifest.set_submitted(input_base, identifier, submit_name,
+                               int(match.group("cluster")) if match else None, proc_id if match else None)
+
+# the random number file that segment of a chained job (an extensionless input
+# filename) leaves in the job's directory, and the next segment resumes from
+def ran_filename(job, segment):
+    return os.path.join("CONDORcluster" + job, "ran%s%03i" % (job, segment))
+
+# the number of segments of a chained job that are done: those whose random
+# number files are in the job's directory, up to the first that is not
+def segments_done(path_prefix, job):
+    done = 0
+    while os.path.exists(os.path.join(path_prefix, ran_filename(job, done + 1))):
+        done += 1
+    return done
+
+# submits the chained jobs (extensionless input filenames and the number of
+# segments of each that are done) as one DAG, in which the nodes of the
+# segments of a job run one after the other and those that are done are marked
+# DONE.  a failed segment is retried on its own; submitting again after a
+# failure picks the chains up where they stopped.  returns the cluster ID of
+# DAGMan.
+def submit_chains(path_prefix, chains, options, manifest):
+    input_base, identifier = ut.parse_job_filename(chains[0][0] + ".inp")
+    dag_name = "chains_%s.dag" % (input_base or "jobs")
+    with open(os.path.join(path_prefix, dag_name), "w") as dag:
+        for job, done in chains:
+            nodes = ["%s-%03i" % (job, segment) for segment in range(1, options.segments + 1)]
+            for segment, node in enumerate(nodes, 1):
+                dag.write(DAG_NODE_TEMPLATE_.safe_substitute(
+                    node=node, submit_name="submit_%s.sub" % job, done=" DONE" if segment <= done else "",
+                    segment=segment, retries=options.retries,
+                    ran=", %s" % os.path.join(path_prefix, ran_filename(job, segment - 1)) if segment > 1 else ""))
+            for parent, child in zip(nodes[:-1], nodes[1:]):
+                dag.write("PARENT %s CHILD %s\n" % (parent, child))
+    output = ut.check_output([options.condor_submit_dag, "-force", dag_name], stdin=subprocess.PIPE, cwd=path_prefix)
+    sys.stdout.write(output)
+    match = RE_CLUSTER.search(output)
+    if not match:
+        sys.exit("could not submit %s" % dag_name)
+    for job, done in chains:
+        record_submission(manifest, job + ".inp", dag_name, output)
+    manifest.commit()
+    return int(match.group("cluster"))
+
+# submits the jobs (extensionless input filenames) with one submit file and
+# one condor_submit call per chunk of jobs; the jobs of a chunk get all the
+# files any of them includes.  returns the cluster IDs.
+def submit_bulk(path_prefix, jobs, options, manifest, includes=None, bundle=None):
+    input_base, identifier = ut.parse_job_filename(jobs[0] + ".inp")
+    clusters = []
+    for n, start in enumerate(range(0, len(jobs), max(1, options.chunk_size))):
+        chunk = jobs[start:start + max(1, options.chunk_size)]
+        job_list = "jobs_%s_%i.txt" % (input_base or "bulk", n)
+        submit_name = "submit_%s_%i.sub" % (input_base or "bulk", n)
+        chunk_includes = sorted(set(fn for job in chunk for fn in (includes or {}).get(job, [])))
+        with open(os.path.join(path_prefix, job_list), "w") as joblist:
+            joblist.write("".join("%s\n" % job for job in chunk))
+        with open(os.path.join(path_prefix, submit_name), "w") as insub:
+            insub.write(BULK_SUBMIT_TEMPLATE_.safe_substitute(job_flavour=options.job_flavour,
+                                                              current_dir=path_prefix,
+                                                              executable=options.executable,
+                                                              job_files=transfer_files(path_prefix,
+                                                                                       chunk_includes,
+                                                                                       options.executable,
+                                                                                       bundle),
+                                                              job_list=job_list))
+        output = ut.check_output([options.condor_submit, submit_name], stdin=subprocess.PIPE, cwd=path_prefix)
+        sys.stdout.write(output)
+        match = RE_CLUSTER.search(output)
+        if not match:
+            sys.exit("could not submit %s; %i jobs were submitted before it" % (submit_name, start))
+        clusters.append(int(match.group("cluster")))
+        for proc_id, job in enumerate(chunk):
+            record_submission(manifest, job + ".inp", submit_name, output, proc_id=proc_id)
+        manifest.commit()
+    return clusters
+
+# the field maps every job needs next to its input file, followed by the files
+# its input includes and the executable.  the maps compiled by fieldmap.py are
+# shipped in place of the ASCII ones when present: they are smaller and the
+# user routines load them in one read.
+FIELD_MAPS = ["LBQ-KEK.MAP", "cmssw501.fieldmap"]
+COMPILED_MAP_SUFFIX = ".bin"
+
+def job_files(path_prefix, includes=(), executable=""):
+    return ([fn + COMPILED_MAP_SUFFIX if os.path.exists(os.path.join(path_prefix, fn + COMPILED_MAP_SUFFIX)) else fn
+             for fn in FIELD_MAPS] + list(includes) + ([executable] if executable else []))
+
+# the files shipped with a job besides its input file: the campaign bundle, if
+# there is one, holds all the others
+def transfer_files(path_prefix, includes=(), executable="", bundle=None):
+    files = [bundle] if bundle else job_files(path_prefix, includes, executable)
+    return ", ".join(os.path.join(path_prefix, fn) for fn in files)
+
+# packs the files the jobs need into a campaign bundle in path_prefix (see
+# bundle.py), and returns the part of the job scripts that unpacks it.
+def make_bundle(path_prefix, includes, executable, bundle_cache=DEFAULT_BUNDLE_CACHE):
+    files = [os.path.join(path_prefix, fn) for fn in job_files(path_prefix, includes, executable)]
+    missing = [fn for fn in files if not os.path.isfile(fn)]
+    if missing:
+        sys.exit("cannot bundle files that do not exist: %s" % ", ".join(missing))
+    path, sha = bd.build(files, path_prefix)
+    warn('bundle: %s (%s)' % (os.path.basename(path), ", ".join(os.path.basename(fn) for fn in sorted(files))))
+    return os.path.basename(path), BUNDLE_TEMPLATE_.safe_substitute(bundle=os.path.basename(path),
+                                                                   digest=bd.bundle_digest(path),
+                                                                   sha256=sha,
+                                                                   bundle_cache=bundle_cache,
+                                                                   lock=bd.LOCK)
+
+RE_SCRIPT_BUNDLE = re.compile(r"^export LX_BUNDLE=(?P<bundle>\S+)$", re.M)
+
+# the bundle the job script of a job (an extensionless input filename)
+# unpacks, or None
+def script_bundle(path_prefix, job):
+    path = os.path.join(path_prefix, "CONDORcluster" + job, "script_%s.sh" % job)
+    if not os.path.exists(path):
+        return None
+    with open(path) as script:
+        match = RE_SCRIPT_BUNDLE.search(script.read())
+    return match.group("bundle") if match else None
+
+RE_SCRIPT_SEGMENTS = re.compile(r"^export LX_SEGMENTS=(?P<segments>\d+)$", re.M)
+
+# the number of segments the job script of a job (an extensionless input
+# filename) runs it in: above 1 for a chained job, whose segments DAGMan
+# submits (see submit_chains)
+def script_segments(path_prefix, job):
+    path = os.path.join(path_prefix, "CONDORcluster" + job, "script_%s.sh" % job)
+    if not os.path.exists(path):
+        return 1
+    with open(path) as script:
+        match = RE_SCRIPT_SEGMENTS.search(script.read())
+    return int(match.group("segments")) if match else 1
+
+# runs one job, or one segment of a chained job, in a scratch directory of its
+# own holding links to the given files (and to the random number file of the
+# segment before), logging to its CONDORcluster directory.  returns the exit
+# status of the job script.
+def run_local_job(path_prefix, input, bashscript, files, options, segment=None):
+    job = ut.extensionless_filename(input)
+    stage_out = os.path.join(path_prefix, "CONDORcluster" + job)
+    scratch = tempfile.mkdtemp(prefix="lxbatch_%s_" % job, dir=options.scratch)
+    if segment and segment > 1:
+        files = list(files) + [ran_filename(job, segment - 1)]
+    try:
+        shutil.copy(os.path.join(path_prefix, input), scratch)
+        for fn in files:
+            if os.path.exists(os.path.join(path_prefix, fn)):
+                os.symlink(os.path.join(path_prefix, fn), os.path.join(scratch, os.path.basename(fn)))
+        logname = os.path.join(stage_out, job + ".local" + (".%03i" % segment if segment else ""))
+        with open(logname + ".out", "w") as out:
+            with open(logname + ".err", "w") as err:
+                process = Popen(['bash'] + (['-s', str(segment)] if segment else []), stdin=subprocess.PIPE,
+                                stdout=out, stderr=err, cwd=scratch, universal_newlines=True)
+                process.communicate(bashscript)
+        return process.returncode
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+# runs the jobs (input file, job script, files to link and the segments to run,
+# or [None] for a job that is not chained) on this machine, up to
+# options.local_workers at a time.  jobs are handed to the workers through a
+# bounded queue; the segments of a job run one after the other, up to the first
+# that fails.  returns the (input, exit status) of every job.
+def run_locally(path_prefix, jobs, options):
+    nworkers = max(1, min(options.local_workers, len(jobs)))
+    queue = Queue(maxsize=2 * nworkers)
+    statuses = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            job = queue.get()
+            if job is None:
+                return
+            input, bashscript, files, segments = job
+            try:
+                for segment in segments:
+                    returncode = run_local_job(path_prefix, input, bashscript, files, options, segment)
+                    if returncode != 0:
+                        break
+            except Exception as e:
+                warn("could not run %s: %s" % (input, e))
+                returncode = -1
+            with lock:
+                statuses.append((input, returncode))
+                warn("\t%s finished with exit status %i (%i/%i)" % (input, returncode, len(statuses), len(jobs)))
+
+    warn('running %i jobs locally, %i at a time' % (len(jobs), nworkers))
+    threads = [threading.Thread(target=worker) for i in range(nworkers)]
+    for thread in threads:
+        thread.start()
+    for job in jobs:
+        queue.put(job)
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    return statuses
 
 def main(path_prefix=os.getcwd()):
     options, inputs = process_arguments(path_prefix)
+    manifest = mf.open_manifest(path_prefix)
 
     if not os.getenv('FLUPRO'):
         sys.exit('FLUPRO environment variable not set')
@@ -182,17 +629,37 @@ def main(path_prefix=os.getcwd()):
 
     #Prepare folders for STDOUT, STDERR, log, .sh files
     for input in inputs:
-        foldername = "CONDORcluster"+ut.extensionless_filename(input)
-        commandfolder = ['mkdir',] + [foldername]
-        Popen(commandfolder, stdin=subprocess.PIPE)
+        foldername = os.path.join(path_prefix, "CONDORcluster"+ut.extensionless_filename(input))
+        if not os.path.isdir(foldername):
+            os.mkdir(foldername)
 
+    jobs = []
     for input in inputs:
         if options.unless_finished and ut.have_results_for(path_prefix, input):
             warn("not submitting finished job %s" % input)
             continue
+        if options.segments > 1 and segments_done(path_prefix, ut.extensionless_filename(input)) >= options.segments:
+            warn("all %i segments of %s are done" % (options.segments, input))
+            continue
 
-        before, after = get_before_after(path_prefix, input)
-
+        card = cd.read_card(os.path.join(path_prefix, input))
+        before, after = get_before_after(card)
+        includes = get_includes(card)
+        missing = [fn for fn in includes if not os.path.exists(os.path.join(path_prefix, fn))]
+        if missing:
+            sys.exit("%s includes files that are not in %s: %s" % (input, path_prefix, ", ".join(missing)))
+        jobs.append((input, before, after, includes))
+
+    bundle, bundle_script = None, ""
+    if options.bundle and jobs:
+        bundle, bundle_script = make_bundle(path_prefix, sorted(set(fn for job in jobs for fn in job[3])),
+                                            options.executable, options.bundle_cache)
+
+    bulk_jobs = []
+    bulk_includes = {}
+    local_jobs = []
+    chains = []
+    for input, before, after, includes in jobs:
         extensionless_filename = ut.extensionless_filename(input)
         file_dir = "CONDORcluster" + extensionless_filename
         full_file_dir = os.path.join(path_prefix, file_dir)
@@ -203,22 +670,39 @@ def main(path_prefix=os.getcwd()):
                                                          input_base=extensionless_filename,
                                                          executable=options.executable,
                                                          flupro=os.getenv('FLUPRO'),
+                                                         bundle=bundle_script,
+                                                         segments=options.segments,
+                                                         run_script=RUN_SCRIPT,
+                                                         telemetry_script=TELEMETRY_SCRIPT,
+                                                         stage_out_script=STAGE_OUT_SCRIPT,
                                                          before="\n".join(before),
                                                          after="\n".join(after))
 
-        subscript = SUBMIT_TEMPLATE_.safe_substitute(file_name_noextension=extensionless_filename,
-                                                     job_flavour=options.job_flavour,
-                                                     current_dir=path_prefix,
-                                                     file_name= input,
-                                                     executable=options.executable)
-       
         with open(os.path.join(full_file_dir, script_name), "w+") as inscript:
             inscript.write(exescript)
 
-        with open(os.path.join(path_prefix, submit_name), "w+") as insub:
-            insub.write(subscript)
+        if options.segments > 1:
+            done = segments_done(path_prefix, extensionless_filename)
+            segments = list(range(done + 1, options.segments + 1))
+        else:
+            done, segments = 0, [None]
+
+        if not options.bulk and not options.run_locally:
+            template = CHAIN_SUBMIT_TEMPLATE_ if options.segments > 1 else SUBMIT_TEMPLATE_
+            subscript = template.safe_substitute(file_name_noextension=extensionless_filename,
+                                                 job_flavour=options.job_flavour,
+                                                 current_dir=path_prefix,
+                                                 file_name= input,
+                                                 executable=options.executable,
+                                                 job_files=transfer_files(path_prefix, includes,
+                                                                          options.executable, bundle))
+
+            with open(os.path.join(path_prefix, submit_name), "w+") as insub:
+                insub.write(subscript)
  
         warn('\t%s' % input)
+        if options.segments > 1:
+            warn("  segments %i to %i of %i" % (segments[0], segments[-1], options.segments))
 
         # show the user the commands embedded in the input file, in hopes that
         # they will double-check whether it matches their expectations and does
@@ -233,25 +717,61 @@ def main(path_prefix=os.getcwd()):
             for s in after:
                 warn("    %s" % s)
 
-        command = ['condor_submit',] + [submit_name]
-        
+        command = [options.condor_submit,] + [submit_name]
+
         if options.run_locally:
             bashscript = BASH_TEMPLATE_.safe_substitute(current_dir=path_prefix,
                                                         input_base=extensionless_filename,
                                                         executable=options.executable,
+                                                        flupro=os.getenv('FLUPRO'),
+                                                        stage_out=full_file_dir,
+                                                        bundle=bundle_script,
+                                                        segments=options.segments,
+                                                        run_script=RUN_SCRIPT,
+                                                        telemetry_script=TELEMETRY_SCRIPT,
+                                                        stage_out_script=STAGE_OUT_SCRIPT,
                                                         before="\n".join(before),
                                                         after="\n".join(after))
-            warn('running locally, command would have been: %s' % command)
-            warn('running locally, script would have been:\n%s' % exescript)
-            warn('running locally:')
-            command = ['bash']
-            process = Popen(command, stdin=subprocess.PIPE)
-            process.communicate(bashscript)
-        else:
-            Popen(command, stdin=subprocess.PIPE)
-            
+            files = [bundle] if bundle else job_files(path_prefix, includes, options.executable)
+            local_jobs.append((input, bashscript, files, segments))
+            continue
+
+        # --bulk only changes how the jobs are submitted; with -L they were
+        # queued to run here above
+        if options.bulk:
+            bulk_jobs.append(extensionless_filename)
+            bulk_includes[extensionless_filename] = includes
+            continue
+
+        if options.segments > 1:
+            chains.append((extensionless_filename, done))
+            continue
+
+        output = ut.check_output(command, stdin=subprocess.PIPE)
+        sys.stdout.write(output)
+        record_submission(manifest, input, submit_name, output=output)
+        manifest.commit()
+
         time.sleep(8)
 
+    if local_jobs:
+        statuses = run_locally(path_prefix, local_jobs, options)
+        for input, returncode in statuses:
+            record_submission(manifest, input, None, returncode=returncode)
+        manifest.commit()
+        failed = [input for input, returncode in statuses if returncode != 0]
+        warn('ran %i jobs locally, %i failed%s' % (len(statuses), len(failed),
+                                                   ': %s' % ' '.join(failed) if failed else ''))
+
+    if bulk_jobs:
+        clusters = submit_bulk(path_prefix, bulk_jobs, options, manifest, bulk_includes, bundle)
+        warn('submitted %i jobs to clusters %s' % (len(bulk_jobs), ' '.join(str(c) for c in clusters)))
+
+    if chains:
+        cluster = submit_chains(path_prefix, chains, options, manifest)
+        warn('submitted the chains of %i jobs of %i segments in a DAG, cluster %i'
+             % (len(chains), options.segments, cluster))
+
 if __name__ == '__main__':
     main()
 
@@ -0,0 +1,343 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# converts the boundary-crossing dumps (*_KAM) of the jobs into HepMC2 ASCII
+# (IO_GenEvent) files, like f2hepmc.C: every primary (NCASE) becomes an event
+# and every crossing a particle with a vertex of its own at the crossing
+# point.  the output is written as shards of at most EVENTS events, by a pool
+# of processes, one shard at a time each.
+#
+# the event number is job_index * STRIDE + NCASE, where job_index is the
+# position of the job identifier in the order split.py hands them out and
+# STRIDE the largest number of primaries per job, so that the numbers are
+# unique across the campaign.  the segments of chained jobs count as jobs of
+# their own: job_index is identifier_index * CYCLES + cycle - 1, with CYCLES
+# the number of segments the jobs were submitted in, so that an event keeps its
+# number whichever dumps are converted.  as in f2hepmc.C, positions are converted to mm,
+# the time coordinate is the age of the particle as FLUKA reports it (s) and
+# the weights of the particles are not written (HepMC2 has no place for them;
+# use kam.py where they matter).
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import collections
+from optparse import OptionParser
+from multiprocessing import Pool
+import numpy
+import util as ut
+import manifest as mf
+import execute as ex
+import kam
+
+DEFAULT_PROCESSES = 4
+DEFAULT_EVENTS_PER_SHARD = 100000
+DEFAULT_OUTPUT = "Fluka_ASCII"
+
+# the largest NCASE FORMAT(i7,...) can hold, used as stride when the number of
+# primaries per job is not known
+MAX_NCASE = 9999999
+MAX_EVENT_NUMBER = 2**31 - 1
+
+# FLUKA particle codes (JTRACK) and their PDG codes.  codes without a PDG
+# equivalent (heavy ions, optical photons, RAY, reserved codes) map to 0.
+FLUKA_TO_PDG = {
+    -6: 1000020040, # 4-HELIUM
+    -5: 1000020030, # 3-HELIUM
+    -4: 1000010030, # TRITON
+    -3: 1000010020, # DEUTERON
+     1: 2212,       # PROTON
+     2: -2212,      # APROTON
+     3: 11,         # ELECTRON
+     4: -11,        # POSITRON
+     5: 12,         # NEUTRIE
+     6: -12,        # ANEUTRIE
+     7: 22,         # PHOTON
+     8: 2112,       # NEUTRON
+     9: -2112,      # ANEUTRON
+    10: -13,        # MUON+
+    11: 13,         # MUON-
+    12: 130,        # KAONLONG
+    13: 211,        # PION+
+    14: -211,       # PION-
+    15: 321,        # KAON+
+    16: -321,       # KAON-
+    17: 3122,       # LAMBDA
+    18: -3122,      # ALAMBDA
+    19: 310,        # KAONSHRT
+    20: 3112,       # SIGMA-
+    21: 3222,       # SIGMA+
+    22: 3212,       # SIGMAZER
+    23: 111,        # PIZERO
+    24: 311,        # KAONZERO
+    25: -311,       # AKAONZER
+    27: 14,         # NEUTRIM
+    28: -14,        # ANEUTRIM
+    31: -3222,      # ASIGMA-
+    32: -3212,      # ASIGMAZE
+    33: -3112,      # ASIGMA+
+    34: 3322,       # XSIZERO
+    35: -3322,      # AXSIZERO
+    36: 3312,       # XSI-
+    37: -3312,      # AXSI+
+    38: 3334,       # OMEGA-
+    39: -3334,      # AOMEGA+
+    41: -15,        # TAU+
+    42: 15,         # TAU-
+    43: 16,         # NEUTRIT
+    44: -16,        # ANEUTRIT
+    45: 411,        # D+
+    46: -411,       # D-
+    47: 421,        # D0
+    48: -421,       # D0BAR
+    49: 431,        # DS+
+    50: -431,       # DS-
+    51: 4122,       # LAMBDAC+
+    52: 4232,       # XSIC+
+    53: 4132,       # XSIC0
+    54: 4322,       # XSIPC+
+    55: 4312,       # XSIPC0
+    56: 4332,       # OMEGAC0
+    57: -4122,      # ALAMBDC-
+    58: -4232,      # AXSIC-
+    59: -4132,      # AXSIC0
+    60: -4322,      # AXSIPC-
+    61: -4312,      # AXSIPC0
+    62: -4332,      # AOMEGAC0
+    }
+
+FLUKA_MIN = min(FLUKA_TO_PDG)
+PDG_TABLE = numpy.zeros(max(FLUKA_TO_PDG) - FLUKA_MIN + 1, dtype=numpy.int64)
+for _code, _pdg in FLUKA_TO_PDG.items():
+    PDG_TABLE[_code - FLUKA_MIN] = _pdg
+
+def fluka_to_pdg(jtrack):
+    index = numpy.asarray(jtrack, dtype=numpy.int64) - FLUKA_MIN
+    known = (index >= 0) & (index < len(PDG_TABLE))
+    return numpy.where(known, PDG_TABLE[numpy.where(known, index, 0)], 0)
+
+HEADER = "\nHepMC::Version 2.06.09\nHepMC::IO_GenEvent-START_EVENT_LISTING\n"
+FOOTER = "HepMC::IO_GenEvent-END_EVENT_LISTING\n\n"
+EVENT = "E %i -1 -1.0000000000000000e+00 -1.0000000000000000e+00 -1.0000000000000000e+00 0 0 %i 0 0 0 0\nU GEV MM\n"
+PARTICLE = ("V %i 0 %.16e %.16e %.16e %.16e 0 1 0\n"
+            "P %i %i %.16e %.16e %.16e %.16e %.16e 1 0 0 0 0\n")
+
+# a dump and the index of its job
+Source = collections.namedtuple("Source", "path job_index")
+
+# finds the job index of each dump from its filename.  the cycles of chained
+# jobs (execute.py --segments) count as jobs of their own, ncycles job indices
+# per job, so that their events are numbered apart.  if some dumps are not
+# named after a job, all are numbered by their position instead.
+def make_sources(paths, ncycles=1):
+    identifiers = [kam.parse_dump_filename(path)[1] for path in paths]
+    if all(identifiers):
+        cycles = [kam.parse_dump_cycle(path) for path in paths]
+        if max(cycles) > ncycles:
+            raise ValueError("dumps of cycle %i, but only %i segments per job are numbered; give --cycles %i "
+                             "or more" % (max(cycles), ncycles, max(cycles)))
+        return [Source(path, ut.identifier_index(identifier) * ncycles + cycle - 1)
+                for path, identifier, cycle in zip(paths, identifiers, cycles)]
+    warn("not all dumps are named after jobs; numbering the jobs in the order of the dumps")
+    return [Source(path, i) for i, path in enumerate(paths)]
+
+# the largest number of primaries per job, from the manifest or the job input
+# files, or None if unknown
+def find_stride(path_prefix, paths):
+    jobs = [kam.parse_dump_filename(path) for path in paths]
+    input_bases = set(input_base for input_base, identifier in jobs if input_base)
+    strides = []
+    if os.path.exists(os.path.join(path_prefix, mf.FILENAME)):
+        manifest = mf.open_manifest(path_prefix)
+        for input_base in input_bases:
+            strides.extend(n for (n,) in manifest.query("SELECT max(nprimaries) FROM jobs WHERE input_base = ?",
+                                                        input_base) if n)
+    if not strides:
+        for input_base, identifier in jobs:
+            input = input_base and os.path.join(path_prefix, "%s_%s.inp" % (input_base, identifier))
+            if input and os.path.isfile(input):
+                with open(input, "r") as file:
+                    n = ut.get_nprimaries(file.read())
+                if n:
+                    strides.append(n)
+    return max(strides) if strides else None
+
+# the largest number of segments the jobs of the campaigns of the dumps were
+# submitted in, from the job scripts of all their jobs, or 1 if there are none
+def find_cycles(path_prefix, paths):
+    input_bases = set(kam.parse_dump_filename(path)[0] for path in paths)
+    cycles = [1]
+    for fn in os.listdir(path_prefix):
+        job = fn[len("CONDORcluster"):] if fn.startswith("CONDORcluster") else None
+        if job and ut.parse_job_filename(job + ".inp")[0] in input_bases:
+            cycles.append(ex.script_segments(path_prefix, job))
+    return max(cycles)
+
+# returns, for each chunk of the records of a dump, the index in the dump of
+# the event of each record.  events are runs of records with the same NCASE.
+# the records of the last event of a chunk are held back and go with the next
+# chunk, so that every chunk holds whole events.
+def iterate_events(path):
+    held, count = None, 0
+    for records in kam.iter_kam(path):
+        if not len(records):
+            continue
+        if held is not None:
+            records = numpy.concatenate([held, records])
+        ncase = records["ncase"]
+        others = numpy.flatnonzero(ncase != ncase[-1])
+        split = others[-1] + 1 if len(others) else 0
+        held = records[split:]
+        if split:
+            events = event_indices(ncase[:split], count)
+            count = events[-1] + 1
+            yield records[:split], events
+    if held is not None and len(held):
+        yield held, event_indices(held["ncase"], count)
+
+# the index of the event of each record of a chunk of whole events, counting
+# from first
+def event_indices(ncase, first):
+    starts = numpy.empty(len(ncase), dtype=bool)
+    starts[0] = True
+    starts[1:] = ncase[1:] != ncase[:-1]
+    return first + numpy.cumsum(starts) - 1
+
+# the number of events of a dump, from its sidecar if the job recorded it
+# there, else by reading it
+def count_events(path):
+    sidecar = kam.read_sidecar(path) if path.endswith(kam.COMPRESSED_SUFFIX) else None
+    if sidecar is not None and "events" in sidecar:
+        return int(sidecar["events"])
+    count = 0
+    for records, events in iterate_events(path):
+        count = events[-1] + 1
+    return int(count)
+
+# formats the records of whole events; returns the text and the codes of the
+# particles that have no PDG code
+def format_events(records, events, job_index, stride):
+    pdg = fluka_to_pdg(records["jtrack"])
+    p = records["ptrack"]
+    e = records["etrack"]
+    m2 = e * e - p * p
+    mass = numpy.where(m2 < 0, -numpy.sqrt(numpy.abs(m2)), numpy.sqrt(numpy.abs(m2)))
+    columns = [(records["x"] * 10).tolist(), (records["y"] * 10).tolist(), (records["z"] * 10).tolist(),
+               records["atrack"].tolist(), pdg.tolist(),
+               (p * records["cx"]).tolist(), (p * records["cy"]).tolist(), (p * records["cz"]).tolist(),
+               e.tolist(), mass.tolist()]
+    starts = numpy.flatnonzero(numpy.r_[True, events[1:] != events[:-1]]).tolist() + [len(records)]
+    ncase = records["ncase"]
+    parts = []
+    for start, stop in zip(starts[:-1], starts[1:]):
+        parts.append(EVENT % (job_index * stride + ncase[start], stop - start))
+        for k, (x, y, z, t, code, px, py, pz, energy, m) in enumerate(zip(*[column[start:stop] for column in columns])):
+            parts.append(PARTICLE % (-1 - k, x, y, z, t, 10001 + k, code, px, py, pz, energy, m))
+    return "".join(parts), records["jtrack"][pdg == 0]
+
+# writes one shard: the events [first, last) of each of the given sources.
+# returns the filename, the number of events and the unmapped FLUKA codes
+# with their counts.  runs in the worker processes.
+def write_shard(args):
+    filename, slices, stride = args
+    nevents = 0
+    unmapped = collections.Counter()
+    with open(filename + ".tmp", "w") as file:
+        file.write(HEADER)
+        for source, first, last in slices:
+            for records, events in iterate_events(source.path):
+                if events[0] >= last:
+                    break
+                selected = (events >= first) & (events < last)
+                if not selected.any():
+                    continue
+                ncase = records["ncase"][selected]
+                if ncase.min() < 1 or ncase.max() > stride:
+                    raise ValueError("%s: NCASE outside [1, %i]; use a larger --stride" % (source.path, stride))
+                text, codes = format_events(records[selected], events[selected], source.job_index, stride)
+                file.write(text)
+                unmapped.update(codes.tolist())
+            nevents += last - first
+        file.write(FOOTER)
+    os.rename(filename + ".tmp", filename)
+    return filename, nevents, unmapped
+
+# cuts the events of the sources into shards of at most events_per_shard
+# events; returns for each shard a list of (source, first event, last event)
+def plan_shards(sources, counts, events_per_shard):
+    shards, current, room = [], [], events_per_shard
+    for source, count in zip(sources, counts):
+        first = 0
+        while first < count:
+            n = min(room, count - first)
+            current.append((source, first, first + n))
+            first += n
+            room -= n
+            if room == 0:
+                shards.append(current)
+                current, room = [], events_per_shard
+    if current:
+        shards.append(current)
+    return shards
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options] [file_KAM...]",
+                          description="Convert mgdraw boundary-crossing dumps to HepMC2 ASCII",
+                          epilog=("Converts the given _KAM files, or those matching %s, into "
+                                  "OUTPUT_0000.dat, OUTPUT_0001.dat, ... of at most EVENTS events each.  "
+                                  "Event numbers are job_index * STRIDE + NCASE; STRIDE defaults to the "
+                                  "largest number of primaries per job.  The segments of chained jobs count "
+                                  "as CYCLES jobs each; CYCLES defaults to the number of segments in the "
+                                  "scripts of the jobs." % kam.GLOB))
+    parser.add_option("-o", "--output", dest="output", default=DEFAULT_OUTPUT,
+                      help="prefix of the output files (default: %s)" % DEFAULT_OUTPUT, metavar="OUTPUT")
+    parser.add_option("-n", "--events-per-shard", dest="events_per_shard", type="int",
+                      default=DEFAULT_EVENTS_PER_SHARD,
+                      help="write at most EVENTS events per file (default: %i)" % DEFAULT_EVENTS_PER_SHARD,
+                      metavar="EVENTS")
+    parser.add_option("-j", "--processes", dest="processes", type="int", default=DEFAULT_PROCESSES,
+                      help="convert with N processes (default: %i)" % DEFAULT_PROCESSES, metavar="N")
+    parser.add_option("--stride", dest="stride", type="int", default=None,
+                      help="event numbers of consecutive jobs are STRIDE apart", metavar="STRIDE")
+    parser.add_option("--cycles", dest="cycles", type="int", default=None,
+                      help="number the segments of chained jobs as if each job ran N of them", metavar="N")
+    (options, args) = parser.parse_args()
+    return (options, args or kam.find_kam_files())
+
+def main(path_prefix=os.getcwd()):
+    options, paths = process_arguments()
+    if not paths:
+        sys.exit("nothing to do.")
+    try:
+        sources = make_sources(paths, options.cycles or find_cycles(path_prefix, paths))
+    except ValueError as e:
+        sys.exit(e)
+    stride = options.stride or find_stride(path_prefix, paths)
+    if stride is None:
+        warn("number of primaries per job unknown; event numbers are job_index * %i + NCASE" % (MAX_NCASE + 1))
+        stride = MAX_NCASE + 1
+    if (max(source.job_index for source in sources) + 1) * stride > MAX_EVENT_NUMBER:
+        warn("event numbers exceed the range of HepMC2 event numbers (%i)" % MAX_EVENT_NUMBER)
+
+    pool = Pool(max(1, options.processes))
+    try:
+        counts = pool.map(count_events, [source.path for source in sources])
+        shards = plan_shards(sources, counts, max(1, options.events_per_shard))
+        warn("converting %i events from %i dumps into %i files" % (sum(counts), len(sources), len(shards)))
+        tasks = [("%s_%04i.dat" % (options.output, i), shard, stride) for i, shard in enumerate(shards)]
+        unmapped = collections.Counter()
+        for filename, nevents, codes in pool.imap_unordered(write_shard, tasks):
+            warn("\t%s: %i events" % (filename, nevents))
+            unmapped.update(codes)
+    finally:
+        pool.close()
+        pool.join()
+    if unmapped:
+        warn("particles without a PDG code (written with code 0): %s" %
+             ", ".join("JTRACK %i (%i)" % (code, n) for code, n in sorted(unmapped.items())))
+
+if __name__ == '__main__':
+    main()
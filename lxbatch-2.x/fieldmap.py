@@ -0,0 +1,186 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# compiles the ASCII field maps read by the user routines (the CMS solenoid
+# map cmssw501.fieldmap read by fieldi, and the LHC quadrupole map LBQ-KEK.MAP
+# read by lbqfin) into binary files that the routines load with one read.
+# the ASCII maps are validated on the way: every line must hold the four
+# numbers of the expected grid point, in the order the routines read them,
+# and every value must be finite.  a compiled map is a header followed by the
+# two field components, in float64 and Fortran (column-major) order:
+#
+#     magic "LXFMAP01", version, kind, n1, n2, ncomponents, 0   (int32 each)
+#     spacing1, spacing2, min1, min2, max1, max2, scale          (float64)
+#     checksum1, checksum2                                        (int64)
+#
+# the checksum is a Fletcher checksum of the components, read as 32-bit
+# unsigned words: checksum1 adds up the words modulo 2**32 - 1, and checksum2
+# the successive values of checksum1.  the routines recompute it to verify the
+# map.  scale has already been applied to the components.  all numbers are
+# little endian.
+#
+#     fieldmap.py [-d DIR] [map...]
+#     fieldmap.py --check map.bin...
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import struct
+import collections
+from optparse import OptionParser
+import numpy
+
+MAGIC = b"LXFMAP01"
+VERSION = 1
+HEADER = struct.Struct("<8s6i7dqq")
+MODULUS = 2 ** 32 - 1
+SUFFIX = ".bin"
+
+# a field map: its kind (1 for r-z maps, 2 for x-y maps), the number of grid
+# points along its two axes, the columns of the ASCII file holding the
+# coordinates along each axis, the coordinates of the first grid point and the
+# grid spacing, the extents of the map, the number the field is divided by, and
+# whether the first axis runs fastest in the ASCII file.
+FieldMap = collections.namedtuple("FieldMap", "kind shape columns first spacing extents divisor first_fastest")
+
+MAPS = collections.OrderedDict([
+    # z r br bz, r outer; grid points at the centres of 5 cm cells
+    ("cmssw501.fieldmap", FieldMap(1, (180, 320), (1, 0), (2.5, 2.5), (5.0, 5.0),
+                                   (0.0, 0.0, 900.0, 1600.0), 1.0, False)),
+    # x y bx by, x inner; lbqfin scales the field down by 1.1
+    ("LBQ-KEK.MAP", FieldMap(2, (97, 97), (0, 1), (0.0, 0.0), (0.25, 0.25),
+                             (0.0, 0.0, 24.0, 24.0), 1.1, True)),
+    ])
+
+def compiled_filename(path):
+    return path + SUFFIX
+
+# reads an ASCII map and checks it against its description.  returns its two
+# field components, divided as the routines do, as (n1, n2) arrays.
+def parse_ascii(path, spec):
+    n1, n2 = spec.shape
+    try:
+        data = numpy.loadtxt(path, dtype=numpy.float64, ndmin=2)
+    except ValueError as e:
+        raise ValueError("%s: %s" % (path, e))
+    if data.shape != (n1 * n2, 4):
+        raise ValueError("%s: expected %i lines of 4 numbers, found %i lines of %i" %
+                         ((path, n1 * n2) + data.shape))
+    bad = numpy.flatnonzero(~numpy.isfinite(data).all(axis=1))
+    if len(bad):
+        raise ValueError("%s: line %i: value is not finite" % (path, bad[0] + 1))
+    # the grid coordinates every line should hold
+    lines = numpy.arange(n1 * n2)
+    if spec.first_fastest:
+        index = (lines % n1, lines // n1)
+    else:
+        index = (lines // n2, lines % n2)
+    for axis in (0, 1):
+        expected = spec.first[axis] + index[axis] * spec.spacing[axis]
+        wrong = numpy.flatnonzero(abs(data[:, spec.columns[axis]] - expected) > 1e-6 * spec.spacing[axis])
+        if len(wrong):
+            raise ValueError("%s: line %i: expected a grid point at %g, found %g" %
+                             (path, wrong[0] + 1, expected[wrong[0]], data[wrong[0], spec.columns[axis]]))
+    if spec.first_fastest:
+        data = data.reshape(n2, n1, 4).transpose(1, 0, 2)
+    else:
+        data = data.reshape(n1, n2, 4)
+    return data[:, :, 2] / spec.divisor, data[:, :, 3] / spec.divisor
+
+def payload(components):
+    return numpy.concatenate([c.ravel(order="F") for c in components]).astype("<f8")
+
+# the checksum of the components, as bytes
+def checksum(data):
+    sums = numpy.cumsum(numpy.frombuffer(data, dtype="<u4").astype(numpy.uint64)) % MODULUS
+    return int(sums[-1]) if len(sums) else 0, int(sums.sum() % MODULUS)
+
+# writes the compiled map, atomically
+def write_compiled(path, spec, components):
+    data = payload(components).tobytes()
+    fields = ((MAGIC, VERSION, spec.kind) + tuple(spec.shape) + (len(components), 0) + tuple(spec.spacing) +
+              tuple(spec.extents) + (1.0 / spec.divisor,) + checksum(data))
+    header = HEADER.pack(*fields)
+    directory, filename = os.path.split(os.path.abspath(path))
+    temp = os.path.join(directory, ".%s.tmp" % filename)
+    with open(temp, "wb") as file:
+        file.write(header)
+        file.write(data)
+    os.rename(temp, path)
+
+def compile_map(path, spec, output=None):
+    output = output or compiled_filename(path)
+    write_compiled(output, spec, parse_ascii(path, spec))
+    return output
+
+# reads and verifies a compiled map.  returns the header fields, as a dict, and
+# the field components as (n1, n2) arrays.
+def read_compiled(path):
+    with open(path, "rb") as file:
+        raw = file.read()
+    if len(raw) < HEADER.size:
+        raise ValueError("%s: not a compiled field map" % path)
+    fields = HEADER.unpack(raw[:HEADER.size])
+    if fields[0] != MAGIC:
+        raise ValueError("%s: not a compiled field map" % path)
+    if fields[1] != VERSION:
+        raise ValueError("%s: compiled field map version %i, expected %i" % (path, fields[1], VERSION))
+    header = dict(zip(("kind", "n1", "n2", "ncomponents"), fields[2:6]))
+    header.update(zip(("spacing1", "spacing2", "min1", "min2", "max1", "max2", "scale", "checksum1", "checksum2"),
+                      fields[7:]))
+    n1, n2, ncomponents = header["n1"], header["n2"], header["ncomponents"]
+    data = raw[HEADER.size:]
+    if len(data) != 8 * n1 * n2 * ncomponents:
+        raise ValueError("%s: expected %i bytes of field values, found %i" % (path, 8 * n1 * n2 * ncomponents,
+                                                                            len(data)))
+    if checksum(data) != (header["checksum1"], header["checksum2"]):
+        raise ValueError("%s: checksum mismatch" % path)
+    values = numpy.frombuffer(data, dtype="<f8")
+    components = [values[k * n1 * n2:(k + 1) * n1 * n2].reshape((n1, n2), order="F")
+                  for k in range(ncomponents)]
+    return header, components
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options] [map...]\n"
+                                "       %prog --check map.bin...",
+                          description="Compile the ASCII field maps into binary files for the user routines",
+                          epilog=("Validates the maps (%s) and writes each to MAP%s, which fieldi and lbqfin "
+                                  "load in place of the ASCII map when present.  Without arguments, compiles "
+                                  "the maps found in DIR." % (", ".join(MAPS), SUFFIX)))
+    parser.add_option("-d", "--directory", dest="directory", default=os.getcwd(),
+                      help="look for the maps in DIR (default: the current directory)", metavar="DIR")
+    parser.add_option("--check", action="store_true", dest="check",
+                      help="verify the given compiled maps instead")
+    (options, args) = parser.parse_args()
+    if options.check and not args:
+        sys.exit(parser.get_usage())
+    return (options, args or [os.path.join(options.directory, name) for name in MAPS
+                              if os.path.exists(os.path.join(options.directory, name))])
+
+def main():
+    options, paths = process_arguments()
+    if not paths:
+        sys.exit("nothing to do.")
+    failed = 0
+    for path in paths:
+        try:
+            if options.check:
+                header, components = read_compiled(path)
+                warn("%s: kind %i, %i x %i, checksum ok" % (path, header["kind"], header["n1"], header["n2"]))
+                continue
+            name = os.path.basename(path)
+            if name not in MAPS:
+                raise ValueError("%s: unknown field map, expected one of %s" % (path, ", ".join(MAPS)))
+            output = compile_map(path, MAPS[name])
+            warn("%s -> %s (%i bytes, was %i)" % (path, output, os.path.getsize(output), os.path.getsize(path)))
+        except (ValueError, IOError, OSError) as e:
+            warn(e)
+            failed += 1
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# weighted histograms of the QLumi crossings in the _KAM dumps: the energy
+# spectrum and the time (ATRACK) distribution of every particle type
+# (JTRACK), and the x-y and phi distributions of the crossings near the QLumi
+# planes at z = 1520 cm.  the dumps are streamed chunk by chunk, so memory use
+# does not depend on their size, and every dump yields a Histograms of its
+# own.  histograms hold sums of weights and of squared weights, so they are
+# merged by adding them up; the merged result is the same whether the dumps
+# were filled in one process or in many, as the per-dump histograms are
+# always added in the order of the dumps.
+#
+#     histograms.py [-j N] [--cache DIR] [-o histograms.npz] [file_KAM...]
+#     histograms.py --merge -o total.npz part1.npz part2.npz ...
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import json
+import hashlib
+import collections
+from optparse import OptionParser
+from multiprocessing import Pool
+import numpy
+import util as ut
+import manifest as mf
+import kam
+
+DEFAULT_PROCESSES = 4
+DEFAULT_OUTPUT = "histograms.npz"
+
+# bins of a histogram axis, linear or logarithmic, between low and high.  bin
+# 0 is the underflow and bin nbins + 1 the overflow.
+class Binning(collections.namedtuple("Binning", "name scale low high nbins")):
+    def edges(self):
+        if self.scale == "log":
+            return numpy.logspace(numpy.log10(self.low), numpy.log10(self.high), self.nbins + 1)
+        return numpy.linspace(self.low, self.high, self.nbins + 1)
+
+    def index(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if self.scale == "log":
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                position = (numpy.log10(values) - numpy.log10(self.low)) / (numpy.log10(self.high) - numpy.log10(self.low))
+            position = numpy.where(values > 0, position, -1.0)
+        else:
+            position = (values - self.low) / (self.high - self.low)
+        return numpy.clip(numpy.floor(position * self.nbins), -1, self.nbins).astype(numpy.int64) + 1
+
+ENERGY = Binning("etrack", "log", 1e-14, 1e4, 180)   # GeV, 10 bins per decade
+TIME   = Binning("atrack", "log", 1e-12, 1e0, 120)   # s
+X      = Binning("x",      "lin", -25.0, 25.0, 100)  # cm
+Y      = Binning("y",      "lin", -25.0, 25.0, 100)  # cm
+PHI    = Binning("phi",    "lin", -numpy.pi, numpy.pi, 72)
+
+# the crossings entering the maps: those between the QLumi planes
+Z_LOW, Z_HIGH = 1519.0, 1521.0
+
+# particle types are FLUKA codes; codes outside this range are not histogrammed
+JTRACK_LOW, JTRACK_HIGH = -6, 62
+NCODES = JTRACK_HIGH - JTRACK_LOW + 1
+
+# the histograms: the axes of each, the first one possibly JTRACK
+HISTOGRAMS = collections.OrderedDict([
+    ("energy", ["jtrack", ENERGY]),
+    ("time",   ["jtrack", TIME]),
+    ("phi",    ["jtrack", PHI]),
+    ("xy",     [X, Y]),
+    ])
+
+def histogram_shape(axes):
+    return tuple(NCODES if axis == "jtrack" else axis.nbins + 2 for axis in axes)
+
+# identifies the binning, so that only histograms binned alike are added up
+def binning_key():
+    description = [(name, [axis if axis == "jtrack" else list(axis) for axis in axes])
+                   for name, axes in HISTOGRAMS.items()]
+    description.append((JTRACK_LOW, JTRACK_HIGH, Z_LOW, Z_HIGH))
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+class Histograms(object):
+    def __init__(self):
+        self.sums = collections.OrderedDict((name, numpy.zeros(histogram_shape(axes)))
+                                            for name, axes in HISTOGRAMS.items())
+        self.squares = collections.OrderedDict((name, numpy.zeros(histogram_shape(axes)))
+                                               for name, axes in HISTOGRAMS.items())
+        self.nrecords = 0
+        self.ndumps = 0
+        # primaries of the jobs whose dumps were filled in, if known for all
+        self.nprimaries = 0
+        self.key = binning_key()
+
+    def fill(self, records):
+        self.nrecords += len(records)
+        codes = records["jtrack"].astype(numpy.int64) - JTRACK_LOW
+        known = (codes >= 0) & (codes < NCODES)
+        in_planes = known & (records["z"] >= Z_LOW) & (records["z"] <= Z_HIGH)
+        phi = numpy.arctan2(records["y"], records["x"])
+        values = dict(etrack=records["etrack"], atrack=records["atrack"], x=records["x"], y=records["y"], phi=phi)
+        weights = records["wtrack"]
+        for name, axes in HISTOGRAMS.items():
+            selected = in_planes if name in ("phi", "xy") else known
+            shape = histogram_shape(axes)
+            flat = numpy.zeros(int(selected.sum()), dtype=numpy.int64)
+            for axis, size in zip(axes, shape):
+                index = codes[selected] if axis == "jtrack" else axis.index(values[axis.name][selected])
+                flat = flat * size + index
+            size = int(numpy.prod(shape))
+            w = weights[selected]
+            self.sums[name] += numpy.bincount(flat, weights=w, minlength=size).reshape(shape)
+            self.squares[name] += numpy.bincount(flat, weights=w * w, minlength=size).reshape(shape)
+
+    def __add__(self, other):
+        if self.key != other.key:
+            raise ValueError("cannot add histograms binned differently")
+        result = Histograms()
+        for name in HISTOGRAMS:
+            result.sums[name] = self.sums[name] + other.sums[name]
+            result.squares[name] = self.squares[name] + other.squares[name]
+        result.nrecords = self.nrecords + other.nrecords
+        result.ndumps = self.ndumps + other.ndumps
+        result.nprimaries = (self.nprimaries + other.nprimaries
+                             if self.nprimaries is not None and other.nprimaries is not None else None)
+        return result
+
+    # the histograms per primary and their statistical errors, treating each
+    # crossing as an independent sample
+    def normalized(self, name):
+        n = float(self.nprimaries) if self.nprimaries else 1.0
+        return self.sums[name] / n, numpy.sqrt(self.squares[name]) / n
+
+    # writes the histograms to an .npz file, atomically
+    def save(self, path):
+        arrays = dict(key=numpy.array(self.key), nrecords=numpy.int64(self.nrecords), ndumps=numpy.int64(self.ndumps),
+                      nprimaries=numpy.int64(-1 if self.nprimaries is None else self.nprimaries),
+                      jtrack=numpy.arange(JTRACK_LOW, JTRACK_HIGH + 1))
+        for name, axes in HISTOGRAMS.items():
+            arrays["sum_" + name] = self.sums[name]
+            arrays["sum2_" + name] = self.squares[name]
+            for axis in axes:
+                if axis != "jtrack":
+                    arrays["edges_" + axis.name] = axis.edges()
+        directory, filename = os.path.split(os.path.abspath(path))
+        temp = os.path.join(directory, ".%s.tmp.npz" % filename)
+        with open(temp, "wb") as file:
+            numpy.savez(file, **arrays)
+        os.rename(temp, path)
+
+def load(path):
+    arrays = numpy.load(path)
+    histograms = Histograms()
+    if str(arrays["key"]) != histograms.key:
+        raise ValueError("%s: histograms binned differently" % path)
+    for name in HISTOGRAMS:
+        histograms.sums[name] = arrays["sum_" + name]
+        histograms.squares[name] = arrays["sum2_" + name]
+    histograms.nrecords = int(arrays["nrecords"])
+    histograms.ndumps = int(arrays["ndumps"])
+    histograms.nprimaries = int(arrays["nprimaries"]) if int(arrays["nprimaries"]) >= 0 else None
+    return histograms
+
+# the number of primaries of the job that wrote the dump, from the manifest or
+# the job input file, or None
+def dump_nprimaries(path_prefix, path):
+    input_base, identifier = kam.parse_dump_filename(path)
+    if input_base is None:
+        return None
+    if os.path.exists(os.path.join(path_prefix, mf.FILENAME)):
+        job = mf.open_manifest(path_prefix).job(input_base, identifier)
+        if job is not None and job["nprimaries"]:
+            return job["nprimaries"]
+    input = os.path.join(path_prefix, "%s_%s.inp" % (input_base, identifier))
+    if os.path.isfile(input):
+        with open(input, "r") as file:
+            return ut.get_nprimaries(file.read())
+    return None
+
+# where the histograms of a dump are cached, keyed by the dump's path, size
+# and modification time
+def cache_filename(cache, path):
+    stat = os.stat(path)
+    key = "%s %i %r" % (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    return os.path.join(cache, "%s.npz" % hashlib.sha1(key.encode()).hexdigest())
+
+# fills the histograms of one dump, or loads them from the cache.  runs in the
+# worker processes.
+def fill_dump(args):
+    path, nprimaries, cache = args
+    cached = cache and cache_filename(cache, path)
+    if cached and os.path.exists(cached):
+        try:
+            return load(cached)
+        except (ValueError, IOError, KeyError):
+            pass
+    histograms = Histograms()
+    for records in kam.iter_kam(path):
+        histograms.fill(records)
+    histograms.ndumps = 1
+    histograms.nprimaries = nprimaries
+    if cached:
+        histograms.save(cached)
+    return histograms
+
+# fills the histograms of the dumps, in parallel, and adds them up in the
+# order of the dumps
+def fill(paths, processes=DEFAULT_PROCESSES, cache=None, path_prefix=os.getcwd()):
+    if cache and not os.path.isdir(cache):
+        os.makedirs(cache)
+    tasks = [(path, dump_nprimaries(path_prefix, path), cache) for path in paths]
+    total = Histograms()
+    if processes > 1 and len(tasks) > 1:
+        pool = Pool(min(processes, len(tasks)))
+        try:
+            for histograms in pool.imap(fill_dump, tasks):
+                total = total + histograms
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            total = total + fill_dump(task)
+    return total
+
+# prints the number of crossings and their weight per primary, per particle type
+def summarize(histograms):
+    per_primary, errors = histograms.normalized("energy")
+    print("%i crossings in %i dumps, %s primaries" % (histograms.nrecords, histograms.ndumps,
+                                                     histograms.nprimaries if histograms.nprimaries else "unknown"))
+    print("jtrack\tweight%s\terror" % ("/primary" if histograms.nprimaries else ""))
+    for i, code in enumerate(range(JTRACK_LOW, JTRACK_HIGH + 1)):
+        if histograms.sums["energy"][i].any():
+            print("%i\t%g\t%g" % (code, per_primary[i].sum(), numpy.sqrt((errors[i] ** 2).sum())))
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options] [file_KAM...]\n"
+                                "       %prog --merge [options] histograms.npz...",
+                          description="Histogram the QLumi crossings in mgdraw boundary-crossing dumps",
+                          epilog=("Fills energy spectra and time distributions per particle type, and x-y "
+                                  "and phi maps of the crossings between z = %g and %g cm, from the given "
+                                  "_KAM files or those matching %s, and saves them to OUTPUT.  With "
+                                  "--merge, adds up histograms saved before instead." % (Z_LOW, Z_HIGH, kam.GLOB)))
+    parser.add_option("-o", "--output", dest="output", default=DEFAULT_OUTPUT,
+                      help="save the histograms to OUTPUT (default: %s)" % DEFAULT_OUTPUT, metavar="OUTPUT")
+    parser.add_option("-j", "--processes", dest="processes", type="int", default=DEFAULT_PROCESSES,
+                      help="fill with N processes (default: %i)" % DEFAULT_PROCESSES, metavar="N")
+    parser.add_option("--cache", dest="cache", default=None,
+                      help="keep the histograms of every dump in DIR, and reuse them while the dump is unchanged",
+                      metavar="DIR")
+    parser.add_option("--merge", action="store_true", dest="merge",
+                      help="add up the given histogram files")
+    (options, args) = parser.parse_args()
+    if options.merge and not args:
+        sys.exit(parser.get_usage())
+    return (options, args or kam.find_kam_files())
+
+def main():
+    options, paths = process_arguments()
+    if not paths:
+        sys.exit("nothing to do.")
+    if options.merge:
+        total = Histograms()
+        for path in paths:
+            total = total + load(path)
+    else:
+        total = fill(paths, options.processes, options.cache)
+    total.save(options.output)
+    summarize(total)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,422 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# reading of the boundary-crossing dumps (*_KAM) that mgdraw.f:BXDRAW writes,
+# one line per particle entering a QLumi region, in FORMAT(i7,i5,11e12.4):
+#
+#     ncase jtrack etrack x y z ptrack wtrack atrack cmtrck cx cy cz
+#
+# every line has the same width, so a file is a two-dimensional array of
+# characters.  it is memory-mapped and the fields are decoded from their
+# digits column by column with numpy, without a Python loop over the lines;
+# the few lines that do not have the usual layout (e.g. exponents beyond 99,
+# which Fortran writes without the E) are decoded one by one.
+#
+# the jobs stage their dumps out gzipped (_KAM.gz), each with a sidecar
+# (_KAM.gz.json) holding the SHA-256 of the compressed file and the number of
+# records, events and bytes of the dump.  compressed dumps are decompressed on the fly
+# as they are read, chunk by chunk, and can be checked against their sidecars
+# with --verify.
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import re
+import mmap
+import glob
+import gzip
+import json
+import time
+import hashlib
+from optparse import OptionParser
+import numpy
+
+COLUMNS = "ncase jtrack etrack x y z ptrack wtrack atrack cmtrck cx cy cz".split()
+
+DTYPE = numpy.dtype([("ncase", numpy.int32), ("jtrack", numpy.int32)] +
+                    [(column, numpy.float64) for column in COLUMNS[2:]])
+
+# field widths of FORMAT(i7,i5,11e12.4)
+INTEGER_WIDTHS = [7, 5]
+REAL_WIDTH = 12
+REAL_DIGITS = 4
+NINTEGERS = len(INTEGER_WIDTHS)
+NREALS = len(COLUMNS) - NINTEGERS
+RECORD_WIDTH = sum(INTEGER_WIDTHS) + REAL_WIDTH * NREALS
+
+# records decoded at a time when iterating over a file
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+GLOB = "CONDOR*/*_KAM*"
+COMPRESSED_SUFFIX = ".gz"
+SIDECAR_SUFFIX = ".json"
+RE_KAM_FILE = re.compile(r"_KAM(%s)?$" % re.escape(COMPRESSED_SUFFIX))
+
+# the decimal exponents of reals with a two-digit exponent and an integer
+# mantissa of REAL_DIGITS digits, and the powers of ten to multiply (or, for
+# negative exponents, divide) the mantissa by.  up to 1e22 the powers are
+# exact, so that the product or quotient is rounded once, the same way as
+# parsing the decimal; reals scaled by a larger power would be off by one ulp
+# now and then and are parsed from their text instead.
+EXPONENTS = numpy.arange(-99 - REAL_DIGITS, 100 - REAL_DIGITS)
+POWERS_OF_TEN = numpy.array([10.0 ** abs(k) for k in EXPONENTS])
+EXACT_EXPONENT = 22
+
+# the usual layout of a real, e.g. " -0.1234E+01"
+REAL_LAYOUT = " -0." + "d" * REAL_DIGITS + "E+dd"
+_FIELD = REAL_WIDTH - len(REAL_LAYOUT)
+_SIGN = _FIELD + REAL_LAYOUT.index("-")
+_MANTISSA = _FIELD + REAL_LAYOUT.index("d")
+_EXPONENT_SIGN = _FIELD + REAL_LAYOUT.index("+")
+_EXPONENT = _FIELD + REAL_LAYOUT.rindex("dd")
+# characters that have to be there for a line to have the usual layout
+_FIXED = [(_FIELD + REAL_LAYOUT.index(c), ord(c)) for c in "0.E"]
+
+_SPACE, _MINUS, _PLUS = [ord(c) for c in " -+"]
+
+# the dumps under directory, plain or compressed; of a dump that is there
+# both ways, the compressed one
+def find_kam_files(directory="."):
+    paths = [path for path in glob.glob(os.path.join(directory, GLOB)) if RE_KAM_FILE.search(path)]
+    compressed = set(path for path in paths if path.endswith(COMPRESSED_SUFFIX))
+    return sorted(path for path in paths if path + COMPRESSED_SUFFIX not in compressed)
+
+# dumps are named after the job input file and the FLUKA cycle, e.g.
+# v37214light_aaab001_KAM, or v37214light_aaab001_KAM.gz compressed
+RE_DUMP = re.compile(r"^(?P<input_base>.+)_(?P<identifier>[a-z]{4,})(?P<cycle>\d{3})_\w+?(%s)?$"
+                     % re.escape(COMPRESSED_SUFFIX))
+
+# returns the input base and identifier of the job that wrote the dump, or
+# (None, None)
+def parse_dump_filename(path):
+    match = RE_DUMP.match(os.path.basename(path))
+    if not match:
+        return None, None
+    return match.group("input_base"), match.group("identifier")
+
+# the cycle that wrote the dump (above 1 for the segments of a chained job), or
+# None
+def parse_dump_cycle(path):
+    match = RE_DUMP.match(os.path.basename(path))
+    return int(match.group("cycle")) if match else None
+
+RE_FORTRAN_REAL = re.compile(r"^\s*(?P<mantissa>[-+]?\d*\.\d*)(?:[EeDd]?(?P<exponent>[-+]\d+)|[EeDd](?P<unsigned>\d+))?\s*$")
+
+def parse_fortran_real(text):
+    match = RE_FORTRAN_REAL.match(text)
+    if not match:
+        raise ValueError("not a real: '%s'" % text)
+    exponent = match.group("exponent") or match.group("unsigned") or "0"
+    return float("%se%s" % (match.group("mantissa"), exponent))
+
+# decodes one line the slow way
+def parse_line(line):
+    values = []
+    offset = 0
+    for width in INTEGER_WIDTHS:
+        values.append(int(line[offset:offset + width]))
+        offset += width
+    for i in range(NREALS):
+        values.append(parse_fortran_real(line[offset:offset + REAL_WIDTH]))
+        offset += REAL_WIDTH
+    return tuple(values)
+
+# decodes a (records, line width) array of characters, each row a line.  the
+# reals are viewed as a (records, reals, characters) array and decoded
+# digit by digit for all of them at once; lines that do not have the usual
+# layout are flagged and decoded by parse_line instead.  (elementwise
+# operations on the columns are used throughout, reductions along short axes
+# being slow in numpy.)
+def decode(lines, first=0):
+    n = len(lines)
+    zero = numpy.uint8(ord("0"))
+    records = numpy.empty(n, dtype=DTYPE)
+
+    offset = 0
+    bad = numpy.zeros(n, dtype=bool)
+    for column, width in zip(COLUMNS, INTEGER_WIDTHS):
+        field = lines[:, offset:offset + width]
+        values = numpy.zeros(n, dtype=numpy.int32)
+        negative = numpy.zeros(n, dtype=bool)
+        for k in range(width):
+            characters = field[:, k]
+            digits = characters - zero
+            is_digit = digits <= 9
+            is_minus = characters == _MINUS
+            bad |= ~(is_digit | is_minus | (characters == _SPACE))
+            negative |= is_minus
+            values *= 10
+            values += digits * is_digit
+        bad |= ~is_digit
+        records[column] = numpy.where(negative, -values, values)
+        offset += width
+
+    reals = numpy.ascontiguousarray(lines[:, offset:offset + NREALS * REAL_WIDTH]).reshape(n, NREALS, REAL_WIDTH)
+    signs = reals[:, :, _EXPONENT_SIGN]
+    bad_fields = (signs != _PLUS) & (signs != _MINUS)
+    for position, character in _FIXED:
+        bad_fields |= reals[:, :, position] != character
+    mantissas = numpy.zeros((n, NREALS), dtype=numpy.int16)
+    largest = numpy.zeros((n, NREALS), dtype=numpy.uint8)
+    for k in range(REAL_DIGITS):
+        digits = reals[:, :, _MANTISSA + k] - zero
+        numpy.maximum(largest, digits, out=largest)
+        mantissas *= 10
+        mantissas += digits
+    tens, units = [reals[:, :, _EXPONENT + k] - zero for k in range(2)]
+    numpy.maximum(largest, tens, out=largest)
+    numpy.maximum(largest, units, out=largest)
+    bad_fields |= largest > 9
+    bad |= bad_fields.any(axis=1)
+    # garbage in the flagged fields must not index out of the table
+    exponents = tens.astype(numpy.int16) * 10 + units
+    # index into EXPONENTS; garbage in the flagged fields must not index out of it
+    exponents = numpy.where(signs == _MINUS, -exponents, exponents) - (REAL_DIGITS + EXPONENTS[0])
+    exponents[bad_fields] = -EXPONENTS[0]
+    scales = POWERS_OF_TEN[exponents]
+    mantissas = numpy.where(reals[:, :, _SIGN] == _MINUS, -mantissas, mantissas)
+    values = mantissas * scales
+    numpy.divide(mantissas, scales, out=values, where=exponents < -EXPONENTS[0])
+    inexact = numpy.abs(exponents + EXPONENTS[0]) > EXACT_EXPONENT
+    inexact &= ~bad_fields
+    if inexact.any():
+        values[inexact] = reals[inexact].view("S%i" % REAL_WIDTH).ravel().astype(numpy.float64)
+    for i, column in enumerate(COLUMNS[NINTEGERS:]):
+        records[column] = values[:, i]
+
+    for i in numpy.nonzero(bad)[0]:
+        line = lines[i].tobytes().decode("ascii", "replace")
+        try:
+            records[i] = parse_line(line)
+        except ValueError:
+            raise ValueError("cannot parse record %i: '%s'" % (first + i, line.rstrip()))
+    return records
+
+# returns the width of the lines in data, including the line terminator
+def line_width(data):
+    end = data.find(b"\n")
+    if end < 0:
+        return None
+    return end + 1
+
+# decodes count lines of the given width from data, starting at line start.
+# the lines are decoded DEFAULT_CHUNK_SIZE at a time, which keeps the
+# temporaries in cache.  errors count the records from first (default: start).
+def decode_lines(data, width, start, count, first=None):
+    first = start if first is None else first
+    if width < RECORD_WIDTH + 1:
+        raise ValueError("lines of %i characters are too short for a _KAM record" % width)
+    buffer = numpy.frombuffer(data, dtype=numpy.uint8, count=count * width, offset=start * width)
+    lines = buffer.reshape(count, width)
+    if count and (lines[:, -1] != ord("\n")).any():
+        raise ValueError("lines of different lengths in the data")
+    records = numpy.empty(count, dtype=DTYPE)
+    for i in range(0, count, DEFAULT_CHUNK_SIZE):
+        records[i:i + DEFAULT_CHUNK_SIZE] = decode(lines[i:i + DEFAULT_CHUNK_SIZE, :RECORD_WIDTH], first + i)
+    return records
+
+# decodes a bytes-like object holding whole lines.  a partial last line, as
+# left by a job that is still writing, is ignored.
+def parse(data):
+    width = line_width(data)
+    if width is None:
+        return numpy.empty(0, dtype=DTYPE)
+    return decode_lines(data, width, 0, len(data) // width)
+
+def sidecar_filename(path):
+    return path + SIDECAR_SUFFIX
+
+# the sidecar of a compressed dump, as a dict, or None if it has none
+def read_sidecar(path):
+    try:
+        with open(sidecar_filename(path), "r") as file:
+            return json.load(file)
+    except (IOError, OSError):
+        return None
+
+# a dump, plain and memory-mapped, or compressed and read as a stream: records
+# of a compressed dump are best read in order, as reading backwards starts
+# decompressing from the beginning again.
+class KamFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.compressed = path.endswith(COMPRESSED_SUFFIX)
+        if self.compressed:
+            self.file = gzip.open(path, "rb")
+            self.data = b""
+            self.width = line_width(self.file.read(4096))
+            self.file.rewind()
+            # the position of the stream, in records
+            self.position = 0
+            self._nrecords = None
+            return
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.width = line_width(self.data[:4096])
+        self._nrecords = len(self.data) // self.width if self.width else 0
+
+    # the number of records; of a compressed dump without a sidecar, found by
+    # decompressing it once
+    @property
+    def nrecords(self):
+        if self._nrecords is None:
+            sidecar = read_sidecar(self.path)
+            if sidecar is not None:
+                self._nrecords = sidecar["records"]
+            elif not self.width:
+                self._nrecords = 0
+            else:
+                with gzip.open(self.path, "rb") as file:
+                    size = sum(len(block) for block in iter(lambda: file.read(1 << 22), b""))
+                self._nrecords = size // self.width
+        return self._nrecords
+
+    def close(self):
+        if not isinstance(self.data, bytes):
+            try:
+                self.data.close()
+            except BufferError:
+                # still referenced, e.g. from the traceback of a parse
+                # error; it is unmapped when the references go away
+                pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.nrecords
+
+    # decodes the records in [start, stop)
+    def read(self, start=0, stop=None):
+        if not self.width:
+            return numpy.empty(0, dtype=DTYPE)
+        if self.compressed:
+            return self.read_stream(start, stop)
+        stop = self.nrecords if stop is None else min(stop, self.nrecords)
+        try:
+            return decode_lines(self.data, self.width, start, max(0, stop - start))
+        except ValueError as e:
+            raise ValueError("%s: %s" % (self.path, e))
+
+    def read_stream(self, start, stop):
+        if start < self.position:
+            self.file.rewind()
+            self.position = 0
+        while self.position < start:
+            skipped = len(self.file.read(min(start - self.position, DEFAULT_CHUNK_SIZE) * self.width))
+            if skipped < self.width:
+                return numpy.empty(0, dtype=DTYPE)
+            self.position += skipped // self.width
+        data = self.file.read(-1 if stop is None else max(0, stop - start) * self.width)
+        count = len(data) // self.width
+        self.position += count
+        try:
+            return decode_lines(data, self.width, 0, count, start)
+        except ValueError as e:
+            raise ValueError("%s: %s" % (self.path, e))
+
+    # yields the records chunk_size at a time, so that files larger than
+    # memory can be processed
+    def chunks(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        if self.compressed:
+            start = 0
+            while True:
+                records = self.read(start, start + chunk_size)
+                if not len(records):
+                    return
+                yield records
+                start += len(records)
+        for start in range(0, self.nrecords, chunk_size):
+            yield self.read(start, start + chunk_size)
+
+# checks a compressed dump against its sidecar.  returns the number of
+# records.
+def verify(path):
+    sidecar = read_sidecar(path)
+    if sidecar is None:
+        raise ValueError("%s: no sidecar %s" % (path, sidecar_filename(path)))
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 22), b""):
+            digest.update(block)
+    if digest.hexdigest() != sidecar["sha256"]:
+        raise ValueError("%s: checksum mismatch" % path)
+    size = 0
+    with gzip.open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 22), b""):
+            size += len(block)
+    if size != sidecar["bytes"]:
+        raise ValueError("%s: %i bytes decompressed, expected %i" % (path, size, sidecar["bytes"]))
+    with KamFile(path) as kam:
+        nrecords = size // kam.width if kam.width else 0
+    if nrecords != sidecar["records"]:
+        raise ValueError("%s: %i records, expected %i" % (path, nrecords, sidecar["records"]))
+    return nrecords
+
+def read_kam(path):
+    with KamFile(path) as kam:
+        return kam.read()
+
+# yields the records of the files, chunk_size (or fewer) at a time
+def iter_kam(paths, chunk_size=DEFAULT_CHUNK_SIZE):
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        with KamFile(path) as kam:
+            for chunk in kam.chunks(chunk_size):
+                yield chunk
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options] [file_KAM...]",
+                          description="Summarize mgdraw boundary-crossing dumps",
+                          epilog=("Reads the given _KAM files, or those matching %s, and prints "
+                                  "the number of crossings and their total weight per particle "
+                                  "code." % GLOB))
+    parser.add_option("-c", "--chunk-size", dest="chunk_size", type="int", default=DEFAULT_CHUNK_SIZE,
+                      help="decode N records at a time (default: %i)" % DEFAULT_CHUNK_SIZE, metavar="N")
+    parser.add_option("--verify", action="store_true", dest="verify",
+                      help="check the compressed files against their sidecars instead")
+    (options, args) = parser.parse_args()
+    return (options, args or find_kam_files())
+
+def main():
+    options, paths = process_arguments()
+    if not paths:
+        sys.exit("nothing to do.")
+    if options.verify:
+        failed = 0
+        for path in paths:
+            try:
+                warn("%s: %i records, checksum ok" % (path, verify(path)))
+            except (ValueError, IOError, OSError, KeyError) as e:
+                warn(e)
+                failed += 1
+        if failed:
+            sys.exit(1)
+        return
+    counts, weights = {}, {}
+    start = time.time()
+    for chunk in iter_kam(paths, options.chunk_size):
+        codes, inverse = numpy.unique(chunk["jtrack"], return_inverse=True)
+        for i, (n, w) in enumerate(zip(numpy.bincount(inverse, minlength=len(codes)),
+                                       numpy.bincount(inverse, weights=chunk["wtrack"], minlength=len(codes)))):
+            counts[codes[i]] = counts.get(codes[i], 0) + n
+            weights[codes[i]] = weights.get(codes[i], 0.0) + w
+    nbytes = sum(os.path.getsize(path) for path in paths)
+    elapsed = time.time() - start
+    print("jtrack\tcrossings\tweight")
+    for code in sorted(counts):
+        print("%i\t%i\t%g" % (code, counts[code], weights[code]))
+    warn("read %i files, %.1f MB in %.2f s (%.0f MB/s)" % (len(paths), nbytes / 1e6, elapsed,
+                                                            nbytes / 1e6 / max(elapsed, 1e-9)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# a compact, columnar store of the QLumi crossings in the _KAM dumps.  every
+# ingested dump becomes a segment file of its own, so the output of new jobs
+# is added without touching what is already there; a segment is cut into
+# chunks of records and each column of a chunk is compressed separately, so
+# a query reads only the columns it needs.  the catalog (an SQLite database
+# in the store directory) records where the blocks are and the minimum and
+# maximum of the STATISTICS columns of every chunk, and queries skip the
+# chunks whose ranges cannot match.
+#
+#     kamstore.py ingest STORE [file_KAM...]
+#     kamstore.py query STORE -w "jtrack == 8" -w "etrack > 1e-3" -c x,y,z
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import re
+import zlib
+import sqlite3
+import tempfile
+from optparse import OptionParser
+from multiprocessing import Pool
+import numpy
+import kam
+
+CATALOG = "catalog.sqlite"
+
+DEFAULT_CHUNK_SIZE = 1 << 16
+DEFAULT_PROCESSES = 4
+COMPRESSION_LEVEL = 6
+
+# the columns whose range is recorded for every chunk: particle code, energy,
+# z and weight
+STATISTICS = ["jtrack", "etrack", "z", "wtrack"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    id       INTEGER PRIMARY KEY,
+    source   TEXT UNIQUE NOT NULL,
+    size     INTEGER NOT NULL,
+    mtime    REAL NOT NULL,
+    filename TEXT NOT NULL,
+    nrecords INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    segment  INTEGER NOT NULL,
+    chunk    INTEGER NOT NULL,
+    nrecords INTEGER NOT NULL,
+    %s,
+    PRIMARY KEY (segment, chunk)
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    segment  INTEGER NOT NULL,
+    chunk    INTEGER NOT NULL,
+    name     TEXT NOT NULL,
+    offset   INTEGER NOT NULL,
+    length   INTEGER NOT NULL,
+    PRIMARY KEY (segment, chunk, name)
+);
+""" % ",\n    ".join("min_%s REAL, max_%s REAL" % (column, column) for column in STATISTICS)
+
+# numbers compress much better with the bytes of equal significance next to
+# each other
+def shuffle(values):
+    return numpy.ascontiguousarray(values).view(numpy.uint8).reshape(-1, values.dtype.itemsize).T.tobytes()
+
+def unshuffle(data, dtype, count):
+    return numpy.frombuffer(data, dtype=numpy.uint8).reshape(dtype.itemsize, count).T.copy().view(dtype).ravel()
+
+def encode_block(values):
+    return zlib.compress(shuffle(values), COMPRESSION_LEVEL)
+
+def decode_block(data, dtype, count):
+    return unshuffle(zlib.decompress(data), dtype, count)
+
+# reads a dump and returns its chunks, each a list of (column, block) and the
+# (min, max) of the STATISTICS columns.  runs in the worker processes.
+def encode_dump(args):
+    path, chunk_size = args
+    chunks = []
+    with kam.KamFile(path) as dump:
+        for records in dump.chunks(chunk_size):
+            blocks = [(column, encode_block(records[column])) for column in kam.COLUMNS]
+            ranges = [(float(records[column].min()), float(records[column].max())) for column in STATISTICS]
+            chunks.append((len(records), blocks, ranges))
+    return path, chunks
+
+class Store(object):
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(os.path.join(directory, CATALOG), timeout=60)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def query_catalog(self, sql, *args):
+        return self.connection.execute(sql, args).fetchall()
+
+    def nrecords(self):
+        return self.query_catalog("SELECT coalesce(sum(nrecords), 0) FROM segments")[0][0]
+
+    # whether the dump has been ingested as it is now
+    def has(self, path):
+        stat = os.stat(path)
+        return bool(self.query_catalog("SELECT 1 FROM segments WHERE source = ? AND size = ? AND mtime = ?",
+                                       os.path.abspath(path), stat.st_size, stat.st_mtime))
+
+    # writes the chunks of a dump to a new segment file and records it,
+    # replacing an earlier version of the same dump
+    def add(self, path, chunks):
+        source = os.path.abspath(path)
+        stat = os.stat(path)
+        fd, temp = tempfile.mkstemp(prefix=".segment.", dir=self.directory)
+        locations = []
+        with os.fdopen(fd, "wb") as file:
+            for nrecords, blocks, ranges in chunks:
+                offsets = []
+                for column, block in blocks:
+                    offsets.append((column, file.tell(), len(block)))
+                    file.write(block)
+                locations.append(offsets)
+        old = self.query_catalog("SELECT id, filename FROM segments WHERE source = ?", source)
+        for segment, filename in old:
+            for table in ("segments", "chunks", "blocks"):
+                self.connection.execute("DELETE FROM %s WHERE %s = ?" % (table, "id" if table == "segments" else "segment"),
+                                        (segment,))
+        cursor = self.connection.execute("INSERT INTO segments (source, size, mtime, filename, nrecords) "
+                                         "VALUES (?, ?, ?, '', ?)",
+                                         (source, stat.st_size, stat.st_mtime, sum(chunk[0] for chunk in chunks)))
+        segment = cursor.lastrowid
+        filename = "segment_%08i.col" % segment
+        self.connection.execute("UPDATE segments SET filename = ? WHERE id = ?", (filename, segment))
+        for i, ((nrecords, blocks, ranges), offsets) in enumerate(zip(chunks, locations)):
+            self.connection.execute("INSERT INTO chunks VALUES (?, ?, ?, %s)" % ", ".join("?" * 2 * len(STATISTICS)),
+                                    [segment, i, nrecords] + [value for low_high in ranges for value in low_high])
+            self.connection.executemany("INSERT INTO blocks VALUES (?, ?, ?, ?, ?)",
+                                        [(segment, i, column, offset, length) for column, offset, length in offsets])
+        os.rename(temp, os.path.join(self.directory, filename))
+        self.connection.commit()
+        for segment, filename in old:
+            if filename and os.path.exists(os.path.join(self.directory, filename)):
+                os.remove(os.path.join(self.directory, filename))
+
+    # ingests the dumps that are new or have changed since they were ingested,
+    # reading and compressing them in parallel.  returns the number ingested.
+    def ingest(self, paths, processes=DEFAULT_PROCESSES, chunk_size=DEFAULT_CHUNK_SIZE):
+        paths = [path for path in paths if not self.has(path)]
+        if not paths:
+            return 0
+        pool = Pool(max(1, min(processes, len(paths))))
+        try:
+            for path, chunks in pool.imap_unordered(encode_dump, [(path, chunk_size) for path in paths]):
+                self.add(path, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        return len(paths)
+
+    # returns the (segment, segment file, chunk, number of records) of the
+    # chunks whose ranges may satisfy all the conditions
+    def candidate_chunks(self, conditions):
+        clauses, args = [], []
+        for column, operator, value in conditions:
+            if column in STATISTICS:
+                clause, n = PRUNING[operator]
+                clauses.append(clause.replace("min", "min_" + column).replace("max", "max_" + column))
+                args.extend([value] * n)
+        sql = ("SELECT segments.id, segments.filename, chunks.chunk, chunks.nrecords FROM chunks "
+               "JOIN segments ON segments.id = chunks.segment")
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        return self.query_catalog(sql + " ORDER BY chunks.segment, chunks.chunk", *args)
+
+    # reads the given columns of a chunk from the open segment file
+    def read_chunk(self, file, segment, chunk, nrecords, columns):
+        locations = dict((column, (offset, length)) for column, offset, length in self.query_catalog(
+            "SELECT name, offset, length FROM blocks WHERE segment = ? AND chunk = ?", segment, chunk))
+        values = {}
+        for column in columns:
+            offset, length = locations[column]
+            file.seek(offset)
+            values[column] = decode_block(file.read(length), kam.DTYPE[column], nrecords)
+        return values
+
+    # yields, chunk by chunk, structured arrays of the given columns of the
+    # records satisfying all the conditions, each (column, operator, value).
+    # only the chunks that may match are read, and of those only the columns
+    # in the conditions and the result.
+    def select(self, columns=None, conditions=()):
+        columns = list(columns or kam.COLUMNS)
+        needed = columns + [column for column, operator, value in conditions if column not in columns]
+        dtype = numpy.dtype([(column, kam.DTYPE[column]) for column in columns])
+        files = {}
+        try:
+            for segment, filename, chunk, nrecords in self.candidate_chunks(conditions):
+                if segment not in files:
+                    files[segment] = open(os.path.join(self.directory, filename), "rb")
+                values = self.read_chunk(files[segment], segment, chunk, nrecords, needed)
+                mask = numpy.ones(nrecords, dtype=bool)
+                for column, operator, value in conditions:
+                    mask &= OPERATORS[operator](values[column], value)
+                result = numpy.empty(int(mask.sum()), dtype=dtype)
+                for column in columns:
+                    result[column] = values[column][mask]
+                yield result
+        finally:
+            for file in files.values():
+                file.close()
+
+OPERATORS = {
+    "==": numpy.equal,
+    "!=": numpy.not_equal,
+    "<":  numpy.less,
+    "<=": numpy.less_equal,
+    ">":  numpy.greater,
+    ">=": numpy.greater_equal,
+    }
+
+# SQL conditions on the range [min, max] of a chunk under which some value in
+# it may satisfy "column <operator> value", and the number of times the value
+# occurs in them
+PRUNING = {
+    "==": ("min <= ? AND max >= ?", 2),
+    "!=": ("NOT (min = ? AND max = ?)", 2),
+    "<":  ("min < ?", 1),
+    "<=": ("min <= ?", 1),
+    ">":  ("max > ?", 1),
+    ">=": ("max >= ?", 1),
+    }
+
+RE_CONDITION = re.compile(r"^\s*(?P<column>\w+)\s*(?P<operator>==|!=|<=|>=|<|>)\s*(?P<value>\S+)\s*$")
+
+def parse_condition(text):
+    match = RE_CONDITION.match(text)
+    if not match or match.group("column") not in kam.COLUMNS:
+        raise ValueError("cannot parse condition '%s'; expected e.g. 'etrack > 1e-3' with a column of %s"
+                         % (text, " ".join(kam.COLUMNS)))
+    return (match.group("column"), match.group("operator"), float(match.group("value")))
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog ingest STORE [file_KAM...]\n"
+                                "       %prog query STORE [-w CONDITION]... [-c COLUMNS] [-o FILE.npy]",
+                          description="Store _KAM crossing records in compressed column chunks, and query them",
+                          epilog=("ingest adds the given dumps, or those matching %s, to the store in "
+                                  "directory STORE, skipping those ingested before and unchanged since.  "
+                                  "query selects the records satisfying all conditions (e.g. "
+                                  "'jtrack == 8' -w 'etrack > 1e-3' for neutrons above 1 MeV) and prints "
+                                  "their number, or saves the selected columns to FILE.npy." % kam.GLOB))
+    parser.add_option("-j", "--processes", dest="processes", type="int", default=DEFAULT_PROCESSES,
+                      help="ingest with N processes (default: %i)" % DEFAULT_PROCESSES, metavar="N")
+    parser.add_option("--chunk-size", dest="chunk_size", type="int", default=DEFAULT_CHUNK_SIZE,
+                      help="records per chunk (default: %i)" % DEFAULT_CHUNK_SIZE, metavar="N")
+    parser.add_option("-w", "--where", dest="conditions", action="append", default=[],
+                      help="select records satisfying CONDITION, e.g. 'etrack > 1e-3'", metavar="CONDITION")
+    parser.add_option("-c", "--columns", dest="columns", default=None,
+                      help="comma-separated columns to select (default: all)", metavar="COLUMNS")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="save the selected records to FILE.npy", metavar="FILE.npy")
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2 or args[0] not in ("ingest", "query"):
+        sys.exit(parser.get_usage())
+    try:
+        options.conditions = [parse_condition(condition) for condition in options.conditions]
+    except ValueError as e:
+        sys.exit(str(e))
+    if options.columns:
+        options.columns = options.columns.split(",")
+        unknown = [column for column in options.columns if column not in kam.COLUMNS]
+        if unknown:
+            sys.exit("unknown columns: %s" % " ".join(unknown))
+    return (args[0], args[1], args[2:], options)
+
+def main():
+    command, directory, paths, options = process_arguments()
+    store = Store(directory)
+    if command == "ingest":
+        paths = paths or kam.find_kam_files()
+        n = store.ingest(paths, options.processes, options.chunk_size)
+        warn("ingested %i of %i dumps; %i records in the store" % (n, len(paths), store.nrecords()))
+    else:
+        results = list(store.select(options.columns, options.conditions))
+        dtype = numpy.dtype([(column, kam.DTYPE[column]) for column in options.columns or kam.COLUMNS])
+        records = numpy.concatenate(results) if results else numpy.empty(0, dtype=dtype)
+        if options.output:
+            numpy.save(options.output, records)
+        print(len(records))
+    store.close()
+
+if __name__ == '__main__':
+    main()
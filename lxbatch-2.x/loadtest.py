@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# end-to-end load test of the pipeline, with stubs.py standing in for rfluka
+# and condor_submit.  a synthetic campaign of NJOBS jobs is split (split.py
+# --check, which fails unless every job is byte-identical to the input
+# rewritten as a whole), submitted (execute.py --bulk), run here (execute.py
+# -L, whose job scripts run the stub rfluka and stage the dumps out), checked
+# (kam.py --verify), converted (f2hepmc.py) and costed (telemetry.py).  the
+# stub then ends the user logs of the jobs with the exit status of their runs,
+# and monitor.py follows them, resubmitting the jobs that failed.  every stage
+# runs as a process of its own and is reported with its wall time, its CPU
+# time, peak memory and block I/O (from the rusage os.wait4 returns for it and
+# its children) and the files and bytes it added to the campaign directory, so
+# that the parts of the scripts that do not scale show up before they meet the
+# batch farm.
+#
+#     loadtest.py -n 10000 -w 8 -o report.json
+#
+# the output of each stage goes to loadtest_<stage>.log in the campaign
+# directory; with -d it is kept.
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import json
+import resource
+import glob
+import shutil
+import tempfile
+import subprocess
+import collections
+import multiprocessing
+from timeit import default_timer
+from optparse import OptionParser
+import util as ut
+import manifest as mf
+import execute as ex
+import stubs as sb
+
+VERSION="""
+2.x""".strip()
+ut.require_version_match(VERSION)
+
+DEFAULT_JOBS = 1000
+DEFAULT_NPRIMARIES = 100
+DEFAULT_FAILURE_RATE = 0.01
+DEFAULT_PROCESSES = 4
+
+STAGES = ["split", "submit", "run", "verify", "convert", "telemetry", "logs", "monitor"]
+
+INPUT_BASE = "loadtest"
+SIDECARS = "CONDOR*/*_KAM.gz.json"
+
+LXBATCH = os.path.dirname(os.path.abspath(__file__))
+
+STUB_WRAPPER = """#!/bin/sh
+exec %s %s %s %s "$@"
+"""
+
+def script(name):
+    return [sys.executable, os.path.join(LXBATCH, name)]
+
+def write_wrapper(path, command, options):
+    with open(path, "w") as file:
+        file.write(STUB_WRAPPER % (sys.executable, os.path.join(LXBATCH, "stubs.py"), command, " ".join(options)))
+    os.chmod(path, 0o755)
+
+# the campaign directory: the input card, the field maps the jobs are shipped
+# (linked from the repository, or empty), and FLUPRO/bin/rfluka and
+# condor_submit calling the stubs.  returns the input base.
+def prepare(directory, options):
+    if options.card:
+        input_base = ut.extensionless_filename(options.card)
+        shutil.copy(options.card, os.path.join(directory, input_base + ".inp"))
+    else:
+        input_base = INPUT_BASE
+        with open(os.path.join(directory, input_base + ".inp"), "w") as file:
+            file.write(sb.synthetic_card(options.card_lines))
+    for fn in ex.FIELD_MAPS:
+        source = os.path.join(LXBATCH, os.pardir, fn)
+        if os.path.isfile(source):
+            os.symlink(os.path.abspath(source), os.path.join(directory, fn))
+        else:
+            open(os.path.join(directory, fn), "w").close()
+    os.makedirs(os.path.join(directory, "flupro", "bin"))
+    write_wrapper(os.path.join(directory, "flupro", "bin", "rfluka"), "rfluka",
+                  ["--records-per-primary=%r" % options.records_per_primary,
+                   "--seconds-per-primary=%r" % options.seconds_per_primary,
+                   "--failure-rate=%r" % options.failure_rate])
+    write_wrapper(os.path.join(directory, "condor_submit"), "condor_submit",
+                  ["--state=%s" % os.path.join(directory, sb.DEFAULT_STATE)])
+    os.mkdir(os.path.join(directory, "scratch"))
+    return input_base
+
+def commands(directory, input_base, options):
+    split = script("split.py") + ["--check", input_base + ".inp", str(options.nprimaries), str(options.njobs)]
+    submit = script("execute.py") + ["--bulk", "--condor-submit", "./condor_submit"]
+    run = script("execute.py") + ["-L", "-w", str(options.workers), "--scratch", "scratch"]
+    if options.shared:
+        split.append("--shared")
+    if options.bundle:
+        submit += ["--bundle", "--bundle-cache", os.path.join(directory, "bundles")]
+        run.append("--bundle")
+    return collections.OrderedDict([
+        ("split",   split),
+        ("submit",  submit + [input_base + ".inp"]),
+        ("run",     run + [input_base + ".inp"]),
+        ("verify",  script("kam.py") + ["--verify"]),
+        ("convert", script("f2hepmc.py") + ["-j", str(options.processes)]),
+        ("telemetry", script("telemetry.py") + ["-o", "telemetry.csv"]),
+        ("logs",    script("stubs.py") + ["condor_finish", "--state=%s" % os.path.join(directory, sb.DEFAULT_STATE)]),
+        # monitor.py needs Python 3
+        ("monitor", [sys.executable if sys.version_info[0] >= 3 else "python3", os.path.join(LXBATCH, "monitor.py"),
+                     "--once", "--condor-submit", "./condor_submit", input_base + ".inp"]),
+        ])
+
+# the number of files and bytes under directory, and the most entries in
+# one of its directories
+def snapshot(directory):
+    files, nbytes, largest = 0, 0, 0
+    for root, dirs, fns in os.walk(directory):
+        files += len(fns)
+        largest = max(largest, len(dirs) + len(fns))
+        for fn in fns:
+            nbytes += os.lstat(os.path.join(root, fn)).st_size
+    return files, nbytes, largest
+
+# runs the command of a stage in directory and measures it.  a child starts
+# out with the peak memory of this process, which it was forked from, so the
+# harness keeps clear of numpy to leave the peaks of the stages visible.
+def run_stage(name, command, directory, env):
+    files, nbytes, largest = snapshot(directory)
+    with open(os.devnull) as null:
+        with open(os.path.join(directory, "loadtest_%s.log" % name), "w") as log:
+            start = default_timer()
+            process = subprocess.Popen(command, cwd=directory, env=env, stdin=null, stdout=log,
+                                       stderr=subprocess.STDOUT)
+            pid, status, rusage = os.wait4(process.pid, 0)
+            wall = default_timer() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    after = snapshot(directory)
+    return collections.OrderedDict([
+        ("stage", name),
+        ("status", process.returncode),
+        ("wall", wall),
+        ("user", rusage.ru_utime),
+        ("system", rusage.ru_stime),
+        ("max_rss_mb", rusage.ru_maxrss / 1024.0),
+        ("block_reads", rusage.ru_inblock),
+        ("block_writes", rusage.ru_oublock),
+        ("major_faults", rusage.ru_majflt),
+        ("context_switches", rusage.ru_nvcsw + rusage.ru_nivcsw),
+        ("files", after[0] - files),
+        ("bytes", after[1] - nbytes),
+        ("largest_directory", after[2]),
+        ])
+
+# what came out of the campaign: jobs by status, staged dumps and their
+# records, HepMC files and the jobs monitor.py resubmitted, each with a submit
+# file of its own
+def outcome(directory, input_base):
+    manifest = mf.open_manifest(directory)
+    statuses = dict(manifest.query("SELECT status, count(*) FROM jobs WHERE input_base = ? GROUP BY status",
+                                   input_base))
+    mf.close_manifest(directory)
+    sidecars = glob.glob(os.path.join(directory, SIDECARS))
+    records = 0
+    for path in sidecars:
+        with open(path) as file:
+            records += json.load(file)["records"]
+    return collections.OrderedDict([("jobs", statuses), ("dumps", len(sidecars)), ("records", records),
+                                    ("hepmc_files", len(glob.glob(os.path.join(directory, "Fluka_ASCII_*.dat")))),
+                                    ("resubmitted", len(glob.glob(os.path.join(directory, "submit_%s_[a-z]*.sub"
+                                                                                % input_base))))])
+
+def report(stages, njobs):
+    lines = ["%-9s %6s %9s %9s %9s %9s %10s %10s %9s %10s %10s" %
+             ("stage", "status", "wall s", "user s", "system s", "peak MB", "blk reads", "blk writes",
+              "files", "MB", "ms/job")]
+    for stage in stages:
+        lines.append("%-9s %6i %9.2f %9.2f %9.2f %9.1f %10i %10i %9i %10.1f %10.2f" %
+                     (stage["stage"], stage["status"], stage["wall"], stage["user"], stage["system"],
+                      stage["max_rss_mb"], stage["block_reads"], stage["block_writes"], stage["files"],
+                      stage["bytes"] / 1e6, 1e3 * stage["wall"] / max(1, njobs)))
+    return lines
+
+def write_report(path, results):
+    temp = "%s.tmp" % path
+    with open(temp, "w") as file:
+        json.dump(results, file, indent=2)
+        file.write("\n")
+    os.rename(temp, path)
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options]",
+                          version="%prog "+VERSION,
+                          description="Load-test the lxbatch pipeline with stand-ins for rfluka and condor_submit",
+                          epilog=("Splits a synthetic campaign (or --card) into NJOBS jobs, submits them to a "
+                                  "stub condor_submit, runs them here with a stub rfluka, verifies the staged "
+                                  "dumps and converts them to HepMC, reporting the wall time, CPU time, peak "
+                                  "memory, block I/O and files written of each stage.  Stages: %s."
+                                  % ", ".join(STAGES)))
+    parser.add_option("-n", "--jobs", dest="njobs", type="int", default=DEFAULT_JOBS,
+                      help="split the campaign into N jobs (default: %i)" % DEFAULT_JOBS, metavar="N")
+    parser.add_option("-p", "--primaries", dest="nprimaries", type="int", default=DEFAULT_NPRIMARIES,
+                      help="simulate N primaries per job (default: %i)" % DEFAULT_NPRIMARIES, metavar="N")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=multiprocessing.cpu_count(),
+                      help="run N jobs at a time (default: number of cores)", metavar="N")
+    parser.add_option("-j", "--processes", dest="processes", type="int", default=DEFAULT_PROCESSES,
+                      help="convert with N processes (default: %i)" % DEFAULT_PROCESSES, metavar="N")
+    parser.add_option("--records-per-primary", dest="records_per_primary", type="float",
+                      default=sb.DEFAULT_RECORDS_PER_PRIMARY,
+                      help="dump R crossings per primary on average (default: %g)" % sb.DEFAULT_RECORDS_PER_PRIMARY,
+                      metavar="R")
+    parser.add_option("--seconds-per-primary", dest="seconds_per_primary", type="float",
+                      default=sb.DEFAULT_SECONDS_PER_PRIMARY,
+                      help="let the runs take S seconds per primary (default: %g)" % sb.DEFAULT_SECONDS_PER_PRIMARY,
+                      metavar="S")
+    parser.add_option("--failure-rate", dest="failure_rate", type="float", default=DEFAULT_FAILURE_RATE,
+                      help="fail this fraction of the runs (default: %g)" % DEFAULT_FAILURE_RATE, metavar="FRACTION")
+    parser.add_option("--card", dest="card", default=None,
+                      help="split FILE instead of a synthetic card", metavar="FILE")
+    parser.add_option("--card-lines", dest="card_lines", type="int", default=sb.CARD_LINES,
+                      help="make the synthetic card N lines long (default: %i)" % sb.CARD_LINES, metavar="N")
+    parser.add_option("-s", "--shared", action="store_true", dest="shared",
+                      help="split with --shared")
+    parser.add_option("--bundle", action="store_true", dest="bundle",
+                      help="submit and run with --bundle")
+    parser.add_option("--until", dest="until", default=STAGES[-1], choices=STAGES,
+                      help="stop after STAGE (default: %s)" % STAGES[-1], metavar="STAGE")
+    parser.add_option("-d", "--directory", dest="directory", default=None,
+                      help="run the campaign in DIR, which must not exist, and keep it "
+                           "(default: a temporary directory, removed afterwards)", metavar="DIR")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="write the report to FILE as JSON", metavar="FILE")
+    (options, args) = parser.parse_args()
+
+    if args or options.njobs < 1:
+        sys.exit(parser.get_usage())
+    if options.directory and os.path.exists(options.directory):
+        sys.exit("%s exists already" % options.directory)
+    return options
+
+def main():
+    options = process_arguments()
+    if options.directory:
+        os.makedirs(options.directory)
+    directory = os.path.abspath(options.directory or tempfile.mkdtemp(prefix="lxbatch_loadtest_"))
+    env = dict(os.environ, FLUPRO=os.path.join(directory, "flupro"))
+
+    stages = []
+    try:
+        input_base = prepare(directory, options)
+        warn("load test of %i jobs of %i primaries in %s" % (options.njobs, options.nprimaries, directory))
+        for name, command in commands(directory, input_base, options).items():
+            stage = run_stage(name, command, directory, env)
+            stages.append(stage)
+            warn("%-9s %8.2f s, peak %.1f MB, %i files" % (name, stage["wall"], stage["max_rss_mb"], stage["files"]))
+            if stage["status"] != 0:
+                warn("%s failed with exit status %i; see loadtest_%s.log" % (name, stage["status"], name))
+                break
+            if name == options.until:
+                break
+        results = collections.OrderedDict([("version", VERSION), ("jobs", options.njobs),
+                                           ("harness_max_rss_mb",
+                                            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0),
+                                           ("primaries", options.nprimaries), ("workers", options.workers),
+                                           ("records_per_primary", options.records_per_primary),
+                                           ("failure_rate", options.failure_rate),
+                                           ("shared", bool(options.shared)), ("bundle", bool(options.bundle)),
+                                           ("stages", stages), ("outcome", outcome(directory, input_base))])
+    finally:
+        if not options.directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print("\n".join(report(stages, options.njobs)))
+    print(json.dumps(results["outcome"]))
+    if options.output:
+        write_report(options.output, results)
+    if any(stage["status"] != 0 for stage in stages):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# the magnetic field FLUKA sees, evaluated with numpy for many points at once.
+# magfld follows routines/magfld.f: the CMS solenoid from the r-z map for
+# |z| <= 2280 cm, the low-beta quadrupole from the x-y map of lbqfld.f beyond
+# that, within 18 cm of the beam, and no field elsewhere.  like the routines,
+# it returns the direction cosines of the field, normalised by mhcosn, and its
+# magnitude in Tesla, or -1e-10 and (0, 0, 1) where there is no field.
+#
+# the routines take the field of the map cell a point falls into, i.e. of its
+# grid point with the lower coordinates.  with method="bilinear", the field
+# components are instead interpolated linearly between the four grid points
+# around the point, as litwod.f does: zero outside the grid, including below
+# its first grid point.
+#
+#     magfield.py [-d DIR] [-m bilinear] [--mlattc N] [-o field.npy] points
+#     magfield.py [-d DIR] --compare [--sample N] [points]
+#     magfield.py [-d DIR] --check-fortran [--routines DIR] [points]
+#
+# --check-fortran builds routines/magchk.f with magfld.f, lbqfld.f, fieldi.f
+# and the routines they call, using stand-ins for the FLUKA include files, and
+# checks that the field of the cells is bit-identical to theirs at the given
+# points, or at random points of the maps and at their cell edges and region
+# boundaries.  litwod is checked on the 31 x 31 corner of the quadrupole map,
+# the size its arrays are declared with.
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+import collections
+from optparse import OptionParser
+import numpy
+import fieldmap as fm
+
+METHODS = ["nearest", "bilinear"]
+
+# the quadrupole field applies beyond Q1_Z and within sqrt(Q1_R2) of the beam
+Q1_Z = 2280.0
+Q1_R2 = 324.0
+
+# the smallest field; weaker fields count as no field
+B_MIN = 1e-10
+
+# a field map: its two components, the coordinates of their grid points along
+# both axes, its spacing and extents (min1, min2, max1, max2)
+Grid = collections.namedtuple("Grid", "first second axes spacing extents")
+
+SOLENOID = "cmssw501.fieldmap"
+QUADRUPOLE = "LBQ-KEK.MAP"
+
+# the routines built for --check-fortran, the driver first, and stand-ins for
+# the FLUKA include files they need
+FORTRAN_SOURCES = ["magchk.f", "magfld.f", "lbqfld.f", "fieldi.f", "lbqfin.f", "rdfmap.f", "mhcos.f", "litwod.f"]
+FORTRAN_INCLUDES = {
+    "dblprc.inc": "      IMPLICIT DOUBLE PRECISION (A-H,O-Z)\n",
+    "dimpar.inc": "*     not needed by the routines checked\n",
+    "iounit.inc": "*     not needed by the routines checked\n",
+    "ltclcm.inc": "      COMMON / LTCLCM / MLATTC\n",
+    }
+DEFAULT_FORTRAN_COMPILER = "gfortran"
+DEFAULT_FORTRAN_FLAGS = "-O2 -fno-automatic"
+# the size of the arrays of litwod.f
+LITWOD_SIZE = 31
+
+# reads a map, compiled by fieldmap.py if it is, else from the ASCII file
+def load_grid(directory, name):
+    spec = fm.MAPS[name]
+    path = os.path.join(directory, name)
+    if os.path.exists(fm.compiled_filename(path)):
+        header, (first, second) = fm.read_compiled(fm.compiled_filename(path))
+        spacing = (header["spacing1"], header["spacing2"])
+        extents = (header["min1"], header["min2"], header["max1"], header["max2"])
+    else:
+        first, second = fm.parse_ascii(path, spec)
+        spacing, extents = spec.spacing, spec.extents
+    axes = [spec.first[k] + numpy.arange(spec.shape[k]) * spacing[k] for k in (0, 1)]
+    return Grid(first, second, axes, spacing, extents)
+
+class FieldMaps(object):
+    def __init__(self, directory="."):
+        self.solenoid = load_grid(directory, SOLENOID)
+        self.quadrupole = load_grid(directory, QUADRUPOLE)
+        # btot of fieldi.f
+        self.total = numpy.sqrt(self.solenoid.first ** 2 + self.solenoid.second ** 2)
+
+# litwod.f for many points: the linear interpolation of f, given on the grid
+# x, y, at (xx, yy), or 0 outside the grid
+def litwod(xx, yy, x, y, f):
+    ix = numpy.maximum(numpy.searchsorted(x, xx, side="left") - 1, 0)
+    iy = numpy.maximum(numpy.searchsorted(y, yy, side="left") - 1, 0)
+    inside = (xx >= x[0]) & (yy >= y[0]) & (xx <= x[-1]) & (yy <= y[-1])
+    ix, iy = numpy.where(inside, ix, 0), numpy.where(inside, iy, 0)
+    f1 = f[ix, iy] + (xx - x[ix]) * (f[ix + 1, iy] - f[ix, iy]) / (x[ix + 1] - x[ix])
+    f2 = f[ix, iy + 1] + (xx - x[ix]) * (f[ix + 1, iy + 1] - f[ix, iy + 1]) / (x[ix + 1] - x[ix])
+    return numpy.where(inside, f1 + (yy - y[iy]) * (f2 - f1) / (y[iy + 1] - y[iy]), 0.0)
+
+# the map cells (u, v) falls in, and whether it is on the map
+def cell(grid, u, v):
+    iu = ((u - grid.extents[0]) / grid.spacing[0]).astype(numpy.int64)
+    iv = ((v - grid.extents[1]) / grid.spacing[1]).astype(numpy.int64)
+    n1, n2 = grid.first.shape
+    inside = (iu >= 0) & (iu < n1) & (iv >= 0) & (iv < n2)
+    return numpy.where(inside, iu, 0), numpy.where(inside, iv, 0), inside
+
+# the field components of a map at (u, v): those of the cell (u, v) falls in,
+# or interpolated.  also returns which points are on the map.
+def lookup(grid, u, v, method):
+    if method == "bilinear":
+        return (litwod(u, v, grid.axes[0], grid.axes[1], grid.first),
+                litwod(u, v, grid.axes[0], grid.axes[1], grid.second),
+                numpy.ones(u.shape, dtype=bool))
+    iu, iv, inside = cell(grid, u, v)
+    return grid.first[iu, iv], grid.second[iu, iv], inside
+
+# mhcosn.f for many points.  the cosines are nan where the field is zero; as
+# in the routines, they are overwritten afterwards.
+def mhcosn(tx, ty, tz):
+    with numpy.errstate(invalid="ignore"):
+        t2 = tx * tx + ty * ty
+        txt = numpy.sqrt(1.0 - ty ** 2)
+        tzt = numpy.sqrt(1.0 - t2)
+        rx = numpy.where(t2 > 1.0, numpy.where(tx < 0.0, -txt, txt), tx)
+        ry = ty
+        rz = numpy.where(t2 > 1.0, 0.0, numpy.where(tz < 0.0, -tzt, tzt))
+        for clipped, cx, cy in ((ty > 1.0, 0.0, 1.0), (ty < -1.0, 0.0, -1.0),
+                                (tx > 1.0, 1.0, 0.0), (tx < -1.0, -1.0, 0.0)):
+            rx = numpy.where(clipped, cx, rx)
+            ry = numpy.where(clipped, cy, ry)
+            rz = numpy.where(clipped, 0.0, rz)
+    return rx, ry, rz
+
+# lbqfld.f for points within the quadrupole: the direction cosines and the
+# magnitude of the field.  points off the map have no field.
+def lbqfld(maps, x, y, method="nearest"):
+    bx, by, inside = lookup(maps.quadrupole, abs(x), abs(y), method)
+    b = numpy.sqrt(bx ** 2 + by ** 2)
+    b = numpy.where(b == 0, B_MIN, b)
+    btx = numpy.where(y < 0.0, -bx / b, bx / b)
+    bty = numpy.where(x < 0.0, -by / b, by / b)
+    return btx, bty, numpy.zeros(b.shape), numpy.where(inside, b, 0.0)
+
+# magfld.f: the direction cosines and the magnitude of the field at (x, y, z).
+# mlattc, 0 or 1, is the lattice flag that selects the sign of the radial
+# field.
+def magfld(maps, x, y, z, mlattc=0, method="nearest"):
+    if method not in METHODS:
+        raise ValueError("unknown method %s, expected one of %s" % (method, ", ".join(METHODS)))
+    x, y, z, mlattc = numpy.broadcast_arrays(numpy.asarray(x, dtype=numpy.float64),
+                                             numpy.asarray(y, dtype=numpy.float64),
+                                             numpy.asarray(z, dtype=numpy.float64), mlattc)
+    if not numpy.isin(mlattc, (0, 1)).all():
+        raise ValueError("mlattc must be 0 or 1")
+    btx, bty, btz, b = (numpy.zeros(x.shape) for i in range(4))
+    solenoid = ~(abs(z) > Q1_Z)
+    quadrupole = ~solenoid & (x * x + y * y < Q1_R2)
+    if quadrupole.any():
+        btx[quadrupole], bty[quadrupole], btz[quadrupole], b[quadrupole] = \
+            lbqfld(maps, x[quadrupole], y[quadrupole], method)
+    rr = numpy.sqrt(x * x + y * y)
+    rr = numpy.where(rr <= 0.0, 1e-10, rr)
+    grid = maps.solenoid
+    solenoid &= (rr < grid.extents[2]) & (abs(z) < grid.extents[3])
+    if solenoid.any():
+        r, az, m = rr[solenoid], abs(z[solenoid]), mlattc[solenoid]
+        if method == "bilinear":
+            br, bz, inside = lookup(grid, r, az, method)
+            bs = numpy.sqrt(br ** 2 + bz ** 2)
+        else:
+            ir, iz, inside = cell(grid, r, az)
+            br, bz, bs = grid.first[ir, iz], grid.second[ir, iz], numpy.where(inside, maps.total[ir, iz], 0.0)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            btz[solenoid] = bz / bs
+            brr = numpy.where(m == 1, -1.0 * br / bs, br / bs)
+            # sic: magfld.f drops the sign of such a cosine
+            brr = numpy.where(abs(brr) > 1.0, 1.0, brr)
+            xn = brr / r
+        btx[solenoid] = xn * x[solenoid]
+        bty[solenoid] = xn * y[solenoid]
+        b[solenoid] = bs
+    btx, bty, btz = mhcosn(btx, bty, btz)
+    none = ~(b > B_MIN)
+    btx[none], bty[none], btz[none], b[none] = 0.0, 0.0, 1.0, -B_MIN
+    return btx, bty, btz, b
+
+# points to evaluate the field at, from a .npy file of shape (n, 3) or a text
+# file of x y z per line
+def read_points(path):
+    if path.endswith(".npy"):
+        points = numpy.load(path)
+    else:
+        points = numpy.loadtxt(path, dtype=numpy.float64, ndmin=2)
+    if points.ndim != 2 or points.shape[1] != 3:
+        raise ValueError("%s: expected points of 3 coordinates, found shape %s" % (path, points.shape))
+    return points
+
+# n points spread uniformly over the maps: the solenoid, and the quadrupole on
+# both sides
+def sample_points(n, seed=0):
+    random = numpy.random.RandomState(seed)
+    nq = n // 4
+    r = numpy.sqrt(random.uniform(0.0, 900.0 ** 2, n - nq))
+    phi = random.uniform(-numpy.pi, numpy.pi, n - nq)
+    solenoid = numpy.column_stack([r * numpy.cos(phi), r * numpy.sin(phi), random.uniform(-1600.0, 1600.0, n - nq)])
+    quadrupole = numpy.column_stack([random.uniform(-12.0, 12.0, nq), random.uniform(-12.0, 12.0, nq),
+                                     numpy.where(random.uniform(size=nq) < 0.5, -1.0, 1.0) *
+                                     random.uniform(Q1_Z, 3000.0, nq)])
+    return numpy.concatenate([solenoid, quadrupole])
+
+# points on the cell edges of the maps and on the boundaries of the regions of
+# magfld.f, on the axes so that their radius is exact, and n random points
+def check_points(n, seed=0):
+    r = numpy.arange(0.0, 905.0, 5.0)
+    z = numpy.arange(-1605.0, 1610.0, 5.0)
+    rr, zz = [a.ravel() for a in numpy.meshgrid(r[::2], z[::4])]
+    zeros = numpy.zeros(rr.shape)
+    solenoid = [numpy.column_stack([rr, zeros, zz]), numpy.column_stack([zeros, -rr, zz])]
+    q = numpy.arange(-24.5, 24.75, 0.25)
+    qx, qy = [a.ravel() for a in numpy.meshgrid(q, q)]
+    quadrupole = [numpy.column_stack([qx, qy, numpy.full(qx.shape, z)])
+                  for z in (-numpy.nextafter(Q1_Z, 3000.0), numpy.nextafter(Q1_Z, 3000.0))]
+    rb, zb = [a.ravel() for a in numpy.meshgrid([0.0, 17.75, 18.0, 899.0, 900.0],
+                                                [-Q1_Z, Q1_Z, numpy.nextafter(Q1_Z, 0.0), -1600.0, 1600.0, 1599.0])]
+    boundaries = [numpy.column_stack([rb, numpy.zeros(rb.shape), zb])]
+    return numpy.concatenate(solenoid + quadrupole + boundaries + [sample_points(n, seed)])
+
+# builds the driver and the routines in a directory of their own and returns
+# the field they give at the points, and litwod of the x component of the
+# quadrupole map at (|x|, |y|), as an (n, 5) array
+def fortran_field(directory, routines, points, mlattc, compiler, flags):
+    work = tempfile.mkdtemp(prefix="magchk_")
+    try:
+        for name, text in FORTRAN_INCLUDES.items():
+            with open(os.path.join(work, name), "w") as f:
+                f.write(text)
+        executable = os.path.join(work, "magchk")
+        command = ([compiler] + flags.split() + ["-I", work, "-o", executable] +
+                   [os.path.join(routines, source) for source in FORTRAN_SOURCES])
+        try:
+            status = subprocess.call(command)
+        except OSError as e:
+            raise IOError("cannot run %s: %s" % (compiler, e))
+        if status != 0:
+            raise IOError("%s failed with exit status %i" % (" ".join(command), status))
+        # the routines read the maps from the parent directory of the job
+        for name in (SOLENOID, QUADRUPOLE):
+            for path in (os.path.join(directory, name), fm.compiled_filename(os.path.join(directory, name))):
+                if os.path.exists(path):
+                    os.symlink(os.path.abspath(path), os.path.join(work, os.path.basename(path)))
+        run = os.path.join(work, "run")
+        os.mkdir(run)
+        with open(os.path.join(run, "magchk.in"), "wb") as f:
+            f.write(numpy.array([mlattc, len(points)], dtype="<i4").tobytes())
+            f.write(numpy.ascontiguousarray(points, dtype="<f8").tobytes())
+        with open(os.devnull, "w") as null:
+            status = subprocess.call([executable], cwd=run, stdout=null)
+        if status != 0:
+            raise IOError("the Fortran driver failed with exit status %i" % status)
+        return numpy.fromfile(os.path.join(run, "magchk.out"), dtype="<f8").reshape(len(points), 5)
+    finally:
+        shutil.rmtree(work)
+
+# compares the field of the cells and litwod with those of the Fortran
+# routines; returns the number of points at which any value differs
+def check_fortran(maps, points, mlattc, theirs):
+    ours = numpy.column_stack(magfld(maps, points[:, 0], points[:, 1], points[:, 2], mlattc) +
+                              (litwod(abs(points[:, 0]), abs(points[:, 1]),
+                                      maps.quadrupole.axes[0][:LITWOD_SIZE], maps.quadrupole.axes[1][:LITWOD_SIZE],
+                                      maps.quadrupole.first[:LITWOD_SIZE, :LITWOD_SIZE]),))
+    differ = (ours != theirs) & ~(numpy.isnan(ours) & numpy.isnan(theirs))
+    for column, name in enumerate(["btx", "bty", "btz", "b", "litwod"]):
+        bad = numpy.flatnonzero(differ[:, column])
+        if len(bad):
+            i = bad[0]
+            warn("%s differs at %i points, e.g. at (%.17g, %.17g, %.17g): %.17g, Fortran %.17g" %
+                 ((name, len(bad)) + tuple(points[i]) + (ours[i, column], theirs[i, column])))
+    return int(differ.any(axis=1).sum())
+
+# prints how much the interpolated field differs from the field of the cells,
+# in magnitude and in direction
+def compare(maps, points, mlattc):
+    nearest = numpy.column_stack(magfld(maps, points[:, 0], points[:, 1], points[:, 2], mlattc, "nearest"))
+    bilinear = numpy.column_stack(magfld(maps, points[:, 0], points[:, 1], points[:, 2], mlattc, "bilinear"))
+    print("region\tpoints\tfield\trms dB [T]\tmax dB [T]\trms angle [mrad]\tmax angle [mrad]")
+    quadrupole = abs(points[:, 2]) > Q1_Z
+    for name, selected in (("solenoid", ~quadrupole), ("quadrupole", quadrupole)):
+        field = selected & ((nearest[:, 3] > 0) | (bilinear[:, 3] > 0))
+        db = abs(numpy.maximum(nearest[field, 3], 0.0) - numpy.maximum(bilinear[field, 3], 0.0))
+        both = field & (nearest[:, 3] > 0) & (bilinear[:, 3] > 0)
+        cosine = numpy.clip((nearest[both, :3] * bilinear[both, :3]).sum(axis=1), -1.0, 1.0)
+        angle = 1e3 * numpy.arccos(cosine)
+        print("%s\t%i\t%i\t%.3g\t%.3g\t%.3g\t%.3g" % (name, selected.sum(), field.sum(),
+                                                      numpy.sqrt((db ** 2).mean()) if len(db) else 0.0,
+                                                      db.max() if len(db) else 0.0,
+                                                      numpy.sqrt((angle ** 2).mean()) if len(angle) else 0.0,
+                                                      angle.max() if len(angle) else 0.0))
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options] points\n"
+                                "       %prog --compare [options] [points]\n"
+                                "       %prog --check-fortran [options] [points]",
+                          description="Evaluate the magnetic field of the user routines with numpy",
+                          epilog=("Evaluates the field that magfld.f returns at the points, read from a .npy "
+                                  "file of shape (n, 3) or a text file of x y z [cm] per line, and saves the "
+                                  "direction cosines and the magnitude [T] as an (n, 4) array to OUTPUT.  With "
+                                  "--compare, prints how much the interpolated field differs from the field of "
+                                  "the map cells instead.  With --check-fortran, builds the user routines "
+                                  "with a driver and checks that they give the same field, bit for bit."))
+    parser.add_option("-d", "--directory", dest="directory", default=os.getcwd(),
+                      help="read the field maps from DIR (default: the current directory)", metavar="DIR")
+    parser.add_option("-m", "--method", dest="method", default=METHODS[0], choices=METHODS,
+                      help="nearest, the field of the map cell as in magfld.f, or bilinear (default: %s)" %
+                      METHODS[0], metavar="METHOD")
+    parser.add_option("--mlattc", dest="mlattc", type="int", default=0,
+                      help="the lattice flag: 0 for the solenoid field along +z, 1 for -z (default: 0)",
+                      metavar="N")
+    parser.add_option("-o", "--output", dest="output", default="field.npy",
+                      help="save the field to OUTPUT (default: field.npy)", metavar="OUTPUT")
+    parser.add_option("--compare", action="store_true", dest="compare",
+                      help="compare the field of the cells with the interpolated field")
+    parser.add_option("--sample", dest="sample", type="int", default=None,
+                      help=("compare at N random points of the maps if no points are given (default: 1000000, "
+                            "or 10000 besides the cell edges with --check-fortran)"), metavar="N")
+    parser.add_option("--check-fortran", action="store_true", dest="check_fortran",
+                      help="check the field of the cells against the Fortran routines")
+    parser.add_option("--routines", dest="routines", default=None,
+                      help="with --check-fortran, build the routines in DIR (default: routines under -d)",
+                      metavar="DIR")
+    parser.add_option("--fortran-compiler", dest="compiler", default=DEFAULT_FORTRAN_COMPILER,
+                      help="with --check-fortran, build them with COMPILER (default: %s)" % DEFAULT_FORTRAN_COMPILER,
+                      metavar="COMPILER")
+    parser.add_option("--fortran-flags", dest="flags", default=DEFAULT_FORTRAN_FLAGS,
+                      help="and FLAGS (default: %s)" % DEFAULT_FORTRAN_FLAGS, metavar="FLAGS")
+    (options, args) = parser.parse_args()
+    if options.compare and options.check_fortran:
+        sys.exit("--compare and --check-fortran are exclusive")
+    if len(args) > 1 or not (args or options.compare or options.check_fortran):
+        sys.exit(parser.get_usage())
+    return (options, args[0] if args else None)
+
+def main():
+    options, path = process_arguments()
+    try:
+        maps = FieldMaps(options.directory)
+        if options.check_fortran:
+            points = read_points(path) if path else check_points(options.sample or 10000)
+            routines = options.routines or os.path.join(options.directory, "routines")
+            theirs = fortran_field(options.directory, routines, points, options.mlattc, options.compiler,
+                                   options.flags)
+            differ = check_fortran(maps, points, options.mlattc, theirs)
+            if differ:
+                sys.exit("the field differs from that of the routines at %i of %i points" % (differ, len(points)))
+            warn("the field is identical to that of the routines at %i points" % len(points))
+            return
+        points = read_points(path) if path else sample_points(options.sample or 1000000)
+        if options.compare:
+            compare(maps, points, options.mlattc)
+            return
+        start = time.time()
+        field = numpy.column_stack(magfld(maps, points[:, 0], points[:, 1], points[:, 2], options.mlattc,
+                                          options.method))
+        warn("%i points in %.2f s" % (len(points), time.time() - start))
+    except (ValueError, IOError) as e:
+        sys.exit(e)
+    numpy.save(options.output, field)
+
+if __name__ == '__main__':
+    main()
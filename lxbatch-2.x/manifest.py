@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# persistent record of the jobs of a campaign.  the manifest lives in the
+# working directory next to the input files and remembers, for each job, its
+# identifier, seed, number of primaries, submission and output, so that the
+# scripts do not have to rescan the directory and reread every job card to
+# rediscover the state of the campaign.
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import re
+import sqlite3
+from optparse import OptionParser
+
+FILENAME = ".lxbatch_manifest.sqlite"
+
+STATUS_SPLIT     = "split"
+STATUS_SUBMITTED = "submitted"
+STATUS_FINISHED  = "finished"
+STATUS_FAILED    = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    input_base TEXT NOT NULL,
+    identifier TEXT NOT NULL,
+    filename   TEXT NOT NULL,
+    seed       INTEGER,
+    nprimaries INTEGER,
+    submit_id  TEXT,
+    cluster_id INTEGER,
+    proc_id    INTEGER,
+    output     TEXT,
+    status     TEXT NOT NULL DEFAULT 'split',
+    PRIMARY KEY (input_base, identifier)
+);
+CREATE INDEX IF NOT EXISTS jobs_by_seed ON jobs (input_base, seed);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (input_base, status);
+CREATE TABLE IF NOT EXISTS results (
+    filename TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime    REAL NOT NULL,
+    failure  TEXT
+);
+"""
+
+# identifiers grow past four letters instead of wrapping around, so they order
+# by length first
+ORDER_BY_IDENTIFIER = "ORDER BY length(identifier), identifier"
+
+class Manifest(object):
+    def __init__(self, directory):
+        self.path = os.path.join(directory, FILENAME)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.executescript(SCHEMA)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+    def query(self, sql, *args):
+        return self.connection.execute(sql, args).fetchall()
+
+    def has_jobs(self, input_base):
+        return bool(self.query("SELECT 1 FROM jobs WHERE input_base = ? LIMIT 1", input_base))
+
+    def add_job(self, input_base, identifier, filename, seed, nprimaries, status=STATUS_SPLIT):
+        self.connection.execute("INSERT OR REPLACE INTO jobs (input_base, identifier, filename, seed, nprimaries, status) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                (input_base, identifier, filename, seed, nprimaries, status))
+
+    def remove_jobs(self, input_base, identifiers):
+        self.connection.executemany("DELETE FROM jobs WHERE input_base = ? AND identifier = ?",
+                                    [(input_base, identifier) for identifier in identifiers])
+
+    def jobs(self, input_base, status=None):
+        if status is None:
+            rows = self.query("SELECT filename FROM jobs WHERE input_base = ? " + ORDER_BY_IDENTIFIER, input_base)
+        else:
+            rows = self.query("SELECT filename FROM jobs WHERE input_base = ? AND status = ? " + ORDER_BY_IDENTIFIER,
+                              input_base, status)
+        return [filename for (filename,) in rows]
+
+    def job(self, input_base, identifier):
+        cursor = self.connection.execute("SELECT * FROM jobs WHERE input_base = ? AND identifier = ?",
+                                         (input_base, identifier))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    # returns a dict from job filename to seed
+    def seeds(self, input_base):
+        return dict(self.query("SELECT filename, seed FROM jobs WHERE input_base = ?", input_base))
+
+    def max_seed(self, input_base):
+        return self.query("SELECT max(seed) FROM jobs WHERE input_base = ?", input_base)[0][0]
+
+    def last_identifier(self, input_base):
+        rows = self.query("SELECT identifier FROM jobs WHERE input_base = ? "
+                          "ORDER BY length(identifier) DESC, identifier DESC LIMIT 1", input_base)
+        return rows[0][0] if rows else None
+
+    def set_submitted(self, input_base, identifier, submit_id, cluster_id=None, proc_id=None):
+        self.connection.execute("UPDATE jobs SET submit_id = ?, cluster_id = ?, proc_id = ?, status = ? "
+                                "WHERE input_base = ? AND identifier = ?",
+                                (submit_id, cluster_id, proc_id, STATUS_SUBMITTED, input_base, identifier))
+
+    def set_status(self, input_base, identifier, status, output=None):
+        if output is None:
+            self.connection.execute("UPDATE jobs SET status = ? WHERE input_base = ? AND identifier = ?",
+                                    (status, input_base, identifier))
+        else:
+            self.connection.execute("UPDATE jobs SET status = ?, output = ? WHERE input_base = ? AND identifier = ?",
+                                    (status, output, input_base, identifier))
+
+    # returns (failure,) if a verdict on the result zip with the given size and
+    # modification time is cached, None otherwise
+    def cached_result(self, filename, size, mtime):
+        rows = self.query("SELECT failure FROM results WHERE filename = ? AND size = ? AND mtime = ?",
+                          filename, size, mtime)
+        return rows[0] if rows else None
+
+    def cache_result(self, filename, size, mtime, failure):
+        self.connection.execute("INSERT OR REPLACE INTO results (filename, size, mtime, failure) VALUES (?, ?, ?, ?)",
+                                (filename, size, mtime, failure))
+
+# one manifest per directory and process
+_manifests = {}
+def open_manifest(directory):
+    directory = os.path.abspath(directory)
+    if directory not in _manifests:
+        _manifests[directory] = Manifest(directory)
+    return _manifests[directory]
+
+# closes the manifest of the directory, if open; the next open_manifest opens
+# it anew
+def close_manifest(directory):
+    manifest = _manifests.pop(os.path.abspath(directory), None)
+    if manifest is not None:
+        manifest.close()
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options] main_input_file.inp",
+                          description="Show or rebuild the campaign manifest in the current directory",
+                          epilog=("Lists the jobs recorded for main_input_file.inp.  With --rescan, "
+                                  "records of job input files that no longer exist are dropped and "
+                                  "job input files not yet recorded are added first, e.g. after jobs "
+                                  "were added or removed by hand; split.py and execute.py do the same "
+                                  "whenever they list the jobs."))
+    parser.add_option("--rescan", action="store_true", dest="rescan",
+                      help="synchronize the records with the job input files in the directory")
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1:
+        sys.exit(parser.get_usage())
+
+    input_base = re.sub(r'\.inp$', '', args[0])
+    return (input_base, options)
+
+def main(path_prefix=os.getcwd()):
+    # util builds on this module; it is only needed here, to rescan
+    import util as ut
+    input_base, options = process_arguments()
+    manifest = open_manifest(path_prefix)
+    if options.rescan:
+        ut.sync_jobs(manifest, path_prefix, input_base)
+        manifest.commit()
+    for (identifier, filename, seed, nprimaries, cluster_id, status) in manifest.query(
+            "SELECT identifier, filename, seed, nprimaries, cluster_id, status FROM jobs "
+            "WHERE input_base = ? " + ORDER_BY_IDENTIFIER, input_base):
+        print("%s\t%s\t%s\t%s\t%s" % (filename, seed, nprimaries, cluster_id if cluster_id is not None else "-", status))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+FOCUS - FLUKA for CMS Users | PH-CMX-DS | BRIL Radiation Simulation
+European Organization for Nuclear Research (CERN)
+
+authors: Slawomir Tadeja (2013)
+         Tim Cooijmans (2014)
+
+contact:
+http://hypernews.cern.ch/HyperNews/CMS/get/bril-radiation-simulation.html
+"""
+
+# follows the HTCondor user logs of a submitted campaign, keeping count of the
+# jobs that are idle, running, finished and failed, and resubmits jobs that
+# failed or were evicted.  the logs (CONDORcluster<job>/<job>.<cluster>.<proc>.log)
+# are read incrementally; only what was appended since the last poll is parsed.
+# chained jobs (execute.py --segments) are left to DAGMan, which submits and
+# retries their segments: every segment adds a user log, and resubmitting one
+# with a submit file of its own would overwrite that of the DAG and start the
+# chain over.  they are only counted, with the segments that are done.
+#
+# unlike the other scripts this one needs Python 3 (asyncio).
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import re
+import time
+import asyncio
+import datetime
+import collections
+from optparse import OptionParser
+import util as ut
+import manifest as mf
+import execute as ex
+
+VERSION="""
+2.x""".strip()
+ut.require_version_match(VERSION)
+
+DEFAULT_INTERVAL = 60
+DEFAULT_MAX_RETRIES = 3
+# number of log files read at the same time
+DEFAULT_CONCURRENCY = 64
+
+# job states, as far as the user logs tell
+IDLE     = "idle"
+RUNNING  = "running"
+FINISHED = "finished"
+FAILED   = "failed"
+EVICTED  = "evicted"
+HELD     = "held"
+CHAINED  = "chained"
+STATES = [IDLE, RUNNING, HELD, EVICTED, FINISHED, FAILED, CHAINED]
+
+# user log events that change the state of a job
+EVENT_SUBMIT     = 0
+EVENT_EXECUTE    = 1
+EVENT_EVICTED    = 4
+EVENT_TERMINATED = 5
+EVENT_ABORTED    = 9
+EVENT_HELD       = 12
+EVENT_RELEASED   = 13
+
+Event = collections.namedtuple("Event", "code cluster proc time text")
+
+RE_EVENT = re.compile(r"^(?P<code>\d{3}) \((?P<cluster>\d+)\.(?P<proc>\d+)\.\d+\) (?P<time>\S+ \S+) (?P<text>.*)$",
+                      flags=re.DOTALL)
+RE_RETURN_VALUE = re.compile(r"\(return value (?P<value>-?\d+)\)")
+RE_LOG = re.compile(r"^(?P<job>.+)\.(?P<cluster>\d+)\.(?P<proc>\d+)\.log$")
+
+# newer HTCondor versions log ISO dates, older ones leave out the year
+def parse_event_time(text):
+    try:
+        return time.mktime(time.strptime(text, "%Y-%m-%d %H:%M:%S"))
+    except ValueError:
+        stamp = time.strptime("%i/%s" % (datetime.date.today().year, text), "%Y/%m/%d %H:%M:%S")
+        return time.mktime(stamp)
+
+def parse_event(text):
+    match = RE_EVENT.match(text)
+    if not match:
+        return None
+    return Event(int(match.group("code")), int(match.group("cluster")), int(match.group("proc")),
+                 parse_event_time(match.group("time")), match.group("text"))
+
+# the part of a user log that has been read, and the events in it.  events are
+# terminated by a line "...", so a partially written event at the end of the
+# file is kept until the rest of it has been appended.
+class LogTail(object):
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.buffer = ""
+
+    # returns the events appended since the last call
+    def read(self):
+        try:
+            with open(self.path, "r") as file:
+                file.seek(self.offset)
+                data = file.read()
+                self.offset = file.tell()
+        except (IOError, OSError):
+            return []
+        chunks = (self.buffer + data).split("...\n")
+        self.buffer = chunks.pop()
+        events = [parse_event(chunk.strip("\n")) for chunk in chunks]
+        return [event for event in events if event is not None]
+
+# what the logs of one job say about it
+class Job(object):
+    def __init__(self, name, nprimaries, segments=1):
+        self.name = name
+        self.nprimaries = nprimaries or 0
+        self.segments = segments
+        self.state = IDLE
+        self.cluster = None
+        self.proc = None
+        self.tails = {}
+        self.started = None
+        self.ended = None
+        self.returncode = None
+        # number of user logs, i.e. of times the job was submitted
+        self.submissions = 0
+
+    def apply(self, event):
+        if self.cluster is not None and event.cluster < self.cluster:
+            # a previous submission of this job
+            return
+        self.cluster, self.proc = event.cluster, event.proc
+        if event.code == EVENT_SUBMIT:
+            self.state = IDLE
+        elif event.code == EVENT_EXECUTE:
+            self.state = RUNNING
+            self.started = event.time
+        elif event.code == EVENT_EVICTED:
+            self.state = EVICTED
+        elif event.code == EVENT_TERMINATED:
+            match = RE_RETURN_VALUE.search(event.text)
+            self.returncode = int(match.group("value")) if match else None
+            self.state = FINISHED if self.returncode == 0 else FAILED
+            self.ended = event.time
+        elif event.code == EVENT_ABORTED:
+            self.state = FAILED
+            self.ended = event.time
+        elif event.code == EVENT_HELD:
+            self.state = HELD
+        elif event.code == EVENT_RELEASED:
+            self.state = IDLE
+
+class Monitor(object):
+    def __init__(self, path_prefix, input_base, options):
+        self.path_prefix = path_prefix
+        self.input_base = input_base
+        self.options = options
+        self.manifest = mf.open_manifest(path_prefix)
+        self.jobs = collections.OrderedDict()
+        for fn in ut.find_jobs(path_prefix, input_base):
+            record = self.manifest.job(*ut.parse_job_filename(fn))
+            name = ut.extensionless_filename(fn)
+            self.jobs[name] = Job(name, record["nprimaries"] if record else ut.get_nprimaries(self.read_input(fn)),
+                                  ex.script_segments(path_prefix, name))
+        self.semaphore = None
+        # submissions in progress, by job name
+        self.resubmitting = {}
+
+    def read_input(self, fn):
+        with open(os.path.join(self.path_prefix, fn), "r") as file:
+            return file.read()
+
+    def directory(self, job):
+        return os.path.join(self.path_prefix, "CONDORcluster" + job.name)
+
+    # looks for new user logs of the job and reads what was appended to all of
+    # them, in log (i.e. cluster) order.  the logs of the segments of a chained
+    # job are not read.
+    def poll_job(self, job):
+        if job.segments > 1:
+            job.state = CHAINED
+            return
+        try:
+            names = os.listdir(self.directory(job))
+        except OSError:
+            names = []
+        for fn in names:
+            match = RE_LOG.match(fn)
+            if match and match.group("job") == job.name and fn not in job.tails:
+                job.tails[fn] = LogTail(os.path.join(self.directory(job), fn))
+        job.submissions = len(job.tails)
+        events = []
+        for tail in job.tails.values():
+            events.extend(tail.read())
+        for event in sorted(events, key=lambda event: (event.cluster, event.time)):
+            job.apply(event)
+
+    async def poll(self):
+        loop = asyncio.get_event_loop()
+        async def poll_job(job):
+            async with self.semaphore:
+                await loop.run_in_executor(None, self.poll_job, job)
+        await asyncio.gather(*[poll_job(job) for job in self.jobs.values()
+                               if job.state not in (FINISHED, CHAINED)])
+
+    def counts(self):
+        counts = collections.Counter(job.state for job in self.jobs.values())
+        return [(state, counts[state]) for state in STATES]
+
+    # primaries per hour of the finished jobs, from the first job starting to
+    # the last one ending, and the expected remaining time in hours
+    def throughput(self):
+        finished = [job for job in self.jobs.values() if job.state == FINISHED]
+        if not finished:
+            return None, None
+        start = min(job.started or job.ended for job in finished)
+        end = max(job.ended for job in finished)
+        if end <= start:
+            return None, None
+        rate = sum(job.nprimaries for job in finished) / ((end - start) / 3600.)
+        remaining = sum(job.nprimaries for job in self.jobs.values() if job.state != FINISHED)
+        return rate, remaining / rate
+
+    def retryable(self, job):
+        return job.state in (FAILED, EVICTED) and job.submissions <= self.options.max_retries
+
+    def exhausted(self, job):
+        return job.state in (FAILED, EVICTED) and not self.retryable(job)
+
+    def done(self):
+        return all(job.state in (FINISHED, CHAINED) or self.exhausted(job) for job in self.jobs.values())
+
+    async def run_command(self, *command):
+        process = await asyncio.create_subprocess_exec(*command, cwd=self.path_prefix,
+                                                       stdout=asyncio.subprocess.PIPE)
+        output, _ = await process.communicate()
+        return process.returncode, output.decode()
+
+    # removes what is left of the job from the queue and submits it anew, with
+    # a submit file of its own.  chained jobs are left to DAGMan.
+    async def resubmit(self, job):
+        if job.segments > 1:
+            return
+        if job.state == EVICTED and self.options.condor_rm:
+            await self.run_command(self.options.condor_rm, "%i.%i" % (job.cluster, job.proc))
+        input = job.name + ".inp"
+        submit_name = "submit_%s.sub" % job.name
+        includes = ex.job_includes(self.path_prefix, input)
+        bundle = ex.script_bundle(self.path_prefix, job.name)
+        with open(os.path.join(self.path_prefix, submit_name), "w") as insub:
+            insub.write(ex.SUBMIT_TEMPLATE_.safe_substitute(file_name_noextension=job.name,
+                                                            job_flavour=self.options.job_flavour,
+                                                            current_dir=self.path_prefix,
+                                                            file_name=input,
+                                                            executable=self.options.executable,
+                                                            job_files=ex.transfer_files(self.path_prefix, includes,
+                                                                                        self.options.executable,
+                                                                                        bundle)))
+        returncode, output = await self.run_command(self.options.condor_submit, submit_name)
+        if returncode != 0 or not ex.RE_CLUSTER.search(output):
+            warn("could not resubmit %s: %s" % (job.name, output.strip()))
+            return
+        warn("resubmitted %s job %s (attempt %i of %i)" % (job.state, job.name, job.submissions + 1,
+                                                            self.options.max_retries + 1))
+        ex.record_submission(self.manifest, input, submit_name, output=output)
+        # the job stays failed or evicted until the new log shows up
+        job.state = IDLE
+
+    # records the jobs' states in the manifest
+    def record(self):
+        for job in self.jobs.values():
+            input_base, identifier = ut.parse_job_filename(job.name + ".inp")
+            if job.state == FINISHED:
+                self.manifest.set_status(input_base, identifier, mf.STATUS_FINISHED)
+            elif self.exhausted(job):
+                self.manifest.set_status(input_base, identifier, mf.STATUS_FAILED)
+        self.manifest.commit()
+
+    def report(self):
+        rate, eta = self.throughput()
+        line = "  ".join("%s %i" % count for count in self.counts())
+        chained = [job for job in self.jobs.values() if job.state == CHAINED]
+        if chained:
+            line += " (%i of %i segments done)" % (sum(min(ex.segments_done(self.path_prefix, job.name), job.segments)
+                                                       for job in chained),
+                                                   sum(job.segments for job in chained))
+        if rate is not None:
+            line += "  |  %.4g primaries/hour, ETA %.1f hours" % (rate, eta)
+        warn("%s  %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), line))
+
+    async def run(self):
+        self.semaphore = asyncio.Semaphore(self.options.concurrency)
+        while True:
+            await self.poll()
+            if self.options.resubmit:
+                await asyncio.gather(*[self.resubmit(job) for job in self.jobs.values() if self.retryable(job)])
+            self.record()
+            self.report()
+            if self.options.once or self.done():
+                break
+            await asyncio.sleep(self.options.interval)
+        failed = [job.name for job in self.jobs.values() if self.exhausted(job)]
+        if failed:
+            warn("gave up on %i jobs: %s" % (len(failed), " ".join(failed)))
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options] main_input_file.inp",
+                          version="%prog "+VERSION,
+                          description="Monitor and resubmit the jobs of a submitted FLUKA simulation",
+                          epilog=("Follows the HTCondor user logs of the jobs of main_input_file.inp "
+                                  "in their CONDORcluster directories, reporting the number of jobs "
+                                  "in each state, the throughput and the expected remaining time "
+                                  "every INTERVAL seconds until all jobs have finished or failed "
+                                  "more than RETRIES times.  Failed and evicted jobs are resubmitted.  "
+                                  "Chained jobs are left to DAGMan, which retries their segments."))
+    parser.add_option("-i", "--interval", dest="interval", type="float", default=DEFAULT_INTERVAL,
+                      help="poll the logs every SECONDS seconds (default: %i)" % DEFAULT_INTERVAL, metavar="SECONDS")
+    parser.add_option("-r", "--max-retries", dest="max_retries", type="int", default=DEFAULT_MAX_RETRIES,
+                      help="resubmit a job at most RETRIES times (default: %i)" % DEFAULT_MAX_RETRIES, metavar="RETRIES")
+    parser.add_option("-n", "--no-resubmit", action="store_false", dest="resubmit", default=True,
+                      help="only report, do not resubmit jobs")
+    parser.add_option("--once", action="store_true", dest="once",
+                      help="read the logs once and exit")
+    parser.add_option("-j", "--concurrency", dest="concurrency", type="int", default=DEFAULT_CONCURRENCY,
+                      help="read at most N logs at a time (default: %i)" % DEFAULT_CONCURRENCY, metavar="N")
+    parser.add_option("-q", "--run-queue", dest="job_flavour", default="tomorrow",
+                      choices=list(ut.JOB_FLAVOURS),
+                      help="resubmit to run queue QUEUE", metavar="QUEUE")
+    parser.add_option("-e", "--executable", dest="executable", default="",
+                      help="passed on to rfluka", metavar="FILE")
+    parser.add_option("--condor-submit", dest="condor_submit", default="condor_submit",
+                      help="command used to submit jobs (default: condor_submit)", metavar="COMMAND")
+    parser.add_option("--condor-rm", dest="condor_rm", default="condor_rm",
+                      help="command used to remove evicted jobs before resubmitting them (default: condor_rm)",
+                      metavar="COMMAND")
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1:
+        sys.exit(parser.get_usage())
+
+    input_base = re.sub(r'\.inp$', '', args[0])
+    return (input_base, options)
+
+def main(path_prefix=os.getcwd()):
+    input_base, options = process_arguments()
+    monitor = Monitor(path_prefix, input_base, options)
+    if not monitor.jobs:
+        sys.exit('nothing to do.')
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(monitor.run())
+    finally:
+        loop.close()
+
+if __name__ == '__main__':
+    main()
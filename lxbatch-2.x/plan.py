@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# sizing of the jobs of a campaign to the HTCondor job flavours.  a job that
+# runs past the limit of its flavour is killed and loses its output, and one
+# that ends long before it leaves the slot it waited for mostly unused.  given
+# the total number of primaries wanted, this estimates what a primary of the
+# card costs and chooses the number of primaries per job (NPRIMARIES) and of
+# jobs (NSPLITS) that fill the flavour up to a safety margin:
+#
+#     plan.py v37214light.inp 1000000 -q workday --split
+#
+# the cost comes from a few short pilot jobs, split off the card into a
+# directory of their own and run here with execute.py -L, or, with -t, from
+# the telemetry records of jobs that ran before (see telemetry.py).  a job is
+# taken to last
+#
+#     overhead + NPRIMARIES * seconds per primary
+#
+# where the seconds per primary are the CPU time FLUKA reports for following
+# the primaries, over all the jobs, and the overhead is the median of the
+# rest of the wall time of a job (initialization, reading the field maps,
+# staging out).  pilots run on this machine, which may be faster or slower
+# than the workers of the farm; the recorded timings of farm jobs of the same
+# card are the better estimate, once there are some.
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import re
+import glob
+import math
+import shutil
+import tempfile
+import subprocess
+import collections
+from optparse import OptionParser
+import util as ut
+import manifest as mf
+import telemetry as tm
+
+VERSION="""
+2.x""".strip()
+ut.require_version_match(VERSION)
+
+LXBATCH = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_FLAVOUR = "workday"
+DEFAULT_MARGIN = 0.25
+DEFAULT_PILOTS = 4
+DEFAULT_PILOT_PRIMARIES = 20
+
+PILOT_PREFIX = "pilot_"
+PILOT_LOG = "pilot.log"
+
+# what a primary of the card costs, in seconds, and how many jobs and
+# primaries that is based on
+Estimate = collections.namedtuple("Estimate", "seconds_per_primary overhead jobs primaries")
+
+# the primaries per job and jobs for a flavour, and how long a job would take
+Plan = collections.namedtuple("Plan", "flavour nprimaries njobs seconds")
+
+def script(name):
+    return [sys.executable, os.path.join(LXBATCH, name)]
+
+# the estimate from the telemetry records of the jobs that ran to their end,
+# or None if there are none
+def estimate(records):
+    timed = [r for r in tm.known(records, "primaries", "cpu_seconds") if r["primaries"] > 0 and not r.get("status")]
+    if not timed:
+        return None
+    primaries = sum(r["primaries"] for r in timed)
+    overheads = sorted(max(0.0, r["wall_seconds"] - r["cpu_seconds"]) for r in tm.known(timed, "wall_seconds"))
+    return Estimate(seconds_per_primary=sum(r["cpu_seconds"] for r in timed) / float(primaries),
+                    overhead=overheads[len(overheads) // 2] if overheads else 0.0,
+                    jobs=len(timed), primaries=primaries)
+
+# the plan for total primaries with the jobs lasting at most 1 - margin of the
+# limit of the flavour, the primaries spread evenly over them; None if not
+# even one primary fits
+def plan(estimate, total, flavour, margin=DEFAULT_MARGIN):
+    budget = ut.JOB_FLAVOURS[flavour] * (1 - margin) - estimate.overhead
+    if estimate.seconds_per_primary > 0:
+        fit = min(total, int(budget / estimate.seconds_per_primary))
+    else:
+        fit = total if budget > 0 else 0
+    if fit < 1:
+        return None
+    njobs = int(math.ceil(total / float(fit)))
+    nprimaries = int(math.ceil(total / float(njobs)))
+    return Plan(flavour, nprimaries, njobs, estimate.overhead + nprimaries * estimate.seconds_per_primary)
+
+def format_plans(plans, chosen):
+    lines = ["%-13s %8s %12s %8s %8s %6s" % ("flavour", "limit h", "primaries", "jobs", "job h", "filled")]
+    for flavour, p in plans.items():
+        limit = ut.JOB_FLAVOURS[flavour]
+        mark = "*" if flavour == chosen else " "
+        if p is None:
+            lines.append("%-13s %8.2f %12s %8s %8s %6s" % (mark + flavour, limit / 3600.0, "-", "-", "-", "-"))
+        else:
+            lines.append("%-13s %8.2f %12i %8i %8.2f %5.0f%%" % (mark + flavour, limit / 3600.0, p.nprimaries,
+                                                               p.njobs, p.seconds / 3600.0,
+                                                               100.0 * p.seconds / limit))
+    return "\n".join(lines)
+
+# the telemetry records of the jobs of input_base among those matching
+# pattern
+def recorded_records(path_prefix, input_base, pattern):
+    records = tm.read_records(sorted(glob.glob(os.path.join(path_prefix, pattern))))
+    return [r for r in records if tm.variant(r) == input_base]
+
+# splits pilot jobs off the card into a directory of their own, next to the
+# files of path_prefix (the card, field maps, executable, included files), runs
+# them with execute.py -L and returns their telemetry records.  the directory
+# is removed unless the pilots fail or it is to be kept.
+def run_pilots(path_prefix, input_base, options):
+    directory = tempfile.mkdtemp(prefix=PILOT_PREFIX + input_base + "_", dir=path_prefix)
+    for fn in os.listdir(path_prefix):
+        path = os.path.join(path_prefix, fn)
+        if os.path.isfile(path) and not fn.startswith(mf.FILENAME) and not ut.parse_job_filename(fn)[0]:
+            os.symlink(path, os.path.join(directory, fn))
+
+    split = script("split.py") + [input_base + ".inp", str(options.pilot_primaries), str(options.pilots)]
+    execute = script("execute.py") + ["-L"]
+    if options.workers:
+        execute += ["-w", str(options.workers)]
+    if options.executable:
+        execute += ["-e", options.executable]
+    warn("running %i pilot jobs of %i primaries in %s" % (options.pilots, options.pilot_primaries, directory))
+    with open(os.path.join(directory, PILOT_LOG), "w") as log, open(os.devnull) as null:
+        for command in (split, execute + [input_base + ".inp"]):
+            status = subprocess.call(command, cwd=directory, stdin=null, stdout=log, stderr=log)
+            if status != 0:
+                sys.exit("%s failed with exit status %i; see %s" % (os.path.basename(command[1]), status,
+                                                                     os.path.join(directory, PILOT_LOG)))
+    records = tm.read_records(sorted(glob.glob(os.path.join(directory, tm.GLOB))))
+    if estimate(records) is None:
+        sys.exit("none of the pilot jobs ran to its end; see %s" % directory)
+    if not options.keep_pilots:
+        shutil.rmtree(directory)
+    return records
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options] main_input_file.inp TOTAL_PRIMARIES",
+                          version="%prog "+VERSION,
+                          description="Size the jobs of a FLUKA campaign to a job flavour",
+                          epilog=("Estimates the time per primary of main_input_file.inp from pilot "
+                                  "jobs run on this machine, or from the telemetry records of earlier "
+                                  "jobs with -t, and prints, for every job flavour, the number of "
+                                  "primaries per job and of jobs that simulate TOTAL_PRIMARIES "
+                                  "without the jobs running past the flavour's limit less the margin."))
+    parser.add_option("-q", "--run-queue", dest="job_flavour", default=DEFAULT_FLAVOUR,
+                      choices=list(ut.JOB_FLAVOURS),
+                      help="size the jobs for run queue QUEUE (default: %s)" % DEFAULT_FLAVOUR, metavar="QUEUE")
+    parser.add_option("-m", "--margin", dest="margin", type="float", default=DEFAULT_MARGIN,
+                      help=("leave the fraction F of the flavour's limit unused, for slower workers "
+                            "and primaries costlier than the average (default: %g)" % DEFAULT_MARGIN),
+                      metavar="F")
+    parser.add_option("-t", "--telemetry", dest="telemetry", action="store_true",
+                      help="estimate from the telemetry records of earlier jobs of the card instead of pilots")
+    parser.add_option("--records", dest="records", default=tm.GLOB,
+                      help="with -t, read the records matching PATTERN (default: %s)" % tm.GLOB, metavar="PATTERN")
+    parser.add_option("-p", "--pilots", dest="pilots", type="int", default=DEFAULT_PILOTS,
+                      help="run N pilot jobs (default: %i)" % DEFAULT_PILOTS, metavar="N")
+    parser.add_option("-n", "--pilot-primaries", dest="pilot_primaries", type="int", default=DEFAULT_PILOT_PRIMARIES,
+                      help="of N primaries each (default: %i)" % DEFAULT_PILOT_PRIMARIES, metavar="N")
+    parser.add_option("-w", "--local-workers", dest="workers", type="int", default=None,
+                      help="run N pilot jobs at a time (default: as execute.py -L)", metavar="N")
+    parser.add_option("-e", "--executable", dest="executable", default="",
+                      help="passed on to rfluka", metavar="FILE")
+    parser.add_option("-k", "--keep-pilots", dest="keep_pilots", action="store_true",
+                      help="keep the directory of the pilot jobs")
+    parser.add_option("--split", dest="split", action="store_true",
+                      help="go on to split main_input_file.inp into the jobs of the plan")
+    parser.add_option("-s", "--shared", action="store_true", dest="shared",
+                      help="with --split, passed on to split.py")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2:
+        sys.exit(parser.get_usage())
+    if not 0 <= options.margin < 1:
+        sys.exit("the margin has to be at least 0 and less than 1")
+    if options.pilots < 1 or options.pilot_primaries < 1:
+        sys.exit("at least one pilot job of one primary is needed")
+
+    input_base = re.sub(r'\.inp$', '', args[0])
+    total = int(args[1])
+    if total < 1:
+        sys.exit("TOTAL_PRIMARIES has to be positive")
+
+    return (input_base, total, options)
+
+def main(path_prefix=os.getcwd()):
+    input_base, total, options = process_arguments()
+    if not os.path.isfile(os.path.join(path_prefix, input_base + ".inp")):
+        sys.exit("%s.inp not found" % input_base)
+
+    if options.telemetry:
+        records = recorded_records(path_prefix, input_base, options.records)
+        if estimate(records) is None:
+            sys.exit("no telemetry records of finished jobs of %s match %s; run pilots instead"
+                     % (input_base, options.records))
+    else:
+        records = run_pilots(path_prefix, input_base, options)
+    cost = estimate(records)
+    warn("%.4g s per primary and %.1f s overhead per job, from %i jobs of %i primaries in all"
+         % (cost.seconds_per_primary, cost.overhead, cost.jobs, cost.primaries))
+
+    plans = collections.OrderedDict((flavour, plan(cost, total, flavour, options.margin))
+                                    for flavour in ut.JOB_FLAVOURS)
+    print(format_plans(plans, options.job_flavour))
+    chosen = plans[options.job_flavour]
+    if chosen is None:
+        sys.exit("not even one primary fits into %s with a margin of %g" % (options.job_flavour, options.margin))
+
+    split = script("split.py") + [input_base + ".inp", str(chosen.nprimaries), str(chosen.njobs)]
+    if options.shared:
+        split.append("--shared")
+    warn("%s: %i jobs of %i primaries, about %.2f h each: split.py %s %i %i, then execute.py -q %s"
+         % (options.job_flavour, chosen.njobs, chosen.nprimaries, chosen.seconds / 3600.0,
+            input_base + ".inp", chosen.nprimaries, chosen.njobs, options.job_flavour))
+    if options.split:
+        sys.exit(subprocess.call(split, cwd=path_prefix))
+
+if __name__ == '__main__':
+    main()
@@ -9,16 +9,21 @@ import os
 import re
 from glob import glob
 from optparse import OptionParser
+from multiprocessing import Pool
 import numpy
 from string import Template
 
+DEFAULT_PROCESSES = 4
+# tables parsed and added up per task of the batch mode
+DEFAULT_FILES_PER_TASK = 64
+
 
 #Template for LaTeX table
 LaTemplate = Template("""\\begin{tabular}{l|c|c|c}
      \hline
      \hline
 
-     Region          & \multicolumn{3}{l}{   } \\\\ [2ex]
+     Region          & \multicolumn{3}{l}{${REGION}} \\\\ [2ex]
 
      Composition     & \multicolumn{3}{l}{   } \\\\
      {}              & \multicolumn{3}{l}{   } \\\\ [2ex]
@@ -38,16 +43,17 @@ ${TABLE}
 \end{tabular}
 """)
 
+SYMBOLS = ['H','He','Li','Be','B','C','N','O','F','Ne','Na','Mg','Al','Si',
+           'P','S','Cl','Ar','K','Ca','Sc','Ti','V','Cr','Mn','Fe','Co','Ni',
+           'Cu','Zn','Ga','Ge','As','Se','Br','Kr','Rb','Sr','Y','Zr','Nb',
+           'Mo','Tc','Ru','Rh','Pd','Ag','Cd','In','Sn','Sb','Te','I','Xe',
+           'Cs','Ba','La','Ce','Pr','Nd','Pm','Sm','Eu','Gd','Tb','Dy','Ho',
+           'Er','Tm','Yb','Lu','Hf','Ta','W','Re','Os','Ir','Pt','Au',
+           'Hg','Tl','Pb','Bi','Po','At','Rn','Fr','Ra','Ac','Th','Pa','U',
+           'Np','Pu','Am','Cm','Bk','Cf','Es','Fm']
+
 def find_nuclide(Z):
-    symbol = ['H','He','Li','Be','B','C','N','O','F','Ne','Na','Mg','Al','Si',
-              'P','S','Cl','Ar','K','Ca','Sc','Ti','V','Cr','Mn','Fe','Co','Ni',
-              'Cu','Zn','Ga','Ge','As','Se','Br','Kr','Rb','Sr','Y','Zr','Nb',
-              'Mo','Tc','Ru','Rh','Pd','Ag','Cd','In','Sn','Sb','Te','I','Xe',
-              'Cs','Ba','La','Ce','Pr','Nd','Pm','Sm','Eu','Gd','Tb','Dy','Ho',
-              'Ho','Er','Tm','Yb','Lu','Hf','Ta','W','Re','Os','Ir','Pt','Au',
-              'Hg','Tl','Pb','Bi','Po','At','Rn','Fr','Ra','Ac','Th','Pa','U',
-              'Np','Pu','Am','Cm','Bk','Cf','Es','Fm']
-    return symbol[Z-1]
+    return SYMBOLS[Z-1] if 0 < Z <= len(SYMBOLS) else 'Z%i' % Z
 
 #Conditions for a file to be relevant:
 #1. Has to begin with inputbasename_resnucle_
@@ -81,6 +87,17 @@ def process_arguments(path_prefix):
     parser.add_option("-t", "--table-type", dest="opt_table", default="csv",
                       choices="csv tex".split(),
                       help="Type of output: csv or tex file")
+    parser.add_option("-b", "--batch", action="store_true", dest="batch",
+                      help=("add up all the files (wildcards are expanded) into one summary of the "
+                            "activity of every nuclide in every region, averaged over the files"))
+    parser.add_option("-j", "--processes", dest="processes", type="int", default=DEFAULT_PROCESSES,
+                      help="with -b, parse the files with N processes (default: %i)" % DEFAULT_PROCESSES,
+                      metavar="N")
+    parser.add_option("-n", "--top", dest="top", type="int", default=None,
+                      help="with -b, list only the N most active nuclides of every region", metavar="N")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="with -b, write the summary to FILE (default: main_input_file_resnucle_summary.csv or .tex)",
+                      metavar="FILE")
 
     (options, args) = parser.parse_args()    
 
@@ -92,14 +109,16 @@ def process_arguments(path_prefix):
     input_base = re.sub(r'\.inp$', '', args[0])
 
     #No specific files are selected
-    if len(args) < 2:
+    if options.batch:
+        res_files = batch_files(path_prefix, input_base, args[1:])
+    elif len(args) < 2:
         res_files = find_files(path_prefix, input_base)
     else:
         res_files = args[1:]
 
     tab_option = options.opt_table
 
-    return (res_files, tab_option)
+    return (res_files, tab_option, input_base, options)
 
 
 
@@ -114,17 +133,225 @@ def actsort(A0, Z0, Bq0, err0):
     return (A0, Z0, Bq0, err0)
 
 
+# batch mode: the tables of many files (of the regions of many jobs, say) are
+# parsed in parallel and added up into one table of the activity of every
+# nuclide in every region, averaged over the files holding the region, with
+# its error.  a table file holds one or more detectors (regions), each
+# introduced by a "# Detector n: ... NAME" line, or one detector named after
+# the file; their isotopes (A Z activity err%) follow a "# A/Z Isotopes" line
+# and their isomers (A Z m activity err%) an "# A/Z/m Isomers" line.  the data
+# between the comment lines are parsed with numpy in one go.
+
+RE_COMMENT = re.compile(r"^[ \t]*#(.*)$", re.M)
+
+# nuclides are numbered (Z * 512 + A) * 16 + m, and the nuclides of a region
+# region * NUCLIDES + nuclide
+NUCLIDES = 256 * 512 * 16
+
+def nuclide_keys(Z, A, m):
+    return (Z.astype(numpy.int64) * 512 + A) * 16 + m
+
+def split_keys(keys):
+    nuclides = keys % NUCLIDES
+    return keys // NUCLIDES, nuclides // (512 * 16), nuclides // 16 % 512, nuclides % 16
+
+def table_detector_name(path):
+    return re.sub(r'_tab\.lis$', '', os.path.basename(path))
+
+# parses a table file.  returns a list of (detector name, nuclide keys,
+# activities, variances).
+def parse_table(path):
+    with open(path) as fin:
+        text = fin.read()
+    detectors = []
+    name, columns = None, None
+    keys, activities, variances = [], [], []
+    position = 0
+    for match in list(RE_COMMENT.finditer(text)) + [None]:
+        data = text[position:match.start() if match else len(text)]
+        if data.strip():
+            if columns is None:
+                raise ValueError("%s: data outside an isotope or isomer table" % path)
+            # numpy.fromstring would stop at the first malformed number
+            # without a word; float() of every token refuses it
+            try:
+                values = numpy.array(data.split(), dtype=numpy.float64)
+            except ValueError as e:
+                raise ValueError("%s: %s near offset %i" % (path, e, position))
+            if len(values) % columns:
+                raise ValueError("%s: rows of %i numbers expected near offset %i" % (path, columns, position))
+            values = values.reshape(-1, columns)
+            A, Z = values[:, 0].astype(numpy.int64), values[:, 1].astype(numpy.int64)
+            m = values[:, 2].astype(numpy.int64) if columns == 5 else numpy.zeros(len(values), dtype=numpy.int64)
+            activity, error = values[:, -2], values[:, -1]
+            keys.append(nuclide_keys(Z, A, m))
+            activities.append(activity)
+            variances.append((activity * error / 100.0) ** 2)
+        if match is None:
+            break
+        position = match.end()
+        comment = match.group(1)
+        words = comment.split()
+        if "Detector" in words or name is None:
+            if name is not None:
+                detectors.append((name, keys, activities, variances))
+            keys, activities, variances = [], [], []
+            name = words[-1] if "Detector" in words and len(words) > 3 else table_detector_name(path)
+            columns = None
+        if "A/Z/m" in comment:
+            columns = 5
+        elif "A/Z" in comment:
+            columns = 4
+    if name is not None:
+        detectors.append((name, keys, activities, variances))
+    empty = numpy.zeros(0)
+    return [(name, numpy.concatenate(keys) if keys else empty.astype(numpy.int64),
+             numpy.concatenate(activities) if activities else empty,
+             numpy.concatenate(variances) if variances else empty)
+            for name, keys, activities, variances in detectors]
+
+# sums of activities and variances by key
+class ResnucleSums(object):
+    def __init__(self):
+        self.keys = numpy.zeros(0, dtype=numpy.int64)
+        self.activities = numpy.zeros(0)
+        self.variances = numpy.zeros(0)
+        # the regions, in the order they were met, and the number of files
+        # holding each
+        self.regions = []
+        self.nfiles = []
+        self.index = {}
+
+    def region(self, name):
+        if name not in self.index:
+            self.index[name] = len(self.regions)
+            self.regions.append(name)
+            self.nfiles.append(0)
+        return self.index[name]
+
+    def add(self, keys, activities, variances):
+        keys = numpy.concatenate([self.keys, keys])
+        self.keys, inverse = numpy.unique(keys, return_inverse=True)
+        self.activities = numpy.bincount(inverse, numpy.concatenate([self.activities, activities]),
+                                         minlength=len(self.keys))
+        self.variances = numpy.bincount(inverse, numpy.concatenate([self.variances, variances]),
+                                        minlength=len(self.keys))
+
+    # adds up sums whose regions are numbered differently
+    def merge(self, other):
+        renumber = numpy.array([self.region(name) for name in other.regions] or [0], dtype=numpy.int64)
+        for name, n in zip(other.regions, other.nfiles):
+            self.nfiles[self.index[name]] += n
+        regions = other.keys // NUCLIDES
+        self.add(renumber[regions] * NUCLIDES + other.keys % NUCLIDES, other.activities, other.variances)
+
+# parses and adds up the tables of some files.  runs in the worker processes.
+def sum_tables(paths):
+    sums = ResnucleSums()
+    keys, activities, variances = [], [], []
+    for path in paths:
+        for name, k, a, v in parse_table(path):
+            region = sums.region(name)
+            sums.nfiles[region] += 1
+            keys.append(region * NUCLIDES + k)
+            activities.append(a)
+            variances.append(v)
+    if keys:
+        sums.add(numpy.concatenate(keys), numpy.concatenate(activities), numpy.concatenate(variances))
+    return sums
+
+def aggregate(paths, processes=DEFAULT_PROCESSES, files_per_task=DEFAULT_FILES_PER_TASK):
+    tasks = [paths[i:i + files_per_task] for i in range(0, len(paths), files_per_task)]
+    total = ResnucleSums()
+    if processes > 1 and len(tasks) > 1:
+        pool = Pool(min(processes, len(tasks)))
+        try:
+            for sums in pool.imap(sum_tables, tasks):
+                total.merge(sums)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            total.merge(sum_tables(task))
+    return total
+
+# the rows of the summary: for every region, in the order met, its nuclides
+# of nonzero activity by decreasing activity, at most top of them, as
+# (region, Z, A, m, mean activity, error %, number of files)
+def summary_rows(sums, top=None):
+    regions, Z, A, m = split_keys(sums.keys)
+    nfiles = numpy.array(sums.nfiles + [1], dtype=numpy.float64)[regions]
+    activity = sums.activities / nfiles
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        error = numpy.where(sums.activities > 0, 100.0 * numpy.sqrt(sums.variances) / sums.activities, 0.0)
+    selected = numpy.flatnonzero(sums.activities > 0)
+    order = selected[numpy.lexsort((-activity[selected], regions[selected]))]
+    rows = []
+    for region in range(len(sums.regions)):
+        first, last = numpy.searchsorted(regions[order], [region, region + 1])
+        for i in order[first:last if top is None else min(last, first + top)]:
+            rows.append((sums.regions[region], int(Z[i]), int(A[i]), int(m[i]), float(activity[i]), float(error[i]),
+                         sums.nfiles[region]))
+    return rows
+
+def nuclide_label(Z, A, m):
+    return '$^{%i%s}$%s' % (A, 'm' if m else '', find_nuclide(Z))
+
+def write_summary(outname, rows, tab_option):
+    directory, filename = os.path.split(os.path.abspath(outname))
+    temp = os.path.join(directory, '.%s.tmp' % filename)
+    with open(temp, 'w') as fout:
+        if tab_option == 'csv':
+            fout.write("Region, Z, A, Isomer, Nuclide, Activity Bq, Error, Files\n")
+            for region, Z, A, m, activity, error, nfiles in rows:
+                fout.write("%s, %i, %i, %i, %s%i%s, %.4E, %.2f, %i\n" % (region, Z, A, m, find_nuclide(Z), A,
+                                                                        'm' if m else '', activity, error, nfiles))
+        else:
+            for region in sorted(set(row[0] for row in rows), key=[row[0] for row in rows].index):
+                lines = ['{:4s} {:2s} {:12s} {:2s}'.format(' ', '{}', ' ', '& ') +
+                         '{:10s} {:2s}'.format(nuclide_label(Z, A, m), '& ') +
+                         '{:20s} {:9s}'.format('%.3E $\\pm$ %.1f\\%%' % (activity, error), '& {}') + "\\\\ \n"
+                         for r, Z, A, m, activity, error, nfiles in rows if r == region]
+                fout.write(LaTemplate.safe_substitute(TABLE=''.join(lines), REGION=region.replace('_', '\\_')))
+                fout.write('\n')
+    os.rename(temp, outname)
+
+# the table files of the batch mode: the arguments, with wildcards expanded,
+# or those of the main input in the current directory
+def batch_files(directory, input_base, args):
+    if not args:
+        return sorted(find_files(directory, input_base))
+    paths = []
+    for arg in args:
+        paths.extend(sorted(glob(arg)) if any(c in arg for c in '*?[') else [arg])
+    return paths
+
+def main_batch(paths, input_base, options):
+    warn('%i RESNUCLe files to aggregate' % len(paths))
+    sums = aggregate(paths, options.processes)
+    rows = summary_rows(sums, options.top)
+    outname = options.output or '%s_resnucle_summary.%s' % (input_base, options.opt_table)
+    write_summary(outname, rows, options.opt_table)
+    warn('%i regions, %i nuclides with nonzero activity; wrote %i rows to %s' %
+         (len(sums.regions), int((sums.activities > 0).sum()), len(rows), outname))
+
+
 def main():
     directory = os.getcwd()
     warn('Directory: %s' % directory)
     warn('User: %s' % os.getenv('LOGNAME'))
 
-    res_files, tab_option = process_arguments(directory)
+    res_files, tab_option, input_base, options = process_arguments(directory)
 
     #If no files have to be processed, exit
     if not res_files:
         sys.exit('Nothing to do.')
 
+    if options.batch:
+        main_batch(res_files, input_base, options)
+        return
+
     warn('RESNUCLe files to process: \n%s\n' % res_files)
         
     for res in res_files:
@@ -190,7 +417,7 @@ def main():
                 tabletext[i] = tabletext[i] + '{:20s} {:9s}'.format(str(Bq_iso[i-len(A)]),'& {}')
                 tabletext[i] = tabletext[i] + "\\\\ \n"  
             tabletext = ''.join(tabletext)    
-            LaTable = LaTemplate.safe_substitute(TABLE = tabletext)
+            LaTable = LaTemplate.safe_substitute(TABLE = tabletext, REGION = '   ')
             with open(outname, 'w') as fout:
                 fout.write(LaTable)
 
@@ -0,0 +1,424 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# reading and merging of the Fortran-unformatted scoring files (fort.NN) that
+# FLUKA writes for USRBIN, USRBDX and USRTRACK/USRCOLL, without a FLUKA
+# installation.  the files of the individual jobs are merged the way the flutil
+# combiners (usbsuw, usxsuw, ustsuw) do: each job is a batch weighted by its
+# primary weight w_i, and for every bin
+#
+#     mean  = sum(w_i x_i) / W
+#     error = sqrt((sum(w_i x_i^2) / W - mean^2) / (N - 1)) / mean
+#
+# with W = sum(w_i) and N the number of batches; the error is relative, as in
+# the STATISTICS section of the usbsuw output.  the sums are associative, so
+# the merge is a tree reduction of partial sums computed in parallel.
+#
+# only the STATISTICS section of usbsuw, one record of errors per detector
+# after a record holding the marker and the number of detectors, is read and
+# written.  usxsuw and ustsuw lay theirs out differently (with the integrals
+# and cumulative spectra of each detector), which is not reproduced and has
+# not been checked against their output: USRBDX and USRTRACK files are read
+# (so that their means can be compared), but only USRBIN is in NATIVE_KINDS.
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import json
+import struct
+import zipfile
+import collections
+from optparse import OptionParser
+from multiprocessing import Pool
+import numpy
+
+DEFAULT_PROCESSES = 4
+
+# the run header; older versions of FLUKA do not write the number of primaries
+# and batches, recent ones may add a counter of billions of primaries.
+RUN_HEADER_FORMATS = {
+    116: "=80s32sf",
+    120: "=80s32sfi",
+    124: "=80s32sfii",
+    128: "=80s32sfiii",
+    }
+
+USRBIN   = "usrbin"
+USRBDX   = "usrbdx"
+USRTRACK = "usrtrack"
+
+# detector header layouts, told apart by their size
+DETECTOR_FORMATS = {
+    86: (USRBIN,   "=i10siiffifffifffififff",
+         "nb name type score xlow xhigh nx dx ylow yhigh ny dy zlow zhigh nz dz lntzer bk b2 tc"),
+    78: (USRBDX,   "=i10siiiifiiiffifffif",
+         "nb name type dist reg1 reg2 area twoway fluence lowneu elow ehigh ne de alow ahigh na da"),
+    50: (USRTRACK, "=i10siiififfif",
+         "nb name type dist reg volume lowneu elow ehigh ne de"),
+    }
+
+# the scoring kinds each flutil combiner handles
+KINDS = dict(usrbin=USRBIN, usrbdx=USRBDX, usrtrack=USRTRACK, usrcoll=USRTRACK)
+
+# the scoring kinds whose combined files, statistical errors included, are
+# written as the flutil combiner writes them
+NATIVE_KINDS = (USRBIN,)
+
+STATISTICS = b"STATISTICS"
+
+Detector = collections.namedtuple("Detector", "kind header raw_header groups data")
+
+# header_format is the layout of the run header that was read (one of
+# RUN_HEADER_FORMATS), or None to choose it from ncase when writing
+class Scoring(object):
+    def __init__(self, title, time, weight, ncase, nbatch, detectors, errors=None, header_format=None):
+        self.title = title
+        self.time = time
+        self.weight = weight
+        self.ncase = ncase
+        self.nbatch = nbatch
+        self.detectors = detectors
+        self.errors = errors
+        self.header_format = header_format
+
+    @property
+    def kind(self):
+        return self.detectors[0].kind if self.detectors else None
+
+# returns the (offset, length) of each record of a Fortran sequential
+# unformatted file held in data
+def record_spans(data):
+    spans = []
+    offset = 0
+    while offset < len(data):
+        (length,) = struct.unpack_from("=i", data, offset)
+        if length < 0 or offset + 8 + length > len(data):
+            raise IOError("truncated Fortran record at byte %i" % offset)
+        (trailer,) = struct.unpack_from("=i", data, offset + 4 + length)
+        if trailer != length:
+            raise IOError("corrupt Fortran record at byte %i" % offset)
+        spans.append((offset + 4, length))
+        offset += 8 + length
+    return spans
+
+def detector_size(kind, header, groups):
+    if kind == USRBIN:
+        return header["nx"] * header["ny"] * header["nz"]
+    ngroup = struct.unpack_from("=i", groups)[0] if groups is not None else 0
+    if kind == USRBDX:
+        return (ngroup + header["ne"]) * header["na"]
+    return ngroup + header["ne"]
+
+def parse_detector_header(raw_header):
+    if len(raw_header) not in DETECTOR_FORMATS:
+        raise IOError("unknown detector header of %i bytes" % len(raw_header))
+    kind, format, names = DETECTOR_FORMATS[len(raw_header)]
+    header = dict(zip(names.split(), struct.unpack(format, raw_header)))
+    header["name"] = header["name"].rstrip()
+    return kind, header
+
+# parses the contents of a scoring file
+def parse_scoring(data):
+    spans = record_spans(data)
+    if not spans:
+        raise IOError("empty scoring file")
+    offset, length = spans[0]
+    if length not in RUN_HEADER_FORMATS:
+        raise IOError("unknown run header of %i bytes" % length)
+    header_format = RUN_HEADER_FORMATS[length]
+    fields = struct.unpack_from(header_format, data, offset)
+    title, time, weight = fields[0].rstrip(), fields[1].rstrip(), fields[2]
+    ncase = fields[3] if len(fields) > 3 else 1
+    nbatch = fields[-1] if len(fields) > 4 else 1
+    if len(fields) > 5:
+        ncase += fields[4] * 1000000000
+
+    detectors, errors = [], None
+    i = 1
+    while i < len(spans):
+        offset, length = spans[i]
+        if data[offset:offset+len(STATISTICS)] == STATISTICS:
+            if all(detector.kind == USRBIN for detector in detectors):
+                errors = parse_statistics(data, spans[i+1:], detectors)
+            break
+        raw_header = data[offset:offset+length]
+        kind, header = parse_detector_header(raw_header)
+        i += 1
+        groups = None
+        if kind != USRBIN and header["lowneu"]:
+            offset, length = spans[i]
+            groups = data[offset:offset+length]
+            i += 1
+        size = detector_size(kind, header, groups)
+        offset, length = spans[i]
+        if length != 4 * size:
+            raise IOError("detector %s: expected %i values, found %i bytes" % (header["name"], size, length))
+        detectors.append(Detector(kind, header, raw_header, groups,
+                                  numpy.frombuffer(data, dtype=numpy.float32, count=size, offset=offset)))
+        i += 1
+    return Scoring(title, time, weight, ncase, nbatch, detectors, errors, header_format)
+
+# the relative errors of the STATISTICS section of a usbsuw file, one record
+# per detector of as many values as its bins
+def parse_statistics(data, spans, detectors):
+    if len(spans) < len(detectors):
+        raise IOError("STATISTICS section of %i records for %i detectors" % (len(spans), len(detectors)))
+    errors = []
+    for detector, (offset, length) in zip(detectors, spans):
+        if length != 4 * len(detector.data):
+            raise IOError("detector %s: expected %i errors, found %i bytes"
+                          % (detector.header["name"], len(detector.data), length))
+        errors.append(numpy.frombuffer(data, dtype=numpy.float32, count=length // 4, offset=offset))
+    return errors
+
+# reads a scoring file; source is a path or a (zip, member) pair
+def read_scoring(source):
+    if isinstance(source, tuple):
+        archive = zipfile.ZipFile(source[0])
+        try:
+            data = archive.read(source[1])
+        finally:
+            archive.close()
+    else:
+        with open(source, 'rb') as file:
+            data = file.read()
+    return parse_scoring(data)
+
+# partial sums over a set of batches; adding two partials gives the partial of
+# the union of their batches.
+class Partial(object):
+    def __init__(self, template=None, weight=0.0, ncase=0, nbatch=0, sums=None, squares=None):
+        self.template = template
+        self.weight = weight
+        self.ncase = ncase
+        self.nbatch = nbatch
+        self.sums = sums
+        self.squares = squares
+
+    @classmethod
+    def of(cls, scoring):
+        w = float(scoring.weight)
+        data = [detector.data.astype(numpy.float64) for detector in scoring.detectors]
+        return cls(Scoring(scoring.title, scoring.time, scoring.weight, scoring.ncase, scoring.nbatch,
+                           [detector._replace(data=None) for detector in scoring.detectors],
+                           header_format=scoring.header_format),
+                   w, scoring.ncase, 1, [w * x for x in data], [w * x * x for x in data])
+
+    def __add__(self, other):
+        if self.nbatch == 0:
+            return other
+        if other.nbatch == 0:
+            return self
+        if [d.raw_header for d in self.template.detectors] != [d.raw_header for d in other.template.detectors]:
+            raise ValueError("cannot merge scorings with different detectors")
+        return Partial(self.template, self.weight + other.weight, self.ncase + other.ncase,
+                       self.nbatch + other.nbatch,
+                       [a + b for a, b in zip(self.sums, other.sums)],
+                       [a + b for a, b in zip(self.squares, other.squares)])
+
+    def means(self):
+        return [s / self.weight for s in self.sums]
+
+    def errors(self):
+        errors = []
+        for s, s2 in zip(self.sums, self.squares):
+            mean = s / self.weight
+            if self.nbatch < 2:
+                errors.append(numpy.zeros_like(mean))
+                continue
+            variance = numpy.maximum(s2 / self.weight - mean * mean, 0.0) / (self.nbatch - 1)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                errors.append(numpy.where(mean != 0.0, numpy.sqrt(variance) / numpy.abs(mean), 0.0))
+        return errors
+
+    def scoring(self):
+        template = self.template
+        return Scoring(template.title, template.time, self.weight, self.ncase, self.nbatch,
+                       [detector._replace(data=mean.astype(numpy.float32))
+                        for detector, mean in zip(template.detectors, self.means())],
+                       [error.astype(numpy.float32) for error in self.errors()],
+                       template.header_format)
+
+# saves a partial together with a description of the sources folded into it,
+# e.g. to continue summing later.  the file is replaced atomically.
+def save_partial(path, partial, folded):
+    arrays = dict(weight=numpy.float64(partial.weight), ncase=numpy.int64(partial.ncase),
+                  nbatch=numpy.int64(partial.nbatch),
+                  title=numpy.frombuffer(partial.template.title, dtype=numpy.uint8),
+                  time=numpy.frombuffer(partial.template.time, dtype=numpy.uint8),
+                  folded=numpy.array(json.dumps(folded, sort_keys=True)))
+    if partial.template.header_format is not None:
+        arrays["header_format"] = numpy.array(partial.template.header_format)
+    for i, detector in enumerate(partial.template.detectors):
+        arrays["header_%i" % i] = numpy.frombuffer(detector.raw_header, dtype=numpy.uint8)
+        if detector.groups is not None:
+            arrays["groups_%i" % i] = numpy.frombuffer(detector.groups, dtype=numpy.uint8)
+        arrays["sums_%i" % i] = partial.sums[i]
+        arrays["squares_%i" % i] = partial.squares[i]
+    temp = "%s.tmp" % path
+    with open(temp, 'wb') as file:
+        numpy.savez(file, **arrays)
+    os.rename(temp, path)
+
+# loads a partial saved by save_partial; returns (partial, folded)
+def load_partial(path):
+    arrays = numpy.load(path)
+    try:
+        detectors, sums, squares = [], [], []
+        i = 0
+        while "header_%i" % i in arrays:
+            raw_header = arrays["header_%i" % i].tobytes()
+            groups = arrays["groups_%i" % i].tobytes() if "groups_%i" % i in arrays else None
+            kind, header = parse_detector_header(raw_header)
+            detectors.append(Detector(kind, header, raw_header, groups, None))
+            sums.append(arrays["sums_%i" % i])
+            squares.append(arrays["squares_%i" % i])
+            i += 1
+        header_format = str(arrays["header_format"]) if "header_format" in arrays else None
+        template = Scoring(arrays["title"].tobytes(), arrays["time"].tobytes(), 0.0, 0, 0, detectors,
+                           header_format=header_format)
+        partial = Partial(template, float(arrays["weight"]), int(arrays["ncase"]), int(arrays["nbatch"]),
+                          sums, squares)
+        return partial, json.loads(str(arrays["folded"]))
+    finally:
+        arrays.close()
+
+def partial_of_sources(sources):
+    partial = Partial()
+    for source in sources:
+        partial = partial + Partial.of(read_scoring(source))
+    return partial
+
+# pairwise reduction, so that rounding errors grow with the depth of the tree
+# rather than with the number of files
+def tree_reduce(partials):
+    partials = list(partials)
+    if not partials:
+        return Partial()
+    while len(partials) > 1:
+        partials = [partials[i] + partials[i+1] if i + 1 < len(partials) else partials[i]
+                    for i in range(0, len(partials), 2)]
+    return partials[0]
+
+# merges the scoring files (paths or (zip, member) pairs) using a pool of
+# processes, each summing a contiguous chunk of the files.
+def merge(sources, processes=DEFAULT_PROCESSES, chunksize=16):
+    sources = list(sources)
+    chunks = [sources[i:i+chunksize] for i in range(0, len(sources), chunksize)]
+    if processes > 1 and len(chunks) > 1:
+        pool = Pool(min(processes, len(chunks)))
+        try:
+            partials = pool.map(partial_of_sources, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        partials = [partial_of_sources(chunk) for chunk in chunks]
+    return tree_reduce(partials)
+
+def write_record(file, data):
+    file.write(struct.pack("=i", len(data)))
+    file.write(data)
+    file.write(struct.pack("=i", len(data)))
+
+# packs the run header in the layout it was read in.  a scoring that was not
+# read from a file, or whose number of primaries no longer fits that layout,
+# gets the layout with the number of batches (and of billions of primaries if
+# needed).
+def pack_run_header(scoring):
+    title, time, weight = scoring.title.ljust(80), scoring.time.ljust(32), scoring.weight
+    ncase = scoring.ncase
+    header_format = scoring.header_format
+    if header_format is None or (header_format != RUN_HEADER_FORMATS[128] and ncase >= 2**31):
+        header_format = RUN_HEADER_FORMATS[124] if ncase < 2**31 else RUN_HEADER_FORMATS[128]
+    if header_format == RUN_HEADER_FORMATS[116]:
+        return struct.pack(header_format, title, time, weight)
+    if header_format == RUN_HEADER_FORMATS[120]:
+        return struct.pack(header_format, title, time, weight, ncase)
+    if header_format == RUN_HEADER_FORMATS[124]:
+        return struct.pack(header_format, title, time, weight, ncase, scoring.nbatch)
+    return struct.pack(header_format, title, time, weight,
+                       ncase % 1000000000, ncase // 1000000000, scoring.nbatch)
+
+# writes a scoring file in the layout it was read in, followed, for USRBIN
+# detectors, by a STATISTICS section holding the relative error of each
+# detector if known.
+def write_scoring(path, scoring):
+    with open(path, 'wb') as file:
+        write_record(file, pack_run_header(scoring))
+        for detector in scoring.detectors:
+            write_record(file, detector.raw_header)
+            if detector.groups is not None:
+                write_record(file, detector.groups)
+            write_record(file, numpy.asarray(detector.data, dtype=numpy.float32).tobytes())
+        if scoring.errors is not None and all(d.kind == USRBIN for d in scoring.detectors):
+            write_record(file, STATISTICS + struct.pack("=i", len(scoring.errors)))
+            for error in scoring.errors:
+                write_record(file, numpy.asarray(error, dtype=numpy.float32).tobytes())
+
+# compares merged means (and errors, where the reference has a STATISTICS
+# section) with a file summed by the flutil tools.  returns a list of
+# (detector, quantity, largest relative difference) exceeding rtol; raises
+# ValueError if the two do not hold the same detectors and bins.
+def compare(scoring, reference, rtol=1e-5):
+    mismatches = []
+    if len(scoring.detectors) != len(reference.detectors):
+        raise ValueError("%i detectors, the reference has %i" % (len(scoring.detectors), len(reference.detectors)))
+    pairs = [(d.header["name"], "mean", d.data, r.data) for d, r in zip(scoring.detectors, reference.detectors)]
+    if scoring.errors is not None and reference.errors is not None:
+        pairs += [(d.header["name"], "error", e, r)
+                  for d, e, r in zip(scoring.detectors, scoring.errors, reference.errors)]
+    for name, quantity, ours, theirs in pairs:
+        if len(ours) != len(theirs):
+            raise ValueError("detector %s: %i values of the %s, the reference has %i"
+                             % (name, len(ours), quantity, len(theirs)))
+        ours, theirs = numpy.asarray(ours, dtype=numpy.float64), numpy.asarray(theirs, dtype=numpy.float64)
+        scale = numpy.maximum(numpy.abs(theirs), numpy.abs(theirs).max() * 1e-6 + 1e-300)
+        difference = (numpy.abs(ours - theirs) / scale).max() if len(ours) else 0.0
+        if difference > rtol:
+            mismatches.append((name, quantity, difference))
+    return mismatches
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options] output_file input_files...",
+                          description="Merge FLUKA USRBIN/USRBDX/USRTRACK scoring files without flutil",
+                          epilog=("Merges the fort.NN files of the individual jobs into output_file, "
+                                  "computing the mean and relative statistical error the way the "
+                                  "flutil combiners do.  With --validate, the result is compared "
+                                  "with a file summed by usbsuw/usxsuw/ustsuw; the errors only for usbsuw."))
+    parser.add_option("-j", "--processes", dest="processes", type="int", default=DEFAULT_PROCESSES,
+                      help="read and sum files in N processes", metavar="N")
+    parser.add_option("--validate", dest="validate", default=None,
+                      help="compare the merged result with the flutil output FILE", metavar="FILE")
+    parser.add_option("--rtol", dest="rtol", type="float", default=1e-5,
+                      help="relative tolerance for --validate")
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2:
+        sys.exit(parser.get_usage())
+
+    return (args[0], args[1:], options)
+
+def main():
+    outfile, infiles, options = process_arguments()
+    merged = merge(infiles, options.processes).scoring()
+    write_scoring(outfile, merged)
+    warn('merged %i files (%i primaries) into %s' % (merged.nbatch, merged.ncase, outfile))
+    if merged.kind is not None and merged.kind not in NATIVE_KINDS:
+        warn('%s: the statistical errors of %s are not written' % (outfile, merged.kind.upper()))
+    if options.validate:
+        try:
+            mismatches = compare(merged, read_scoring(options.validate), options.rtol)
+        except ValueError as e:
+            sys.exit('merged result does not match %s: %s' % (options.validate, e))
+        for name, quantity, difference in mismatches:
+            warn('detector %s: %s differs by up to %.3g' % (name, quantity, difference))
+        if mismatches:
+            sys.exit('merged result does not match %s' % options.validate)
+        warn('merged result matches %s' % options.validate)
+
+if __name__ == '__main__':
+    main()
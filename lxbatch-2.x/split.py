@@ -17,14 +17,17 @@ def warn(*objs):
 
 import string
 import numbers
+import collections
 import itertools as it
 import re
 import os
 import sys
-import shutil
-import tempfile
+import hashlib
 from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
 import util as ut
+import manifest as mf
+import card as cd
 import traceback
 
 VERSION="""
@@ -33,43 +36,189 @@ ut.require_version_match(VERSION)
 
 DEFAULT_NPRIMARIES = 100
 DEFAULT_NSPLITS = 10
+DEFAULT_THREADS = 4
 
-RE_ITERATE = re.compile(r"^\*[ ]?#lxbatch\s+iterate\s+(?P<path>\S+)\s*$", flags=re.MULTILINE)
+# with --shared, the fixed segments of the card at least this long are written
+# once, to files named after their contents, and the job files #include them.
+# the jobs run rfluka in a subdirectory of the directory holding both.
+SHARED_MIN_SIZE = 4096
+SHARED_SUFFIX = ".inc"
+SHARED_INCLUDE_PREFIX = "../"
 
-def prepare_card_iterators(contents):
+def prepare_card_iterators(paths):
     iterators = {}
-    for match in RE_ITERATE.finditer(contents):
-        path = match.group("path")
+    for path in paths:
         if path in iterators:
             raise RuntimeError("path %s used more than once in *#lxbatch iterate directive" % path)
         iterators[path] = open(path, "r")
-    warn("importing cards from files: %s" % iterators.keys())
+    warn("importing cards from files: %s" % list(iterators.keys()))
     return iterators
 
-def insert_iterated_cards(contents, iterators):
-    def iterated_card(match):
-        path = match.group("path")
+# a compiled input card is a list of fixed text segments interleaved with the
+# slots that change from job to job.  the slots are the lines of the START and
+# RANDOMIZ cards, including those in false #if blocks, and of the *#lxbatch
+# iterate directives, without their line endings (and the blank lines after
+# a directive): exactly what render_text rewrites, so rendering a template is
+# byte-identical to running that over the full text of every job.  with
+# --check, split.py renders every job both ways and stops if they differ.
+Slot = collections.namedtuple("Slot", "kind text")
+
+SLOT_START    = "START"
+SLOT_RANDOMIZ = "RANDOMIZ"
+SLOT_ITERATE  = "iterate"
+
+def compile_template(card):
+    slots = {}
+    for kind in (SLOT_START, SLOT_RANDOMIZ):
+        for c in card.cards(kind, inactive=True):
+            slots[c.line] = Slot(kind, card.lines[c.line].rstrip("\n"))
+    for line, kind, argument in card.directive_lines:
+        if kind == SLOT_ITERATE and len(argument.split()) == 1:
+            slots[line] = Slot(kind, argument.strip())
+    template, position, ending = [], 0, ""
+    for line in sorted(slots):
+        template.append(ending + "".join(card.lines[position:line]))
+        template.append(slots[line])
+        ending = card.lines[line][len(card.lines[line].rstrip("\n")):]
+        position = line + 1
+        if slots[line].kind == SLOT_ITERATE:
+            # RE_ITERATE swallows the blank lines after the directive, and
+            # the line ending too at the end of the text
+            while position < len(card.lines) and not card.lines[position].strip():
+                position += 1
+            ending = "\n" if position < len(card.lines) else ""
+    template.append(ending + "".join(card.lines[position:]))
+    return template
+
+def template_iterated_paths(template):
+    return [part.text for part in template if isinstance(part, Slot) and part.kind == SLOT_ITERATE]
+
+# draw the next card for each iterated slot of the template.  this has to
+# happen in job order, so it is done before handing the job to a worker.
+def draw_iterated_cards(template, iterators):
+    cards = {}
+    for path in template_iterated_paths(template):
         try:
-            return iterators[path].next()
+            cards[path] = next(iterators[path])
         except StopIteration:
             raise RuntimeError("not enough cards in %s" % path)
-    return RE_ITERATE.sub(iterated_card, contents)
-
-def make_copies(path_prefix, undoers, input_base, identifiers, seeds, nprimaries):
-    with open(os.path.join(path_prefix, "%s.inp" % input_base), 'r') as file:
-        contents = file.read()
-    contents = ut.set_nprimaries(contents, nprimaries)
-    card_iterators = prepare_card_iterators(contents)
-    for seed, identifier in zip(seeds, identifiers):
-        contents2 = contents
-        contents2 = insert_iterated_cards(contents2, card_iterators)
-        contents2 = ut.set_seed(contents2, seed)
-        output = '%s_%s.inp' % (input_base, identifier)
-        warn(output)
-        path = os.path.join(path_prefix, output)
-        with open(path, 'w') as file:
-            file.write(contents2)
-        undoers.append(lambda: os.remove(path))
+    return cards
+
+# returns the parts of the job's input file, to be written out in sequence.
+def render_template(template, nprimaries, seed, cards):
+    parts = []
+    nseeds = 0
+    for part in template:
+        if not isinstance(part, Slot):
+            parts.append(part)
+        elif part.kind == SLOT_START:
+            parts.append(ut.set_WHAT(part.text, ut.IWHAT_NPRIMARIES, nprimaries))
+        elif part.kind == SLOT_RANDOMIZ:
+            parts.append(ut.set_WHAT(part.text, ut.IWHAT_RANDOMSEED, seed))
+            nseeds += 1
+        else:
+            # iterated cards are inserted after the number of primaries has
+            # been set but before the seed is, so they may carry a RANDOMIZ card
+            # but keep their own START card.
+            card, n = ut.REGEX_RANDOMIZ.subn(
+                lambda match: ut.set_WHAT(match.group(0), ut.IWHAT_RANDOMSEED, seed), cards[part.text])
+            parts.append(card)
+            nseeds += n
+    if nseeds == 0:
+        raise ValueError("no RANDOMIZ card found in the input")
+    return parts
+
+# the *#lxbatch iterate directive, as split.py matched it over the full text
+RE_ITERATE = re.compile(r"^\*[ ]?#lxbatch\s+iterate\s+(?P<path>\S+)\s*$", flags=re.MULTILINE)
+
+# returns the job's input file rewritten from the full text of the base
+# input, as split.py did before it rendered templates
+def render_text(text, nprimaries, seed, cards):
+    text = ut.set_nprimaries(text, nprimaries)
+    text = RE_ITERATE.sub(lambda match: cards[match.group("path")], text)
+    return ut.set_seed(text, seed)
+
+# whether every #if of the text is closed within it, so that it can go into a
+# file of its own
+def preprocessor_balanced(text):
+    depth = 0
+    for line in text.splitlines():
+        match = cd.RE_PREPROCESSOR.match(line)
+        command = match.group("command") if match else ""
+        if command in ("if", "ifdef", "ifndef"):
+            depth += 1
+        elif command == "endif":
+            depth -= 1
+        elif command in ("elif", "else") and depth == 0:
+            return False
+        if depth < 0:
+            return False
+    return depth == 0
+
+def shared_filename(input_base, text):
+    digest = hashlib.sha1(text if isinstance(text, bytes) else text.encode("utf-8")).hexdigest()
+    return "%s.shared-%s%s" % (input_base, digest[:16], SHARED_SUFFIX)
+
+# replaces the long fixed segments of the template with #include lines of
+# files holding them, writing those that do not exist yet.  the job files keep
+# copies of the *#lxbatch directives of the segments (as comments, to FLUKA),
+# so that execute.py finds them there.
+def share_template(path_prefix, journal, input_base, template):
+    shared = []
+    for part in template:
+        # a segment after a slot starts with the slot's line ending
+        body = part.lstrip("\r\n") if not isinstance(part, Slot) else ""
+        if not body or len(body) < SHARED_MIN_SIZE or not preprocessor_balanced(body):
+            shared.append(part)
+            continue
+        filename = shared_filename(input_base, body)
+        if not os.path.exists(os.path.join(path_prefix, filename)):
+            warn(filename)
+            journal.write(os.path.join(path_prefix, filename), body)
+        directives = [line + "\n" for line in body.splitlines() if cd.RE_DIRECTIVE.match(line)]
+        shared.append(part[:len(part) - len(body)] + "".join(directives) +
+                      "#include %s%s\n" % (SHARED_INCLUDE_PREFIX, filename))
+    return shared
+
+def make_copies(path_prefix, journal, manifest, input_base, base, identifiers, seeds, nprimaries,
+                threads=DEFAULT_THREADS, shared=False, check=False):
+    unshared = template = compile_template(base)
+    if shared:
+        template = share_template(path_prefix, journal, input_base, template)
+    text = "".join(base.lines)
+    card_iterators = prepare_card_iterators(template_iterated_paths(template))
+
+    # jobs are drawn in order in this thread and written out by the pool; at
+    # most a few jobs per thread are in flight at any time.
+    pool = ThreadPool(max(1, threads))
+    pending = collections.deque()
+    try:
+        for seed, identifier in zip(seeds, identifiers):
+            output = '%s_%s.inp' % (input_base, identifier)
+            warn(output)
+            cards = draw_iterated_cards(template, card_iterators)
+            parts = render_template(template, nprimaries, seed, cards)
+            if check:
+                rendered = parts if not shared else render_template(unshared, nprimaries, seed, cards)
+                if "".join(rendered) != render_text(text, nprimaries, seed, cards):
+                    raise RuntimeError("%s differs from the input rewritten as a whole" % output)
+            pending.append(pool.apply_async(journal.write, (os.path.join(path_prefix, output), parts)))
+            manifest.add_job(input_base, identifier, output, seed, nprimaries)
+            while len(pending) > 4 * max(1, threads):
+                pending.popleft().get()
+        while pending:
+            pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+
+# reads the base input keeping its line endings, which the job files keep:
+# in text mode Python 3 would turn CRLF into LF
+def read_base(path):
+    if sys.version_info[0] < 3:
+        return cd.read_card(path)
+    with open(path, "r", newline="") as file:
+        return cd.InputCard(file.read())
 
 def process_arguments():
     parser = OptionParser(usage="usage: %prog main_input_file.inp [NPRIMARIES [NSPLITS]]",
@@ -79,6 +228,14 @@ def process_arguments():
                                   "in each job; NSPLITS specifies the number of jobs to create. "
                                   "The jobs get consecutive random seeds counting up from the"
                                   "seed found in main_input_file.inp."))
+    parser.add_option("-j", "--threads", dest="threads", type="int", default=DEFAULT_THREADS,
+                      help="render job input files using N threads", metavar="N")
+    parser.add_option("-s", "--shared", action="store_true", dest="shared",
+                      help=("write the parts of the input common to all jobs once, and #include them "
+                            "from the job input files, which then hold only the cards that change"))
+    parser.add_option("--check", action="store_true", dest="check",
+                      help=("also rewrite the whole input for every job, as split.py did before it "
+                            "rendered templates, and stop if the two differ by a byte"))
     (options, args) = parser.parse_args()
 
     if len(args) < 1:
@@ -91,28 +248,24 @@ def process_arguments():
 
     return (input_base, nprimaries, nsplits, options)
 
-def prepare_replace(path_prefix, undoers, input_base, existing_jobs):
+def prepare_replace(path_prefix, journal, manifest, input_base, base, existing_jobs):
     if existing_jobs:
-        tempdir = tempfile.mkdtemp(prefix="split_replaced_", dir=path_prefix)
+        tempdir = journal.mkdtemp(prefix="split_replaced_", dir=path_prefix)
         warn("moving old jobs into %s..." % tempdir)
         for path in existing_jobs:
-            shutil.move(path, tempdir)
-        def undoer():
-            for path in existing_jobs:
-                shutil.move(os.path.join(tempdir, os.path.basename(path)), path_prefix)
-            os.rmdir(tempdir)
-        undoers.append(undoer)
+            journal.move(os.path.join(path_prefix, path), tempdir)
+        manifest.remove_jobs(input_base, [ut.get_identifier_from_filename(path, input_base) for path in existing_jobs])
 
-    seed_base = ut.get_seed_from_input(os.path.join(path_prefix, "%s.inp" % input_base))
+    seed_base = base.seed()
 
     identifiers = ut.generate_identifiers()
     seeds = ut.generate_seeds(seed_base)
 
     return (identifiers, seeds)
 
-def prepare_union(path_prefix, undoers, input_base, existing_jobs, identifier_base):
-    max_used_seed = max(ut.get_seed_from_input(path) for path in existing_jobs)
-    seed_base = ut.get_seed_from_input(os.path.join(path_prefix, "%s.inp" % input_base))
+def prepare_union(path_prefix, journal, manifest, input_base, base, existing_jobs, identifier_base):
+    max_used_seed = max(ut.get_job_seeds(path_prefix, existing_jobs))
+    seed_base = base.seed()
     seed_base = max(seed_base, max_used_seed + 1)
 
     identifiers = it.islice(ut.generate_identifiers(identifier_base), 1, None)
@@ -120,18 +273,19 @@ def prepare_union(path_prefix, undoers, input_base, existing_jobs, identifier_ba
 
     return (identifiers, seeds)
 
-def main(undoers, path_prefix=os.getcwd()):
+def main(journal, manifest, path_prefix=os.getcwd()):
     input_base, nprimaries, nsplits, options = process_arguments()
 
     warn('splitting %s.inp into %i jobs simulating %i primaries each' % (input_base, nsplits, nprimaries))
+    base = read_base(os.path.join(path_prefix, "%s.inp" % input_base))
 
-    existing_jobs = sorted(ut.find_jobs(path_prefix, input_base))
+    existing_jobs = ut.find_jobs(path_prefix, input_base)
     if existing_jobs:
         warn("Possible leftovers from a previous split were found:")
         for path in existing_jobs:
             warn("\t%s" % path)
 
-        identifier_base = ut.get_identifier_from_filename(sorted(existing_jobs)[-1], input_base)
+        identifier_base = manifest.last_identifier(input_base)
 
         warn("Possible leftovers from a previous split were found.  Do you want to replace "
              "this set with the new set of jobs, or do you want the union of the two sets?\n\n"
@@ -141,26 +295,32 @@ def main(undoers, path_prefix=os.getcwd()):
         choice = ut.query_choice("replace union".split(), "replace")
 
         if choice == "replace":
-            identifiers, seeds = prepare_replace(path_prefix, undoers, input_base, existing_jobs)
+            identifiers, seeds = prepare_replace(path_prefix, journal, manifest, input_base, base, existing_jobs)
         elif choice == "union":
-            identifiers, seeds = prepare_union(path_prefix, undoers, input_base, existing_jobs, identifier_base)
+            identifiers, seeds = prepare_union(path_prefix, journal, manifest, input_base, base, existing_jobs,
+                                               identifier_base)
     else:
-        identifiers, seeds = prepare_replace(path_prefix, undoers, input_base, [])
+        identifiers, seeds = prepare_replace(path_prefix, journal, manifest, input_base, base, [])
 
     identifiers = it.islice(identifiers, 0, nsplits)
     seeds       = it.islice(seeds,       0, nsplits)
-    make_copies(path_prefix, undoers, input_base, identifiers, seeds, nprimaries)
+    make_copies(path_prefix, journal, manifest, input_base, base, identifiers, seeds, nprimaries, options.threads,
+                options.shared, options.check)
 
 if __name__ == '__main__':
-    undoers = []
+    journal = ut.Journal()
+    manifest = mf.open_manifest(os.getcwd())
     try:
-        main(undoers)
-    except Exception:
-        warn("an error occurred; reverting filesystem state...")
-        try:
-            for undoer in reversed(undoers):
-                undoer()
-        except:
-            warn("an error occurred while trying to revert filesystem state.")
-            raise
+        main(journal, manifest)
+        journal.commit()
+        manifest.commit()
+    except BaseException:
+        manifest.rollback()
+        if journal:
+            warn("an error occurred; reverting filesystem state...")
+            try:
+                journal.rollback()
+            except:
+                warn("an error occurred while trying to revert filesystem state.")
+                raise
         raise
@@ -0,0 +1,330 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# stand-ins for rfluka and condor_submit, to drive the whole pipeline
+# (loadtest.py) without FLUKA or HTCondor.
+#
+#     stubs.py rfluka [stub options] [-e EXE] [-N N] [-M M] input[.inp]
+#
+# runs cycles N+1 to M of the job like rfluka, in a directory fluka_<pid>
+# whose outputs are moved next to the input when the run succeeds: the .out
+# (echoing the input, as FLUKA does), .log, .err, the random number file and a
+# _KAM dump of the crossings mgdraw.f would write, FORMAT(i7,i5,11e12.4).  the
+# number of primaries and the seed come from the START and RANDOMIZ cards, and
+# the same seed gives the same dump; cycle N+1 resumes from the random number
+# file of cycle N, which has to be there.  --failure-rate makes a run fail now and
+# then, as it does on the farm: it stops halfway, leaves its fluka_<pid>
+# directory behind and exits with status 1.
+#
+#     stubs.py condor_submit [--state DIR] submit_file
+#
+# checks that the executables and the transfer_input_files of every job of
+# the submit file exist, and answers like condor_submit, counting cluster IDs
+# up in DIR.  like HTCondor, it starts the user log of every job with its
+# submit event.  the jobs are not run; loadtest.py runs them with execute.py -L.
+#
+#     stubs.py condor_finish [--state DIR]
+#
+# ends the user logs of the jobs submitted so far as HTCondor would once they
+# ran: with an execute event and a terminate event holding the return value
+# of the job, the status its telemetry record reports (see execute.py), or an
+# abort event if it has none.  monitor.py can then follow the jobs.
+#
+# synthetic_card() makes an input card for them the size of v37214light.inp.
+# the stubs are started once per job, so they import as little as possible.
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import re
+import json
+import math
+import time
+import fcntl
+import random
+from optparse import OptionParser
+import util as ut
+import card as cd
+
+DEFAULT_RECORDS_PER_PRIMARY = 2.0
+DEFAULT_SECONDS_PER_PRIMARY = 0.0
+DEFAULT_FAILURE_RATE = 0.0
+DEFAULT_STATE = ".condor_stub"
+# the file in the state directory listing the user logs of the jobs submitted
+LOGS = "logs"
+
+# the particles crossing the QLumi planes: FLUKA code, mass (GeV) and share
+PARTICLES = [(7, 0.0, 0.40), (8, 0.939565, 0.25), (3, 0.000511, 0.10), (4, 0.000511, 0.05),
+             (1, 0.938272, 0.05), (13, 0.139570, 0.05), (14, 0.139570, 0.05),
+             (10, 0.105658, 0.025), (11, 0.105658, 0.025)]
+# the planes, at +-Z cm, are discs of RADIUS cm
+PLANE_Z = 1850.0
+PLANE_RADIUS = 10.0
+MEAN_KINETIC_ENERGY = 0.01
+SPEED_OF_LIGHT = 29979245800.0
+REAL_WIDTH = 12
+# lines of the synthetic input card, about those of v37214light.inp
+CARD_LINES = 13000
+
+# a real as Fortran writes it with E12.4, e.g. " -0.1234E+01"
+def fortran_real(x):
+    if x == 0:
+        return "0.0000E+00".rjust(REAL_WIDTH)
+    digits, exponent = ("%.3E" % abs(x)).split("E")
+    return ("%s0.%s%sE%+03i" % ("-" if x < 0 else "", digits[0], digits[2:], int(exponent) + 1)).rjust(REAL_WIDTH)
+
+def card_line(name, whats=(), sdum=""):
+    return (name.ljust(cd.NAME_WIDTH) + "".join(str(what).rjust(ut.WHAT_WIDTH) if what is not None
+                                                else " " * ut.WHAT_WIDTH for what in whats)).ljust(
+        cd.NAME_WIDTH + 6 * ut.WHAT_WIDTH) + sdum
+
+# an input card of about nlines lines laid out like the CMS inputs: a header,
+# a geometry of bodies and regions, the material of every region, a scoring,
+# and the RANDOMIZ and START cards split.py rewrites
+def synthetic_card(nlines=CARD_LINES):
+    nregions = max(1, (nlines - 30) // 3)
+    lines = ["* synthetic input card of %i regions" % nregions,
+             "TITLE", "synthetic geometry",
+             card_line("GLOBAL", ["10000.", None, None, "0.0", "1.", "1.0"]),
+             card_line("DEFAULTS", [], "PRECISIO"),
+             card_line("BEAMPOS", ["0.0", "0.0", "1E-09", "0.0", "0.0"]),
+             card_line("BEAM", ["-7000.0"], "PROTON"),
+             card_line("GEOBEGIN", [], "COMBNAME"),
+             "    0    0          synthetic geometry"]
+    lines += ["RCC B%05i      0.0 0.0 %.1f 0.0 0.0 1.0 %.1f" % (i, -0.5 * i, 1.0 + i) for i in range(nregions)]
+    lines += ["END"]
+    lines += ["R%05i        5 +B%05i -B%05i" % (i, i, max(0, i - 1)) for i in range(nregions)]
+    lines += ["END", card_line("GEOEND")]
+    materials = ["CARBON", "IRON", "ALUMINUM", "COPPER", "LEAD", "AIR"]
+    lines += [card_line("ASSIGNMA", [materials[i % len(materials)], "R%05i" % i]) for i in range(nregions)]
+    lines += [card_line("USRBIN", ["10.", "ENERGY", "-21.", "100.", "100.", "500."], "DOSE"),
+              card_line("USRBIN", ["-100.", "-100.", "0.0", "40.", "40.", "20."], "&"),
+              card_line("RANDOMIZ", ["1.0", "1234."]),
+              card_line("START", ["100."]),
+              card_line("STOP")]
+    return "".join(line + "\n" for line in lines)
+
+def poisson(rng, mean):
+    # Knuth's method; the means are small
+    limit, k, p = math.exp(-mean), 0, rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+
+# the lines of the dump of nprimaries primaries
+def crossings(rng, nprimaries, records_per_primary):
+    codes = [code for code, mass, share in PARTICLES]
+    masses = dict((code, mass) for code, mass, share in PARTICLES)
+    cumulative = [sum(share for code, mass, share in PARTICLES[:i + 1]) for i in range(len(PARTICLES))]
+    for ncase in range(1, nprimaries + 1):
+        for i in range(poisson(rng, records_per_primary)):
+            u = rng.random() * cumulative[-1]
+            code = codes[next(k for k, c in enumerate(cumulative) if u <= c)]
+            mass = masses[code]
+            energy = mass + rng.expovariate(1.0 / MEAN_KINETIC_ENERGY)
+            momentum = math.sqrt(energy * energy - mass * mass)
+            radius, phi = PLANE_RADIUS * math.sqrt(rng.random()), 2 * math.pi * rng.random()
+            z = PLANE_Z if rng.random() < 0.5 else -PLANE_Z
+            cx, cy = rng.gauss(0.0, 0.01), rng.gauss(0.0, 0.01)
+            cz = math.copysign(math.sqrt(max(0.0, 1.0 - cx * cx - cy * cy)), z)
+            reals = [energy, radius * math.cos(phi), radius * math.sin(phi), z, momentum, 1.0,
+                     abs(z) / SPEED_OF_LIGHT * (1 + rng.random()), 0.0, cx, cy, cz]
+            yield "%7i%5i%s\n" % (ncase % 10000000, code, "".join(fortran_real(x) for x in reals))
+
+# one cycle of the run in directory; returns whether it succeeded
+def run_cycle(directory, base, text, cycle, options):
+    nprimaries = ut.get_nprimaries(text) or 0
+    seed = ut.get_seed(text)
+    name = "%s%03i" % (base, cycle)
+    # the outputs depend on the seed only; failures on chance.  a cycle after
+    # the first goes on from the random number state the cycle before left in
+    # its ran file, so that running the cycles one at a time (-N k-1 -M k)
+    # gives the same outputs as running them all at once.
+    if cycle == 1:
+        rng = random.Random(seed * 1000 + cycle)
+    else:
+        with open("ran%s%03i" % (base, cycle - 1)) as ran:
+            rng = random.Random(int(ran.read().split()[1]))
+    failed = random.random() < options.failure_rate
+    last = nprimaries // 2 if failed else nprimaries
+
+    started = sum(os.times()[:2])
+    with open(os.path.join(directory, name + ".log"), "w") as log:
+        log.write(" stub rfluka: cycle %i of %s, %i primaries, seed %i\n" % (cycle, base, nprimaries, seed))
+    with open(os.path.join(directory, name + "_KAM"), "w") as dump:
+        records = 0
+        for line in crossings(rng, last, options.records_per_primary):
+            dump.write(line)
+            records += 1
+    if options.seconds_per_primary:
+        time.sleep(last * options.seconds_per_primary)
+    with open(os.path.join(directory, "ran" + name), "w") as ran:
+        ran.write(" %i %i\n" % (seed, rng.randint(0, 2**31 - 1)))
+    with open(os.path.join(directory, name + ".err"), "w") as err:
+        if failed:
+            err.write(" *** stub rfluka: abnormal termination after %i primaries ***\n" % last)
+    with open(os.path.join(directory, name + ".out"), "w") as out:
+        out.write(text)
+        # the summary of a run that got to its end, as FLUKA prints it; the
+        # time slept counts as CPU time
+        if not failed:
+            cpu = sum(os.times()[:2]) - started + last * options.seconds_per_primary
+            out.write("\n Total number of primaries run: %13i for a weight of: %15.7E\n" % (last, last))
+            out.write(" Total CPU time used to follow all primary particles: %12.4E seconds\n" % cpu)
+            out.write(" Average CPU time used to follow a primary particle:  %12.4E seconds\n"
+                      % (cpu / last if last else 0.0))
+            out.write(" Crossings dumped: %i\n\n End of FLUKA run\n" % records)
+    return not failed
+
+def rfluka(options, args):
+    if len(args) != 1:
+        sys.exit("usage: rfluka [-e EXE] [-N N] [-M M] input")
+    base = re.sub(r"\.inp$", "", args[0])
+    if not os.path.isfile(base + ".inp"):
+        sys.exit("rfluka: input file %s.inp not found" % base)
+    if options.executable and not os.path.isfile(options.executable):
+        sys.exit("rfluka: executable %s not found" % options.executable)
+    with open(base + ".inp") as file:
+        text = file.read()
+    if options.first > 0 and not os.path.isfile("ran%s%03i" % (base, options.first)):
+        sys.exit("rfluka: random number file ran%s%03i of cycle %i not found" % (base, options.first, options.first))
+
+    directory = "fluka_%i" % os.getpid()
+    os.mkdir(directory)
+    for cycle in range(options.first + 1, options.last + 1):
+        if not run_cycle(directory, base, text, cycle, options):
+            warn("rfluka: cycle %i of %s failed; see %s" % (cycle, base, directory))
+            sys.exit(1)
+        for fn in os.listdir(directory):
+            os.rename(os.path.join(directory, fn), fn)
+    os.rmdir(directory)
+
+RE_QUEUE_FROM = re.compile(r"^queue\s+(?P<variable>\w+)\s+from\s+(?P<list>\S+)\s*$", re.M)
+RE_SUBMIT_LINE = re.compile(r"^(?P<key>[+\w]+)\s*=\s*(?P<value>.*?)\s*$", re.M)
+RE_SUBMIT_MACRO = re.compile(r"\$\((?P<macro>\w+)\)")
+RE_LOG = re.compile(r"^(?P<job>.+)\.\d+\.\d+\.log$")
+
+# appends an event to a user log, in the layout monitor.py reads
+def log_event(path, code, cluster, proc, text):
+    with open(path, "a") as log:
+        log.write("%03i (%03i.%03i.000) %s %s\n...\n" % (code, cluster, proc, time.strftime("%Y-%m-%d %H:%M:%S"),
+                                                       text))
+
+def condor_submit(options, args):
+    if len(args) != 1:
+        sys.exit("usage: condor_submit submit_file")
+    with open(args[0]) as file:
+        submit = file.read()
+    commands = dict((match.group("key").lower(), match.group("value")) for match in RE_SUBMIT_LINE.finditer(submit))
+    match = RE_QUEUE_FROM.search(submit)
+    if match:
+        with open(match.group("list")) as jobs:
+            items = [dict([(match.group("variable"), line.strip())]) for line in jobs if line.strip()]
+    else:
+        items = [{}]
+
+    if not os.path.isdir(options.state):
+        os.makedirs(options.state)
+    with open(os.path.join(options.state, "clusters"), "a+") as counter:
+        fcntl.flock(counter, fcntl.LOCK_EX)
+        counter.seek(0)
+        cluster = int(counter.read().strip() or 0) + 1
+        missing, logs = [], []
+        for proc_id, item in enumerate(items):
+            item = dict(item, ClusterId=str(cluster), ProcId=str(proc_id))
+            expand = lambda value: RE_SUBMIT_MACRO.sub(lambda m: item.get(m.group("macro"), m.group(0)), value)
+            # the executable is found from the submit directory, the input
+            # files and the log from the initial directory
+            initialdir = expand(commands.get("initialdir", os.getcwd()))
+            paths = [expand(commands.get("executable", ""))]
+            paths += [os.path.join(initialdir, expand(fn.strip()))
+                      for fn in commands.get("transfer_input_files", "").split(",") if fn.strip()]
+            missing.extend(path for path in paths if not os.path.exists(path))
+            if "log" in commands:
+                logs.append((proc_id, os.path.abspath(os.path.join(initialdir, expand(commands["log"])))))
+        if missing:
+            sys.exit("ERROR: files of the jobs do not exist: %s" % ", ".join(sorted(set(missing))[:10]))
+        counter.seek(0)
+        counter.truncate()
+        counter.write("%i\n" % cluster)
+        with open(os.path.join(options.state, "submissions"), "a") as ledger:
+            ledger.write("%i %i %s\n" % (cluster, len(items), os.path.abspath(args[0])))
+        with open(os.path.join(options.state, LOGS), "a") as ledger:
+            for proc_id, log in logs:
+                log_event(log, 0, cluster, proc_id, "Job submitted from host: <127.0.0.1:9618>")
+                ledger.write("%i %i %s\n" % (cluster, proc_id, log))
+    print("Submitting job(s)%s" % ("." * len(items) if len(items) < 80 else "..."))
+    print("%i job(s) submitted to cluster %i." % (len(items), cluster))
+
+# ends the user logs of the jobs submitted that have not ended yet
+def condor_finish(options, args):
+    if args:
+        sys.exit("usage: condor_finish [--state DIR]")
+    path = os.path.join(options.state, LOGS)
+    if not os.path.exists(path):
+        return
+    with open(path) as ledger:
+        logs = [line.split(None, 2) for line in ledger if line.strip()]
+    ended = 0
+    for cluster, proc_id, log in logs:
+        cluster, proc_id, log = int(cluster), int(proc_id), log.strip()
+        with open(log) as file:
+            if re.search(r"^(005|009) ", file.read(), re.M):
+                continue
+        record = os.path.join(os.path.dirname(log), RE_LOG.match(os.path.basename(log)).group("job") + ".telemetry.json")
+        try:
+            with open(record) as file:
+                status = json.load(file)["status"]
+        except (IOError, OSError, ValueError, KeyError):
+            status = None
+        log_event(log, 1, cluster, proc_id, "Job executing on host: <127.0.0.1:9618>")
+        if status is None:
+            log_event(log, 9, cluster, proc_id, "Job was aborted.")
+        else:
+            log_event(log, 5, cluster, proc_id, "Job terminated.\n\t(1) Normal termination (return value %i)" % status)
+        ended += 1
+    print("%i job(s) ended." % ended)
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog rfluka [options] [-e EXE] [-N N] [-M M] input[.inp]\n"
+                                "       %prog condor_submit [--state DIR] submit_file\n"
+                                "       %prog condor_finish [--state DIR]",
+                          description="Stand-ins for rfluka and condor_submit")
+    parser.add_option("-e", dest="executable", default="", help="rfluka: the FLUKA executable", metavar="EXE")
+    parser.add_option("-N", dest="first", type="int", default=0, help="rfluka: the previous cycle", metavar="N")
+    parser.add_option("-M", dest="last", type="int", default=5, help="rfluka: the last cycle", metavar="M")
+    parser.add_option("--records-per-primary", dest="records_per_primary", type="float",
+                      default=DEFAULT_RECORDS_PER_PRIMARY,
+                      help="rfluka: dump R crossings per primary on average (default: %g)"
+                           % DEFAULT_RECORDS_PER_PRIMARY, metavar="R")
+    parser.add_option("--seconds-per-primary", dest="seconds_per_primary", type="float",
+                      default=DEFAULT_SECONDS_PER_PRIMARY,
+                      help="rfluka: take S seconds per primary (default: %g)" % DEFAULT_SECONDS_PER_PRIMARY,
+                      metavar="S")
+    parser.add_option("--failure-rate", dest="failure_rate", type="float", default=DEFAULT_FAILURE_RATE,
+                      help="rfluka: fail this fraction of the runs (default: %g)" % DEFAULT_FAILURE_RATE,
+                      metavar="FRACTION")
+    parser.add_option("--state", dest="state", default=DEFAULT_STATE,
+                      help="condor_submit, condor_finish: keep the cluster IDs and logs in DIR (default: %s)"
+                           % DEFAULT_STATE,
+                      metavar="DIR")
+    (options, args) = parser.parse_args()
+    if not args or args[0] not in ("rfluka", "condor_submit", "condor_finish"):
+        sys.exit(parser.get_usage())
+    return (options, args[0], args[1:])
+
+def main():
+    options, command, args = process_arguments()
+    if command == "rfluka":
+        rfluka(options, args)
+    elif command == "condor_submit":
+        condor_submit(options, args)
+    else:
+        condor_finish(options, args)
+
+if __name__ == '__main__':
+    main()
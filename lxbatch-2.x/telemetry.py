@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# cost of the primaries of a campaign, from the telemetry records of its jobs.
+# before it removes the FLUKA outputs, every job sums up its run in
+# <job>.telemetry.json (see TELEMETRY_SCRIPT in execute.py), staged out to its
+# CONDORcluster directory, or, for each segment of a chained job,
+# <job><cycle>.telemetry.json:
+#
+#     {"job": "v37214light_aaab", "segment": 1, "host": ..., "status": 0,
+#      "primaries": 100, "cpu_seconds": 412.7, "cpu_per_primary": 4.127,
+#      "kam_records": 5130, "wall_seconds": 431.2, "user_seconds": 425.1,
+#      "system_seconds": 1.9, "max_rss_kb": 1048576}
+#
+# the primaries and CPU time are those FLUKA reports at the end of its .out
+# file, so they are null for a run that did not get to its end; the user and
+# system time and peak memory are those of /usr/bin/time, null where there is
+# none.  the records are grouped by card variant (the input base of the job)
+# or by host into a table of the CPU time per primary, its spread across the
+# jobs, and the dump records, wall time and memory that go with it.
+
+from __future__ import print_function
+def warn(*objs):
+    print(*objs, file=sys.stderr)
+
+import sys
+import os
+import csv
+import glob
+import json
+import math
+import collections
+from optparse import OptionParser
+import util as ut
+
+VERSION="""
+2.x""".strip()
+ut.require_version_match(VERSION)
+
+GLOB = os.path.join("CONDOR*", "*.telemetry.json")
+
+GROUPS = ("variant", "host")
+DEFAULT_GROUP = "variant"
+
+COLUMNS = ("jobs", "failed", "primaries", "cpu_hours", "cpu_per_primary", "spread",
+           "cpu_hours_per_million", "kam_per_primary", "wall_seconds", "max_rss_mb")
+
+# header and format of the columns in the printed table
+FORMATS = collections.OrderedDict([
+    ("jobs",                  ("jobs", "%6i")),
+    ("failed",                ("failed", "%6i")),
+    ("primaries",             ("primaries", "%12i")),
+    ("cpu_hours",             ("CPU h", "%10.2f")),
+    ("cpu_per_primary",       ("CPU s/primary", "%13.4g")),
+    ("spread",                ("spread", "%7.1f%%")),
+    ("cpu_hours_per_million", ("CPU h/1e6", "%10.1f")),
+    ("kam_per_primary",       ("KAM/primary", "%11.3f")),
+    ("wall_seconds",          ("mean wall s", "%11.1f")),
+    ("max_rss_mb",            ("max RSS MB", "%10.1f")),
+])
+
+# the records in paths, skipping the files that cannot be read
+def read_records(paths):
+    records = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                records.append(json.load(f))
+        except (IOError, OSError, ValueError) as e:
+            warn("%s: %s, skipped" % (path, e))
+    return records
+
+# the variant a job belongs to: the input base of its card, e.g. v37214light
+# for v37214light_aaab
+def variant(record):
+    input_base, _ = ut.parse_job_filename(record["job"] + ".inp")
+    return input_base or record["job"]
+
+def group_key(record, group):
+    if group == "host":
+        return record.get("host") or "unknown"
+    return variant(record)
+
+def known(records, *keys):
+    return [r for r in records if all(r.get(k) is not None for k in keys)]
+
+def mean(values):
+    return sum(values) / len(values) if values else None
+
+# relative standard deviation of values, in percent
+def spread(values):
+    m = mean(values)
+    if len(values) < 2 or not m:
+        return None
+    return 100 * math.sqrt(sum((v - m) ** 2 for v in values) / (len(values) - 1)) / m
+
+# one row of the table, for the records of a group.  the CPU time per primary
+# is that of all the primaries of the group, over the jobs that report both.
+def cost_row(records):
+    timed = known(records, "primaries", "cpu_seconds")
+    primaries = sum(r["primaries"] for r in timed)
+    cpu_seconds = sum(r["cpu_seconds"] for r in timed)
+    cpu_per_primary = cpu_seconds / primaries if primaries else None
+    counted = known(records, "primaries", "kam_records")
+    counted_primaries = sum(r["primaries"] for r in counted)
+    rss = [r["max_rss_kb"] for r in known(records, "max_rss_kb")]
+    return collections.OrderedDict([
+        ("jobs", len(records)),
+        ("failed", sum(1 for r in records if r.get("status"))),
+        ("primaries", primaries),
+        ("cpu_hours", cpu_seconds / 3600.0),
+        ("cpu_per_primary", cpu_per_primary),
+        ("spread", spread([r["cpu_per_primary"] for r in known(timed, "cpu_per_primary")])),
+        ("cpu_hours_per_million", cpu_per_primary * 1e6 / 3600.0 if cpu_per_primary is not None else None),
+        ("kam_per_primary", (sum(r["kam_records"] for r in counted) / float(counted_primaries)
+                             if counted_primaries else None)),
+        ("wall_seconds", mean([r["wall_seconds"] for r in known(records, "wall_seconds")])),
+        ("max_rss_mb", max(rss) / 1024.0 if rss else None),
+    ])
+
+# the rows of the table, by group, and one for all the records
+def cost_table(records, group=DEFAULT_GROUP):
+    groups = collections.OrderedDict()
+    for record in sorted(records, key=lambda r: group_key(r, group)):
+        groups.setdefault(group_key(record, group), []).append(record)
+    table = collections.OrderedDict((key, cost_row(rs)) for key, rs in groups.items())
+    if len(groups) > 1:
+        table["all"] = cost_row(records)
+    return table
+
+def format_table(table, group=DEFAULT_GROUP):
+    width = max([len(group)] + [len(key) for key in table])
+    lines = ["  ".join([group.ljust(width)] +
+                       [header.rjust(len(fmt % 0)) for header, fmt in FORMATS.values()])]
+    for key, row in table.items():
+        cells = [key.ljust(width)]
+        for column, (header, fmt) in FORMATS.items():
+            cells.append((fmt % row[column]) if row[column] is not None else "-".rjust(len(fmt % 0)))
+        lines.append("  ".join(cells))
+    return "\n".join(lines)
+
+# writes the table to path, as csv or, for a .json path, json
+def write_table(table, path, group=DEFAULT_GROUP):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        if path.endswith(".json"):
+            json.dump([collections.OrderedDict([(group, key)] + list(row.items())) for key, row in table.items()],
+                      f, indent=1)
+            f.write("\n")
+        else:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow((group,) + COLUMNS)
+            for key, row in table.items():
+                writer.writerow([key] + ["" if row[c] is None else row[c] for c in COLUMNS])
+    os.rename(tmp, path)
+
+def process_arguments():
+    parser = OptionParser(usage="usage: %prog [options] [job.telemetry.json...]",
+                          description="Tabulate the cost of the primaries of a campaign",
+                          epilog=("Reads the given telemetry records of the jobs, or those matching %s, "
+                                  "and prints, per card variant, the CPU time per primary and its "
+                                  "spread across the jobs, the dump records per primary, the mean "
+                                  "wall time and the peak memory." % GLOB))
+    parser.add_option("-g", "--group-by", dest="group", choices=GROUPS, default=DEFAULT_GROUP,
+                      help="group the jobs by %s (default: %s)" % (" or ".join(GROUPS), DEFAULT_GROUP))
+    parser.add_option("-o", "--output", dest="output", metavar="FILE",
+                      help="also write the table to FILE, as json if it ends in .json, else as csv")
+    (options, args) = parser.parse_args()
+    return (options, args or sorted(glob.glob(GLOB)))
+
+def main():
+    options, paths = process_arguments()
+    if not paths:
+        sys.exit("nothing to do.")
+    records = read_records(paths)
+    if not records:
+        sys.exit("no telemetry records could be read.")
+    table = cost_table(records, options.group)
+    print(format_table(table, options.group))
+    if options.output:
+        write_table(table, options.output, options.group)
+        warn("wrote %s" % options.output)
+
+if __name__ == '__main__':
+    main()
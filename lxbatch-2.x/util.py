@@ -1,10 +1,17 @@
 import sys
 import os
 import re
+import shutil
+import tempfile
+import threading
 import subprocess
 import fnmatch
+import zipfile
+import collections
 import numbers
 import logging
+from multiprocessing.pool import ThreadPool
+import manifest as mf
 
 VERSION="""
 2.x""".strip()
@@ -13,6 +20,18 @@ def require_version_match(other_version):
     if VERSION != other_version:
         sys.exit("version mismatch; your installation of the LXBATCH scripts may be corrupted")
 
+# the HTCondor job flavours of the CERN batch service and their limits on the
+# wall time of a job, in seconds
+JOB_FLAVOURS = collections.OrderedDict([
+    ("espresso",     20 * 60),
+    ("microcentury", 60 * 60),
+    ("longlunch",    2 * 60 * 60),
+    ("workday",      8 * 60 * 60),
+    ("tomorrow",     24 * 60 * 60),
+    ("testmatch",    3 * 24 * 60 * 60),
+    ("nextweek",     7 * 24 * 60 * 60),
+])
+
 # FIXED format is assumed for the START and RANDOMIZE cards
 CARD_WIDTH = 72
 WHAT_WIDTH = 10
@@ -43,6 +62,15 @@ IWHAT_RANDOMSEED = 2
 def set_nprimaries(input, nprimaries):
     return re.sub(REGEX_START, lambda match: set_WHAT(match.group(0), IWHAT_NPRIMARIES, nprimaries), input)
 
+def get_nprimaries(input):
+    match = re.search(REGEX_START, input)
+    if not match:
+        return None
+    try:
+        return int(float(get_WHAT(match.group(0), IWHAT_NPRIMARIES)))
+    except ValueError:
+        return None
+
 def get_seed(input):
     assume_zero = False
     match = re.search(REGEX_RANDOMIZ, input)
@@ -75,69 +103,277 @@ def generate_seeds(base=0):
         yield seed
         seed += 1
 
+# identifiers count up through the four-letter words; rather than wrapping
+# around after "zzzz" (456976 jobs) they continue with "aaaaa".
 def generate_identifiers(base="aaaa"):
     a, z = ord('a'), ord('z')
     ks = [ord(c) - a for c in base]
     while True:
         yield ''.join(chr(a+k) for k in ks)
         # increment ks with rollover
-        for i in reversed(xrange(len(ks))):
+        for i in reversed(range(len(ks))):
             ks[i] += 1
             if ks[i] > z - a:
                 ks[i] = 0
             else:
                 break
+        else:
+            ks.insert(0, 0)
+
+# sort key putting identifiers in the order generate_identifiers produces them
+def identifier_key(identifier):
+    return (len(identifier), identifier)
+
+# the position of an identifier in the order generate_identifiers produces them
+def identifier_index(identifier):
+    # all the shorter identifiers come first
+    index = sum(26**length for length in range(4, len(identifier)))
+    value = 0
+    for c in identifier:
+        value = value * 26 + ord(c) - ord('a')
+    return index + value
 
 def get_identifier_from_filename(fn, input_base):
     match = re.match(get_job_filename_regex(input_base), fn)
     return match.group('counter')
 
+# record job input files found in the directory (or among filenames, its
+# listing) that the manifest does not know about yet, e.g. from a split made
+# before the manifest existed or files copied in by hand.
+def adopt_jobs(manifest, path_prefix, input_base, filenames=None):
+    known = set(manifest.jobs(input_base))
+    regex = get_job_filename_regex(input_base)
+    for fn in os.listdir(path_prefix) if filenames is None else filenames:
+        match = regex.match(fn)
+        if not match or fn in known:
+            continue
+        with open(os.path.join(path_prefix, fn), 'r') as file:
+            contents = file.read()
+        manifest.add_job(input_base, match.group('counter'), fn, get_seed(contents), get_nprimaries(contents))
+
+# brings the records of the jobs of input_base in line with the job input files
+# in the directory: records of files that are gone (e.g. deleted by hand) are
+# dropped and files not yet recorded are adopted.  only the new files are read.
+def sync_jobs(manifest, path_prefix, input_base):
+    filenames = set(os.listdir(path_prefix))
+    missing = [identifier for (identifier, filename) in manifest.query(
+                   "SELECT identifier, filename FROM jobs WHERE input_base = ?", input_base)
+               if filename not in filenames]
+    if missing:
+        manifest.remove_jobs(input_base, missing)
+    adopt_jobs(manifest, path_prefix, input_base, sorted(filenames))
+
 def find_jobs(path_prefix, input_base):
-    return [fn for fn in os.listdir(path_prefix)
-            if get_job_filename_regex(input_base).match(fn)]
+    manifest = mf.open_manifest(path_prefix)
+    sync_jobs(manifest, path_prefix, input_base)
+    manifest.commit()
+    return manifest.jobs(input_base)
+
+# returns the seeds of the given job input files, from the manifest where
+# possible and from the files themselves otherwise
+def get_job_seeds(path_prefix, inputs):
+    manifest = mf.open_manifest(path_prefix)
+    known = {}
+    seeds = []
+    for input in inputs:
+        input_base, identifier = parse_job_filename(input)
+        if input_base not in known:
+            known[input_base] = manifest.seeds(input_base) if input_base is not None else {}
+        seed = known[input_base].get(os.path.basename(input))
+        if seed is None:
+            seed = get_seed_from_input(os.path.join(path_prefix, input))
+        seeds.append(seed)
+    return seeds
 
 def extensionless_filename(fn):
     return os.path.splitext(os.path.basename(fn))[0]
 
+_job_filename_regexes = {}
 def get_job_filename_regex(input_base):
-    return re.compile('%s_(?P<counter>[a-z]{4}).inp' % re.escape(input_base))
+    if input_base not in _job_filename_regexes:
+        _job_filename_regexes[input_base] = re.compile('%s_(?P<counter>[a-z]{4,})\\.inp$' % re.escape(input_base))
+    return _job_filename_regexes[input_base]
+
+# splits a job input filename into its input base and identifier
+def parse_job_filename(fn):
+    match = re.match(r'(?P<input_base>.*)_(?P<counter>[a-z]{4,})\.inp$', os.path.basename(fn))
+    if not match:
+        return None, None
+    return match.group('input_base'), match.group('counter')
 
 # calls an external program and get its output.  like subprocess.check_output,
 # but backported.
 def check_output(cmd, *args, **kwargs):
-    p = subprocess.Popen(cmd, *args, stdout=subprocess.PIPE, **kwargs)
+    p = subprocess.Popen(cmd, *args, stdout=subprocess.PIPE, universal_newlines=True, **kwargs)
     return p.communicate()[0]
 
-# returns a list of paths of files in the zip with the given name.
-def files_in_zip(fn):
-    return check_output(('zipinfo', '-1', fn)).splitlines()
+# a job result that was not processed, and why
+FailedJob = collections.namedtuple("FailedJob", "filename reason")
 
-# conditions for a file to be relevant
-def is_job_result(fn, input_base):
+# conditions for a file to be a candidate job result
+def is_job_result(fn, input_base, directory='.'):
     if not fn.startswith('results_%s_' % input_base):
         return False
     if not fn.endswith('.zip'):
         return False
-    if not os.path.isfile(fn):
-        return False
-    # zips containing a directory matching fluka_* correspond to failed runs
-    if any(fnmatch.filter(files_in_zip(fn), 'fluka_*')):
-        logging.warning("not processing failed job %s" % fn)
+    if not os.path.isfile(os.path.join(directory, fn)):
         return False
     return True
 
+# returns the reason why the result zip corresponds to a failed job, or None.
+# only the central directory of the zip is read.
+def job_result_failure(path):
+    try:
+        archive = zipfile.ZipFile(path)
+        try:
+            names = archive.namelist()
+        finally:
+            archive.close()
+    except (zipfile.BadZipfile, IOError, OSError) as e:
+        return "unreadable zip: %s" % e
+    # zips containing a directory matching fluka_* correspond to failed runs
+    failed = fnmatch.filter(names, 'fluka_*')
+    if failed:
+        return "contains %s" % failed[0].split('/')[0]
+    return None
+
+# finds the job results in the directory and validates them, returning the
+# filenames of the good results and a list of FailedJobs.  verdicts are cached
+# in the manifest by (filename, size, mtime), so only new or changed zips are
+# opened; those are inspected by a pool of threads.
+def scan_job_results(directory, input_base, threads=8):
+    manifest = mf.open_manifest(directory)
+    if manifest.has_jobs(input_base):
+        candidates = ["results_%s.zip" % extensionless_filename(fn) for fn in manifest.jobs(input_base)]
+    else:
+        candidates = sorted(os.listdir(directory))
+    candidates = [fn for fn in candidates if is_job_result(fn, input_base, directory)]
+
+    verdicts = {}
+    unknown = []
+    for fn in candidates:
+        stat = os.stat(os.path.join(directory, fn))
+        cached = manifest.cached_result(fn, stat.st_size, stat.st_mtime)
+        if cached is None:
+            unknown.append((fn, stat))
+        else:
+            verdicts[fn] = cached[0]
+    if unknown:
+        pool = ThreadPool(max(1, min(threads, len(unknown))))
+        try:
+            failures = pool.map(job_result_failure, [os.path.join(directory, fn) for fn, stat in unknown])
+        finally:
+            pool.close()
+            pool.join()
+        for (fn, stat), failure in zip(unknown, failures):
+            manifest.cache_result(fn, stat.st_size, stat.st_mtime, failure)
+            verdicts[fn] = failure
+
+    results, failed = [], []
+    prefix = 'results_%s_' % input_base
+    for fn in candidates:
+        identifier = fn[len(prefix):-len('.zip')]
+        if verdicts[fn] is None:
+            results.append(fn)
+            manifest.set_status(input_base, identifier, mf.STATUS_FINISHED, output=fn)
+        else:
+            failed.append(FailedJob(fn, verdicts[fn]))
+            manifest.set_status(input_base, identifier, mf.STATUS_FAILED, output=fn)
+    manifest.commit()
+    return results, failed
+
 def find_job_results(directory, input_base):
-    return [fn for fn in os.listdir(directory) if is_job_result(fn, input_base)]
+    results, failed = scan_job_results(directory, input_base)
+    if failed:
+        logging.warning("not processing %i failed jobs: %s" % (len(failed), ' '.join(job.filename for job in failed)))
+    return results
 
 def have_results_for(directory, input):
-    return os.path.isfile("results_%s.zip" % extensionless_filename(input))
+    input_base, identifier = parse_job_filename(input)
+    if input_base is not None:
+        job = mf.open_manifest(directory).job(input_base, identifier)
+        if job is not None and job['status'] == mf.STATUS_FINISHED:
+            return True
+    return os.path.isfile(os.path.join(directory, "results_%s.zip" % extensionless_filename(input)))
+
+# a journal of filesystem changes that is committed or rolled back as a whole.
+# new files are written to temporary files next to their destination and only
+# renamed into place (atomically) on commit; moves and new directories are
+# recorded so that they can be reverted.
+class Journal(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.created = []
+        self.moved = []
+        self.directories = []
+        # temporary files are created with mode 0600; give the final files the
+        # permissions a plain open() would have given them.
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = 0o666 & ~umask
+
+    def __bool__(self):
+        return bool(self.pending or self.created or self.moved or self.directories)
+    __nonzero__ = __bool__
+
+    def mkdtemp(self, **kwargs):
+        path = tempfile.mkdtemp(**kwargs)
+        with self.lock:
+            self.directories.append(path)
+        return path
+
+    def move(self, src, dst):
+        dst = os.path.join(dst, os.path.basename(src)) if os.path.isdir(dst) else dst
+        shutil.move(src, dst)
+        with self.lock:
+            self.moved.append((src, dst))
+
+    # write the given string (or iterable of strings) to path on commit
+    def write(self, path, parts):
+        directory, filename = os.path.split(path)
+        fd, temp = tempfile.mkstemp(prefix='.%s.' % filename, suffix='.tmp', dir=directory or '.')
+        with self.lock:
+            self.pending.append((temp, path))
+        with os.fdopen(fd, 'w') as file:
+            if isinstance(parts, str):
+                file.write(parts)
+            else:
+                file.writelines(parts)
+        os.chmod(temp, self.mode)
+
+    def commit(self):
+        with self.lock:
+            for temp, path in self.pending:
+                os.rename(temp, path)
+                self.created.append(path)
+            self.pending = []
+
+    def rollback(self):
+        with self.lock:
+            for temp, path in self.pending:
+                if os.path.exists(temp):
+                    os.remove(temp)
+            for path in reversed(self.created):
+                os.remove(path)
+            for src, dst in reversed(self.moved):
+                shutil.move(dst, src)
+            for path in reversed(self.directories):
+                os.rmdir(path)
+            self.pending, self.created, self.moved, self.directories = [], [], [], []
+
+# reads a line from the terminal, under Python 2 and 3 alike
+try:
+    read_line = raw_input
+except NameError:
+    read_line = input
 
 def query_choice(options, default):
     assert(default in options)
     prompt = "Please enter one of %s (default=%s): " % (options, default)
     while True:
         sys.stdout.write(prompt)
-        choice = raw_input().strip().lower()
+        choice = read_line().strip().lower()
         if choice == '':
             choice = default
         # ensure unambiguous
@@ -12,7 +12,20 @@ c===========================================================================
       parameter (nrmap=180,nzmap=320)
       common /cmsmap/ drmap,dzmap,rminma,zminma,
      & rmaxma,zmaxma,br(nrmap,nzmap),bz(nrmap,nzmap),btot(nrmap,nzmap)
-      dimension bchk(3,46,31)
+      dimension bchk(3,46,31),hdr(7)
+      logical lfound
+c     the map compiled by lxbatch-2.x/fieldmap.py, if shipped with the job
+      call rdfmap('../cmssw501.fieldmap.bin',99,1,nrmap,nzmap,br,bz,
+     &            hdr,lfound)
+      if (lfound) then
+        drmap=hdr(1)
+        dzmap=hdr(2)
+        rminma=hdr(3)
+        zminma=hdr(4)
+        rmaxma=hdr(5)
+        zmaxma=hdr(6)
+        goto 5
+      endif
       drmap=5.d0
       dzmap=5.d0
       rminma=0.d0
@@ -25,6 +38,7 @@ c===========================================================================
             read(99,*) z,r,br(i,j),bz(i,j)
  4       continue
  3    continue
+ 5    continue
       do 1 i=1,nrmap
         do 2 j=1,nzmap
           btot(i,j)=sqrt(br(i,j)**2+bz(i,j)**2)
@@ -19,8 +19,23 @@
 *
       COMMON/FMPX/BXMAP(97,97),BYMAP(97,97),DXBMAP,
      &            DYBMAP
-      DIMENSION IB(97)                                                          
+      DIMENSION IB(97), HDR(7)
+      LOGICAL LFOUND, LREAD
+      SAVE LREAD
+      DATA LREAD / .FALSE. /
+*  usrglo and fieldi both call this; the map is read once
+      IF ( LREAD ) RETURN
+      LREAD = .TRUE.
       write(*,*) 'This is lbqfin.f'
+*  the map compiled by lxbatch-2.x/fieldmap.py, if shipped with the job,
+*  already scaled down by 1.1
+      CALL RDFMAP ( '../LBQ-KEK.MAP.bin', 98, 2, 97, 97, BXMAP, BYMAP,
+     &              HDR, LFOUND )
+      IF ( LFOUND ) THEN
+         DXBMAP = HDR(1)
+         DYBMAP = HDR(2)
+         RETURN
+      ENDIF
 c    open(87,file='../magfld.out')
 c    write(87,*) 'This is magfld.f'
 c      CALL OAUXFI('../LBQ-KEK.MAP',98,'OLD',IERR)
@@ -0,0 +1,58 @@
+      PROGRAM MAGCHK
+************************************************************************
+*  Driver for lxbatch-2.x/magfield.py --check-fortran, not part of     *
+*  the FLUKA executable.  Reads the lattice flag and the points from   *
+*  magchk.in and writes to magchk.out, for every point, the direction  *
+*  cosines and the magnitude of the field MAGFLD returns, and LITWOD   *
+*  of the x component of the quadrupole map on its 31 x 31 corner at   *
+*  (|x|, |y|).  Both files are unformatted streams of int32 and        *
+*  float64.  The maps are read by FIELDI from .., as in a job.         *
+************************************************************************
+      INCLUDE 'dblprc.inc'
+      INCLUDE 'dimpar.inc'
+      INCLUDE 'iounit.inc'
+      INCLUDE 'ltclcm.inc'
+*
+      COMMON/FMPX/BXMAP(97,97),BYMAP(97,97),DXBMAP,DYBMAP
+      INTEGER*4 MFLAG, NPTS
+      DIMENSION XQ(31), YQ(31), FQ(31,31)
+*
+      OPEN ( UNIT = 10, FILE = 'magchk.in', STATUS = 'OLD',
+     &       ACCESS = 'STREAM', FORM = 'UNFORMATTED' )
+      READ ( 10 ) MFLAG, NPTS
+      MLATTC = MFLAG
+      CALL FIELDI
+      DO 2 I = 1, 31
+         XQ(I) = (I-1) * DXBMAP
+         YQ(I) = (I-1) * DYBMAP
+         DO 1 J = 1, 31
+            FQ(I,J) = BXMAP(I,J)
+ 1       CONTINUE
+ 2    CONTINUE
+      OPEN ( UNIT = 11, FILE = 'magchk.out', STATUS = 'REPLACE',
+     &       ACCESS = 'STREAM', FORM = 'UNFORMATTED' )
+      DO 10 K = 1, NPTS
+         READ ( 10 ) X, Y, Z
+         BTX = 0.0D0
+         BTY = 0.0D0
+         BTZ = 0.0D0
+         B = 0.0D0
+         CALL MAGFLD ( X, Y, Z, BTX, BTY, BTZ, B, NREG, IDISC )
+         CALL LITWOD ( ABS(X), ABS(Y), F, 31, 31, XQ, YQ, FQ )
+         WRITE ( 11 ) BTX, BTY, BTZ, B, F
+ 10   CONTINUE
+      CLOSE ( 10 )
+      CLOSE ( 11 )
+      END
+*
+*  stand-ins for the FLUKA library routines that FIELDI calls
+      DOUBLE PRECISION FUNCTION FLRNDM ( DUMMY )
+      INCLUDE 'dblprc.inc'
+      FLRNDM = 0.5D0
+      END
+*
+      SUBROUTINE OAUXFI ( FNAME, LUN, CHSTAT, IERR )
+      INCLUDE 'dblprc.inc'
+      CHARACTER*(*) FNAME, CHSTAT
+      OPEN ( UNIT = LUN, FILE = FNAME, STATUS = CHSTAT, IOSTAT = IERR )
+      END
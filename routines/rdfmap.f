@@ -0,0 +1,57 @@
+      SUBROUTINE RDFMAP ( FNAME, LUN, KIND, N1, N2, A, B, HDR, LFOUND )
+************************************************************************
+*  Reads a field map compiled by lxbatch-2.x/fieldmap.py: a header     *
+*  and the two field components A and B, N1 x N2 each, in one read.    *
+*  LFOUND is false if the file FNAME does not exist.  The run stops if *
+*  it exists but does not hold a valid map of this KIND and size.      *
+*  HDR returns the grid spacings, the extents (min1, min2, max1, max2) *
+*  and the scale factor already applied to the field.                  *
+************************************************************************
+      INCLUDE 'dblprc.inc'
+      INCLUDE 'dimpar.inc'
+      INCLUDE 'iounit.inc'
+*
+      CHARACTER*(*) FNAME
+      CHARACTER*8 MAGIC
+      LOGICAL LFOUND
+      INTEGER*8 ICHK1, ICHK2, ISUM1, ISUM2, MFLTCH, IWORD
+      INTEGER*4 IWORDS(2)
+      PARAMETER ( MFLTCH = 4294967295_8 )
+      DIMENSION A(N1*N2), B(N1*N2), HDR(7)
+*
+      INQUIRE ( FILE = FNAME, EXIST = LFOUND )
+      IF ( .NOT. LFOUND ) RETURN
+      OPEN ( UNIT = LUN, FILE = FNAME, STATUS = 'OLD',
+     &       ACCESS = 'STREAM', FORM = 'UNFORMATTED', IOSTAT = IOS )
+      IF ( IOS .NE. 0 ) GO TO 900
+      READ ( LUN, IOSTAT = IOS ) MAGIC, IVER, KINDF, M1, M2, NCOMP,
+     &                           IPAD, HDR, ICHK1, ICHK2
+      IF ( IOS .NE. 0 ) GO TO 900
+      IF ( MAGIC .NE. 'LXFMAP01' .OR. IVER .NE. 1 .OR. KINDF .NE. KIND
+     &     .OR. M1 .NE. N1 .OR. M2 .NE. N2 .OR. NCOMP .NE. 2 ) GO TO 900
+      READ ( LUN, IOSTAT = IOS ) A, B
+      IF ( IOS .NE. 0 ) GO TO 900
+      CLOSE ( LUN )
+*  the Fletcher checksum of the values, as unsigned 32-bit words
+      ISUM1 = 0
+      ISUM2 = 0
+      DO 20 K = 1, 2*N1*N2
+         IF ( K .LE. N1*N2 ) THEN
+            IWORDS = TRANSFER ( A(K), IWORDS )
+         ELSE
+            IWORDS = TRANSFER ( B(K-N1*N2), IWORDS )
+         ENDIF
+         DO 10 L = 1, 2
+            IWORD = IAND ( INT ( IWORDS(L), 8 ), 4294967295_8 )
+            ISUM1 = MOD ( ISUM1 + IWORD, MFLTCH )
+            ISUM2 = MOD ( ISUM2 + ISUM1, MFLTCH )
+ 10      CONTINUE
+ 20   CONTINUE
+      IF ( ISUM1 .NE. ICHK1 .OR. ISUM2 .NE. ICHK2 ) GO TO 900
+      WRITE (*,*) 'Compiled field map ', FNAME, ' read'
+      RETURN
+ 900  CONTINUE
+      WRITE (*,*) 'RDFMAP: ', FNAME, ' is not a valid compiled map',
+     &            ' of kind', KIND, '; recompile it with fieldmap.py'
+      STOP 1
+      END